@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,10 +42,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tool.middleware.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
+    'tool.middleware.SlowRequestProfileMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -81,6 +84,27 @@ DATABASES = {
 }
 
 
+# Cache
+# Used for header samples and history pages. Switch to a shared backend
+# (e.g. Redis or the database cache) when running several workers.
+# Prometheus metrics (tool/metrics.py) have a cache of their own: its keys
+# never expire and must not be culled when the default cache fills up.
+# Conversion progress, cancellation and duplicate-request leases use the
+# 'shared' cache set up below MEDIA_ROOT.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'excel-tool',
+    },
+    'metrics': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'excel-tool-metrics',
+        'OPTIONS': {'MAX_ENTRIES': 100_000},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -121,8 +145,127 @@ STATICFILES_DIRS = [
 ]
 
 # Media files (User uploads)
+# Point EXCEL_SHARED_STORAGE_DIR at a directory mounted on every node (NFS,
+# SMB, ...) to let any worker or node serve any step of a conversion
 MEDIA_URL = 'media/'
-MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_ROOT = Path(os.environ.get('EXCEL_SHARED_STORAGE_DIR') or BASE_DIR / 'media')
+
+# Uploads, outputs and temp workbooks are stored once per distinct content
+STORAGES = {
+    'default': {
+        'BACKEND': 'tool.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Or keep them in an S3-compatible bucket (AWS S3, MinIO, ...); needs
+# `uv sync --extra s3`
+if os.environ.get('EXCEL_S3_BUCKET'):
+    STORAGES['default'] = {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        'OPTIONS': {
+            'bucket_name': os.environ['EXCEL_S3_BUCKET'],
+            'endpoint_url': os.environ.get('EXCEL_S3_ENDPOINT_URL') or None,
+            'location': os.environ.get('EXCEL_S3_PREFIX', ''),
+            'file_overwrite': False,
+        },
+    }
+
+# Progress, cancellation and single-flight state must be seen by every
+# process: Redis when EXCEL_REDIS_URL is set (`uv sync --extra redis`, also
+# used for the metrics), otherwise files under MEDIA_ROOT, which the
+# processes of one machine (or of all machines on a shared mount) share
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': MEDIA_ROOT / 'cache',
+    'OPTIONS': {'MAX_ENTRIES': 100_000},
+}
+if os.environ.get('EXCEL_REDIS_URL'):
+    CACHES['shared'] = CACHES['metrics'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['EXCEL_REDIS_URL'],
+    }
+
+# Files being written before they are stored (inside MEDIA_ROOT by default,
+# so storing them on a local or shared directory is a rename)
+EXCEL_SCRATCH_DIR = Path(os.environ.get('EXCEL_SCRATCH_DIR') or MEDIA_ROOT / 'temp' / 'scratch')
+
+# Uploads are hashed while they are received; small ones stay in memory and
+# are parsed from there, larger ones are spooled inside MEDIA_ROOT so storing
+# them is a rename rather than a second copy
+FILE_UPLOAD_HANDLERS = [
+    'tool.uploadhandlers.HashingMemoryFileUploadHandler',
+    'tool.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+FILE_UPLOAD_TEMP_DIR = MEDIA_ROOT / 'temp' / 'spool'
+
+# Workbook limits checked from metadata before any cell is parsed
+EXCEL_MAX_UNCOMPRESSED_SIZE = 500 * 1024 * 1024
+EXCEL_MAX_COMPRESSION_RATIO = 100
+EXCEL_MAX_CELLS = 50_000_000
+
+# Import pandas/openpyxl and run a small warm-up conversion when an ASGI
+# worker starts, instead of on its first conversion request
+EXCEL_PREWARM = os.environ.get('EXCEL_PREWARM', '').lower() in ('1', 'true', 'yes')
+
+# Per-request tracing: requests sent with an X-Excel-Trace: 1 header, and
+# this share (0-1) of all other requests, write a trace of their steps
+# (upload, sheet reads, cleaning, writes, zip, cleanup) to EXCEL_TRACE_DIR as
+# Chrome trace-event JSON (chrome://tracing, Perfetto) or OTLP/JSON ('otlp')
+EXCEL_TRACE_SAMPLE_RATE = float(os.environ.get('EXCEL_TRACE_SAMPLE_RATE') or 0)
+EXCEL_TRACE_FORMAT = os.environ.get('EXCEL_TRACE_FORMAT', 'chrome')
+EXCEL_TRACE_DIR = Path(os.environ.get('EXCEL_TRACE_DIR') or MEDIA_ROOT / 'traces')
+EXCEL_TRACE_MAX_FILES = 200
+
+# CPU-profile conversion requests (pyinstrument with `uv sync --extra
+# profiling`, cProfile otherwise) and keep the profiles of those slower than
+# EXCEL_SLOW_REQUEST_SECONDS as SlowRequestProfile records (Django admin)
+EXCEL_SLOW_REQUEST_PROFILING = os.environ.get('EXCEL_SLOW_REQUEST_PROFILING', '').lower() in ('1', 'true', 'yes')
+EXCEL_SLOW_REQUEST_SECONDS = float(os.environ.get('EXCEL_SLOW_REQUEST_SECONDS') or 10)
+EXCEL_SLOW_REQUEST_PROFILE_INTERVAL = 0.001
+EXCEL_SLOW_REQUEST_MAX_PROFILES = 50
+EXCEL_SLOW_REQUEST_VIEWS = [
+    'tool:upload',
+    'tool:process_sheets',
+    'tool:download_zip',
+    'tool:upload_file',
+    'tool:process',
+]
+
+# Peak memory of every conversion is recorded by stage (RSS growth and RSS
+# high-water mark); this share (0-1) of conversions also traces allocations
+# with tracemalloc, which slows them down. Conversions using more than
+# EXCEL_MEMORY_RATIO_THRESHOLD times their file size (and at least
+# EXCEL_MEMORY_FLAG_MIN_BYTES) are flagged.
+EXCEL_MEMORY_TRACE_SAMPLE_RATE = float(os.environ.get('EXCEL_MEMORY_TRACE_SAMPLE_RATE') or 0.05)
+EXCEL_MEMORY_RATIO_THRESHOLD = float(os.environ.get('EXCEL_MEMORY_RATIO_THRESHOLD') or 100)
+EXCEL_MEMORY_FLAG_MIN_BYTES = 64 * 1024 * 1024
+
+# Conversions run in EXCEL_CONVERSION_SLOTS slots per process (0 = no
+# limit), cheapest estimated cost (cells, from the workbook metadata) first.
+# Conversions of up to EXCEL_FAST_LANE_MAX_CELLS cells form the fast lane,
+# which keeps EXCEL_FAST_LANE_SLOTS slots for itself; a queued conversion's
+# cost halves every EXCEL_SCHEDULER_AGING_SECONDS so large ones still run.
+EXCEL_CONVERSION_SLOTS = int(os.environ.get('EXCEL_CONVERSION_SLOTS') or 2)
+EXCEL_FAST_LANE_SLOTS = int(os.environ.get('EXCEL_FAST_LANE_SLOTS') or 1)
+EXCEL_FAST_LANE_MAX_CELLS = int(os.environ.get('EXCEL_FAST_LANE_MAX_CELLS') or 500_000)
+EXCEL_SCHEDULER_AGING_SECONDS = float(os.environ.get('EXCEL_SCHEDULER_AGING_SECONDS') or 10)
+
+# Conversions are parsed, cleaned and written in EXCEL_WORKER_PROCESSES
+# subprocess workers per process (0 = in the web process itself). A worker
+# is replaced after EXCEL_WORKER_MAX_JOBS conversions, or once its RSS
+# reaches EXCEL_WORKER_MAX_RSS_MB, which returns its fragmented heap to the OS.
+EXCEL_WORKER_PROCESSES = int(os.environ.get('EXCEL_WORKER_PROCESSES') or 2)
+EXCEL_WORKER_MAX_JOBS = int(os.environ.get('EXCEL_WORKER_MAX_JOBS') or 50)
+EXCEL_WORKER_MAX_RSS_MB = int(os.environ.get('EXCEL_WORKER_MAX_RSS_MB') or 1024)
+
+# An .xlsx sheet whose XML is EXCEL_PARALLEL_PARSE_MIN_MB or more is split
+# into row ranges parsed by EXCEL_PARSE_PROCESSES processes (0 or 1 = always
+# parse serially).
+EXCEL_PARSE_PROCESSES = int(os.environ.get('EXCEL_PARSE_PROCESSES') or os.cpu_count() or 1)
+EXCEL_PARALLEL_PARSE_MIN_MB = int(os.environ.get('EXCEL_PARALLEL_PARSE_MIN_MB') or 32)
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
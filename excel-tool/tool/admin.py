@@ -1,5 +1,12 @@
+import os
+
 from django.contrib import admin
-from .models import UploadedFile, ConversionHistory
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+
+from .models import UploadedFile, ConversionHistory, SlowRequestProfile, ConversionProfile
 
 
 @admin.register(UploadedFile)
@@ -10,9 +17,108 @@ class UploadedFileAdmin(admin.ModelAdmin):
     readonly_fields = ['upload_timestamp']
 
 
+class SlowRequestProfileInline(admin.TabularInline):
+    model = SlowRequestProfile
+    fields = ['created', 'path', 'duration', 'profiler']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+    show_change_link = True
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(ConversionHistory)
 class ConversionHistoryAdmin(admin.ModelAdmin):
-    list_display = ['uploaded_file', 'conversion_timestamp', 'rows_processed', 'status']
+    list_display = ['uploaded_file', 'conversion_timestamp', 'rows_processed', 'columns_count', 'status', 'memory_ratio']
+    list_select_related = ['uploaded_file']
     list_filter = ['status', 'conversion_timestamp']
     search_fields = ['uploaded_file__original_filename']
-    readonly_fields = ['conversion_timestamp']
+    readonly_fields = ['conversion_timestamp', 'columns_count', 'delta_base', 'delta_stats', 'memory_stats']
+    inlines = [SlowRequestProfileInline]
+
+    @admin.display(description='Memory / file size')
+    def memory_ratio(self, obj):
+        ratio = (obj.memory_stats or {}).get('ratio')
+        if ratio is None:
+            return '-'
+        if obj.memory_stats.get('flagged'):
+            # Unusually high for its size (EXCEL_MEMORY_RATIO_THRESHOLD)
+            return format_html('<strong style="color: #ba2121">{}x</strong>', ratio)
+        return f'{ratio}x'
+
+
+@admin.register(SlowRequestProfile)
+class SlowRequestProfileAdmin(admin.ModelAdmin):
+    list_display = ['created', 'method', 'path', 'duration', 'status_code', 'profiler', 'top_function', 'download']
+    list_select_related = ['uploaded_file', 'conversion']
+    list_filter = ['path', 'profiler', 'created']
+    search_fields = ['path', 'uploaded_file__original_filename']
+    fields = ['created', 'method', 'path', 'status_code', 'duration', 'profiler', 'uploaded_file', 'conversion',
+              'request_info', 'download', 'top_functions_table']
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:object_id>/download/', self.admin_site.admin_view(self.download_profile),
+                 name='tool_slowrequestprofile_download'),
+        ] + super().get_urls()
+
+    def download_profile(self, request, object_id):
+        """Serve the stored profile file (read from storage, like output downloads)"""
+        profile = get_object_or_404(SlowRequestProfile, pk=object_id)
+        if not self.has_view_permission(request, profile):
+            raise Http404
+        if not profile.profile_file or not profile.profile_file.storage.exists(profile.profile_file.name):
+            raise Http404('Profile file not found')
+        return FileResponse(profile.profile_file.open('rb'), as_attachment=True,
+                            filename=os.path.basename(profile.profile_file.name))
+
+    @admin.display(description='Top function')
+    def top_function(self, obj):
+        if not obj.top_functions:
+            return '-'
+        top = obj.top_functions[0]
+        return f"{top['function']} ({top['self_seconds']:.2f}s)"
+
+    @admin.display(description='Profile')
+    def download(self, obj):
+        if not obj.profile_file:
+            return '-'
+        url = reverse('admin:tool_slowrequestprofile_download', args=[obj.pk])
+        return format_html('<a href="{}">{}</a>', url, os.path.basename(obj.profile_file.name))
+
+    @admin.display(description='Top functions (by self time)')
+    def top_functions_table(self, obj):
+        if not obj.top_functions:
+            return '-'
+        rows = format_html_join(
+            '',
+            '<tr><td>{}</td><td><code>{}</code></td><td>{:.3f}</td><td>{:.3f}</td><td>{}</td></tr>',
+            (
+                (item['function'], item['location'], item['self_seconds'], item['total_seconds'],
+                 item['calls'] if item['calls'] is not None else '-')
+                for item in obj.top_functions
+            ),
+        )
+        return format_html(
+            '<table><thead><tr><th>Function</th><th>Location</th><th>Self (s)</th><th>Total (s)</th>'
+            '<th>Calls</th></tr></thead><tbody>{}</tbody></table>',
+            rows,
+        )
+
+
+@admin.register(ConversionProfile)
+class ConversionProfileAdmin(admin.ModelAdmin):
+    list_display = ['name', 'filename_pattern', 'skip_rows', 'column_count', 'output_format', 'use_count', 'last_used']
+    list_filter = ['output_format']
+    search_fields = ['name', 'filename_pattern']
+    readonly_fields = ['use_count', 'last_used', 'created']
+
+    @admin.display(description='Columns')
+    def column_count(self, obj):
+        return len(obj.columns or [])
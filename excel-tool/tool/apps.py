@@ -1,6 +1,16 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ToolConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tool'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        # Upload spool directory (inside MEDIA_ROOT, see uploadhandlers.py)
+        if settings.FILE_UPLOAD_TEMP_DIR:
+            os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
@@ -0,0 +1,252 @@
+import fnmatch
+import hashlib
+import re
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ConversionProfile
+from .readers import column_position, read_header, read_sheet_columns
+
+
+class ProfileMismatch(ValueError):
+    """The workbook does not have the layout its conversion profile describes"""
+
+
+class ProfileMatch:
+    """A conversion profile matched to an uploaded workbook"""
+
+    def __init__(self, profile, sheets, matched_by):
+        self.profile = profile
+        self.sheets = sheets
+        # 'filename' or 'header'
+        self.matched_by = matched_by
+
+    def as_dict(self):
+        return {'name': self.profile.name, 'matched_by': self.matched_by, 'sheets': self.sheets}
+
+
+def header_fingerprint(names):
+    """Digest identifying a header row (column names from readers.read_header)"""
+    return hashlib.sha1('\x1f'.join(names).encode('utf-8')).hexdigest()
+
+
+def filename_pattern_for(filename):
+    """
+    Glob matching the later versions of a recurring upload: runs of digits
+    (dates, periods, sequence numbers) become wildcards
+    """
+    pattern = re.sub(r'[\[\]?*]', lambda m: f'[{m.group(0)}]', filename)
+    return re.sub(r'\d+', '*', pattern)
+
+
+def _profile_sheets(profile, sheet_names):
+    """Sheets of the workbook the profile converts"""
+    if not profile.sheet_names:
+        return sheet_names[:1]
+    return [name for name in profile.sheet_names if name in sheet_names]
+
+
+class _Headers:
+    """Header rows of one workbook, each read once whatever the number of profiles"""
+
+    def __init__(self, source, book):
+        self.source = source
+        self.book = book
+        self.read = {}
+
+    def get(self, sheet_name, skip_rows):
+        key = (sheet_name, skip_rows)
+        if key not in self.read:
+            self.read[key] = read_header(self.source, sheet_name, skip_rows, book=self.book)
+        return self.read[key]
+
+
+def _layout_problem(profile, sheets, headers):
+    """Why the workbook does not fit the profile, or None when it does"""
+    if not sheets:
+        return f"none of the sheets {', '.join(profile.sheet_names)}"
+    for sheet_name in sheets:
+        names = headers.get(sheet_name, profile.skip_rows)
+        missing = [column for column in profile.columns if column_position(names, column) is None]
+        if missing:
+            return f"sheet {sheet_name} has no column {', '.join(missing)} in row {profile.skip_rows + 1}"
+    return None
+
+
+def match_profile(filename, source, sheet_names, book=None):
+    """
+    Find the conversion profile of an uploaded workbook
+
+    Profiles whose filename pattern matches the upload name are tried first
+    (most specific pattern first), then profiles whose header fingerprint
+    matches the header row at their skip_rows. A candidate is only used when
+    every sheet it converts has all of its columns: only header rows are
+    read, never the data.
+
+    Args:
+        filename: Name of the uploaded file
+        source: Path to the workbook, or the upload held in memory
+        sheet_names: Sheets of the workbook
+        book: Book from readers.open_xls_book (None = open the file)
+
+    Returns:
+        tuple (ProfileMatch or None, list of {'name', 'reason'} for candidates
+        rejected because the workbook's layout changed)
+    """
+    profiles = list(ConversionProfile.objects.all())
+    headers = _Headers(source, book)
+    rejected = []
+
+    by_name = [
+        profile for profile in profiles
+        if profile.filename_pattern and fnmatch.fnmatch(filename.lower(), profile.filename_pattern.lower())
+    ]
+    by_name.sort(key=lambda profile: len(profile.filename_pattern), reverse=True)
+    for profile in by_name:
+        sheets = _profile_sheets(profile, sheet_names)
+        problem = _layout_problem(profile, sheets, headers)
+        if problem is None:
+            return ProfileMatch(profile, sheets, 'filename'), rejected
+        rejected.append({'name': profile.name, 'reason': problem})
+
+    for profile in profiles:
+        if not profile.header_fingerprint or profile in by_name:
+            continue
+        sheets = _profile_sheets(profile, sheet_names)
+        if not sheets or header_fingerprint(headers.get(sheets[0], profile.skip_rows)) != profile.header_fingerprint:
+            continue
+        problem = _layout_problem(profile, sheets, headers)
+        if problem is None:
+            return ProfileMatch(profile, sheets, 'header'), rejected
+        rejected.append({'name': profile.name, 'reason': problem})
+
+    return None, rejected
+
+
+def _typed_values(values, column_type):
+    """Build a column of a known type from raw cell values (no inference)"""
+    import numpy as np
+    import pandas as pd
+
+    from .dtypes import _has_pyarrow
+
+    if column_type == 'integer':
+        return pd.array(values, dtype='Int64')
+    if column_type == 'float':
+        return np.array([np.nan if value is None else value for value in values], dtype='float64')
+    if column_type == 'boolean':
+        return pd.array(values, dtype='boolean')
+    if column_type == 'datetime':
+        return pd.to_datetime(pd.Series(values, dtype=object)).array
+
+    text = [None if value is None else str(value) for value in values]
+    if column_type == 'category':
+        return pd.Categorical(text)
+    return pd.array(text, dtype='string[pyarrow]' if _has_pyarrow() else 'string')
+
+
+def read_with_profile(source, sheet_name, profile, row_filter=None, on_progress=None, book=None):
+    """
+    Read a sheet the way its profile describes: only the profile's columns
+    are kept while streaming, and each is built directly in its saved type
+
+    Unnamed columns are renamed Extra_Info_N, as clean_dataframe does.
+
+    Args:
+        source: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet to read
+        profile: ConversionProfile
+        row_filter: filters.RowFilter (None = keep all rows)
+        on_progress: Called with the number of data rows scanned so far
+        book: Book from readers.open_xls_book (None = open the file)
+
+    Returns:
+        tuple (pandas.DataFrame, dict with 'rows_scanned', 'rows_kept' and
+        'unnamed_columns_renamed')
+
+    Raises:
+        ProfileMismatch: If a column is missing or holds values of another type
+    """
+    import pandas as pd
+
+    try:
+        values, filtering = read_sheet_columns(source, sheet_name, profile.columns, profile.skip_rows, row_filter,
+                                               on_progress=on_progress, book=book)
+    except ValueError as e:
+        raise ProfileMismatch(str(e))
+
+    data = {}
+    renamed = 0
+    for column in profile.columns:
+        column_type = profile.dtypes.get(column, 'text')
+        name = column
+        if 'Unnamed' in column:
+            renamed += 1
+            name = f'Extra_Info_{renamed}'
+        try:
+            data[name] = _typed_values(values.pop(column), column_type)
+        except (ValueError, TypeError) as e:
+            raise ProfileMismatch(f"Column {column} of sheet {sheet_name} is not {column_type}: {e}")
+
+    df = pd.DataFrame(data, copy=False)
+    return df, dict(filtering, unnamed_columns_renamed=renamed)
+
+
+def mark_used(profile):
+    ConversionProfile.objects.filter(pk=profile.pk).update(use_count=F('use_count') + 1, last_used=timezone.now())
+
+
+def column_type(dtype):
+    """Profile type of a converted column's pandas dtype"""
+    from pandas.api import types as ptypes
+
+    if ptypes.is_bool_dtype(dtype):
+        return 'boolean'
+    if ptypes.is_integer_dtype(dtype):
+        return 'integer'
+    if ptypes.is_float_dtype(dtype):
+        return 'float'
+    if ptypes.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    if isinstance(dtype, ptypes.CategoricalDtype):
+        return 'category'
+    return 'text'
+
+
+def save_profile(name, filename, source, sheet_names, skip_rows, source_columns, column_types, output_format,
+                 book=None):
+    """
+    Save (or replace) a conversion profile from a finished conversion, so
+    the next workbook with this layout is converted directly
+
+    Args:
+        name: Profile name
+        filename: Name of the converted upload (its pattern is saved)
+        source: Path to the workbook, or the upload held in memory
+        sheet_names: Sheets that were converted
+        skip_rows: Rows skipped above the header
+        source_columns: Header names of the kept columns (clean_dataframe's
+            'source_columns'), in output order
+        column_types: Types of the converted columns (see column_type), in
+            the same order
+        output_format: Output format name
+        book: Book from readers.open_xls_book (None = open the file)
+
+    Returns:
+        ConversionProfile
+    """
+    names = read_header(source, sheet_names[0], skip_rows, book=book)
+    profile, _ = ConversionProfile.objects.update_or_create(
+        name=name,
+        defaults={
+            'filename_pattern': filename_pattern_for(filename),
+            'header_fingerprint': header_fingerprint(names),
+            'sheet_names': list(sheet_names),
+            'skip_rows': skip_rows,
+            'columns': list(source_columns),
+            'dtypes': dict(zip(source_columns, column_types)),
+            'output_format': output_format,
+        },
+    )
+    return profile
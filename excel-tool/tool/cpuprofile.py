@@ -0,0 +1,181 @@
+import cProfile
+import marshal
+import os
+import pstats
+from contextvars import ContextVar
+
+
+# Functions listed per captured profile
+TOP_FUNCTIONS = 25
+
+_profiler = ContextVar('excel_request_profiler', default=None)
+
+
+def _pyinstrument_profiler(interval):
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        return None
+    # async_mode='disabled': the view runs synchronously in this thread
+    return Profiler(interval=interval, async_mode='disabled')
+
+
+class RequestProfiler:
+    """
+    CPU profile of the calling thread between start() and stop()
+
+    Uses the pyinstrument sampling profiler when installed (`uv sync --extra
+    profiling`), which costs little at its default 1ms interval; otherwise
+    the standard library's cProfile, which traces every call and can slow
+    Python-heavy code (openpyxl cell construction) noticeably.
+
+    Parts of the request run in worker processes are profiled there and
+    added to this profile with add() (see workers.py).
+    """
+
+    def __init__(self, interval=0.001, engine=None):
+        """
+        Args:
+            interval: Sampling interval of pyinstrument, in seconds
+            engine: 'cprofile' to use cProfile even where pyinstrument is
+                installed (None = pyinstrument where installed)
+        """
+        self.interval = interval
+        self.sampler = _pyinstrument_profiler(interval) if engine != 'cprofile' else None
+        self.tracer = None if self.sampler is not None else cProfile.Profile()
+        self.engine = 'pyinstrument' if self.sampler is not None else 'cprofile'
+        self.session = None
+        # Profiles added while this one runs, merged into it once it stops
+        self.added = []
+
+    def start(self):
+        self._token = _profiler.set(self)
+        if self.sampler is not None:
+            self.sampler.start()
+        else:
+            self.tracer.enable()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.session = self.sampler.last_session
+        else:
+            self.tracer.disable()
+            self.tracer.create_stats()
+        _profiler.reset(self._token)
+        for data in self.added:
+            self._merge(data)
+        self.added = []
+
+    def result(self):
+        """
+        The profile in a form another process's RequestProfiler can add()
+
+        Returns:
+            tuple (engine, pyinstrument session JSON or cProfile stats)
+        """
+        if self.sampler is not None:
+            return self.engine, self.session.to_json() if self.session is not None else None
+        return self.engine, self.tracer.stats
+
+    def add(self, result):
+        """Add the profile of part of the request run in another process (its result())"""
+        engine, data = result
+        if engine == self.engine and data is not None:
+            self.added.append(data)
+
+    def _merge(self, data):
+        if self.sampler is not None:
+            from pyinstrument.session import Session
+
+            session = Session.from_json(data)
+            self.session = session if self.session is None else Session.combine(self.session, session)
+            return
+        stats = self.tracer.stats
+        for function, function_stats in data.items():
+            if function in stats:
+                function_stats = pstats.add_func_stats(stats[function], function_stats)
+            stats[function] = function_stats
+
+    def top_functions(self, limit=TOP_FUNCTIONS):
+        """
+        Functions that took the most time, by self time
+
+        Returns:
+            list of dicts with 'function', 'location' (file:line),
+            'self_seconds', 'total_seconds' and 'calls' (None for samples)
+        """
+        if self.sampler is not None:
+            functions = self._sampled_functions()
+        else:
+            functions = self._traced_functions()
+        functions.sort(key=lambda item: item['self_seconds'], reverse=True)
+        for item in functions:
+            item['self_seconds'] = round(item['self_seconds'], 6)
+            item['total_seconds'] = round(item['total_seconds'], 6)
+        return functions[:limit]
+
+    def _sampled_functions(self):
+        session = self.session
+        root = session.root_frame() if session is not None else None
+        if root is None:
+            return []
+
+        functions = {}
+        stack = [(root, frozenset())]
+        while stack:
+            frame, ancestors = stack.pop()
+            if frame.is_synthetic:
+                # Roots grouping the samples of combined sessions, and leaves
+                stack.extend((child, ancestors) for child in frame.children)
+                continue
+            key = (frame.function, frame.file_path_short, frame.line_no)
+            item = functions.setdefault(key, {
+                'function': frame.function,
+                'location': f'{frame.file_path_short}:{frame.line_no}',
+                'self_seconds': 0.0,
+                'total_seconds': 0.0,
+                'calls': None,
+            })
+            item['self_seconds'] += frame.total_self_time
+            # Recursive calls are already counted in the outermost one
+            if key not in ancestors:
+                item['total_seconds'] += frame.time
+            stack.extend((child, ancestors | {key}) for child in frame.children)
+        return list(functions.values())
+
+    def _traced_functions(self):
+        functions = []
+        for (file_name, line, function), (_, calls, self_time, total_time, _) in self.tracer.stats.items():
+            if file_name == '~':
+                location = '<built-in>'
+            else:
+                # Package and module, as pyinstrument shortens paths
+                location = f"{'/'.join(file_name.split(os.sep)[-2:])}:{line}"
+            functions.append({
+                'function': function,
+                'location': location,
+                'self_seconds': self_time,
+                'total_seconds': total_time,
+                'calls': calls,
+            })
+        return functions
+
+    def export(self):
+        """
+        The full profile as a downloadable file
+
+        Returns:
+            tuple (file extension, bytes): a self-contained pyinstrument
+            HTML report, or cProfile stats for pstats or snakeviz (.prof)
+        """
+        if self.sampler is not None:
+            from pyinstrument.renderers import HTMLRenderer
+
+            return '.html', HTMLRenderer().render(self.session).encode('utf-8')
+        return '.prof', marshal.dumps(self.tracer.stats)
+
+
+def current_profiler():
+    """RequestProfiler running in this context (None when the request is not profiled)"""
+    return _profiler.get()
@@ -0,0 +1,300 @@
+import io
+import os
+
+from django.core.files.base import ContentFile
+
+from .workspace import local_copy
+
+
+CHANGE_COLUMN = '_change'
+
+
+def _normalized_column(series):
+    """
+    Column values in a form whose hash does not depend on the dtype the
+    column happened to get (int vs float, category vs string, ...)
+    """
+    import numpy as np
+    from pandas.api import types as ptypes
+
+    if ptypes.is_numeric_dtype(series.dtype) and not ptypes.is_bool_dtype(series.dtype):
+        return series.to_numpy(dtype='float64', na_value=np.nan)
+    if ptypes.is_datetime64_any_dtype(series.dtype):
+        return series.to_numpy(dtype='datetime64[ns]').view('int64')
+    values = series.astype(object)
+    return values.where(values.notna(), '').astype(str).to_numpy(dtype=object)
+
+
+def _hash_frame(df):
+    """64-bit hash of each row of df, combining all of its columns"""
+    import pandas as pd
+
+    normalized = pd.DataFrame({
+        position: _normalized_column(df.iloc[:, position]) for position in range(len(df.columns))
+    })
+    return pd.util.hash_pandas_object(normalized, index=False).to_numpy(dtype='uint64')
+
+
+def _disambiguate(keys):
+    """Make repeated keys unique by mixing in their occurrence number"""
+    import numpy as np
+    import pandas as pd
+
+    occurrence = pd.Series(keys).groupby(keys).cumcount().to_numpy()
+    if not occurrence.any():
+        return keys
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'key': keys, 'occurrence': occurrence}), index=False
+    ).to_numpy(dtype=np.uint64)
+
+
+def row_fingerprints(df, key_columns=None):
+    """
+    Fingerprint the rows of a cleaned DataFrame
+
+    Every row gets a content hash of all its values. Rows are identified by a
+    hash of the key columns when given (so edited rows show up as changed),
+    otherwise by their content hash (so edits show up as removed + added).
+
+    Args:
+        df: Cleaned pandas.DataFrame
+        key_columns: Column names identifying a row (None/empty = whole row)
+
+    Returns:
+        dict with 'keys', 'hashes' (uint64 arrays in row order), 'columns',
+        'key_columns' and 'key_values' (list of string arrays, one per key column)
+
+    Raises:
+        ValueError: If a key column does not exist
+    """
+    key_columns = list(key_columns or [])
+    columns = [str(col) for col in df.columns]
+    missing = [col for col in key_columns if col not in columns]
+    if missing:
+        raise ValueError(f"Key columns not found: {', '.join(missing)}")
+
+    hashes = _hash_frame(df)
+    if key_columns:
+        key_frame = df.iloc[:, [columns.index(col) for col in key_columns]]
+        keys = _disambiguate(_hash_frame(key_frame))
+        key_values = [
+            key_frame.iloc[:, position].astype(object).where(key_frame.iloc[:, position].notna(), '')
+            .astype(str).to_numpy(dtype=str)
+            for position in range(len(key_columns))
+        ]
+    else:
+        keys = _disambiguate(hashes)
+        key_values = []
+
+    return {
+        'keys': keys,
+        'hashes': hashes,
+        'columns': columns,
+        'key_columns': key_columns,
+        'key_values': key_values,
+    }
+
+
+def save_fingerprint_index(fingerprints, output_name):
+    """
+    Store fingerprints as a compressed index, for ConversionHistory.fingerprint_index
+
+    The index keeps keys sorted (for binary search) with each row's position;
+    content hashes are only stored when rows are keyed, since otherwise they
+    are the keys themselves.
+
+    Args:
+        fingerprints: row_fingerprints result
+        output_name: Name of the conversion's output file (the index is named after it)
+
+    Returns:
+        Storage name of the index
+    """
+    import numpy as np
+
+    from .models import ConversionHistory
+
+    keys = fingerprints['keys']
+    order = np.argsort(keys, kind='stable')
+    position_dtype = np.uint32 if len(keys) < 2 ** 32 else np.uint64
+    arrays = {
+        'keys': keys[order],
+        'positions': order.astype(position_dtype),
+        'columns': np.array(fingerprints['columns'], dtype=str),
+        'key_columns': np.array(fingerprints['key_columns'], dtype=str),
+    }
+    if fingerprints['key_columns']:
+        arrays['hashes'] = fingerprints['hashes'][order]
+        for position, values in enumerate(fingerprints['key_values']):
+            arrays[f'key_values_{position}'] = values[order]
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+
+    field = ConversionHistory._meta.get_field('fingerprint_index')
+    base_name = os.path.splitext(os.path.basename(output_name))[0]
+    return field.storage.save(field.generate_filename(None, f'{base_name}.npz'), ContentFile(buffer.getvalue()))
+
+
+def load_fingerprint_index(conversion):
+    """Load the index written by save_fingerprint_index as a dict of arrays"""
+    import numpy as np
+
+    with conversion.fingerprint_index.open('rb') as f:
+        with np.load(f, allow_pickle=False) as archive:
+            index = {name: archive[name] for name in archive.files}
+    if 'hashes' not in index:
+        index['hashes'] = index['keys']
+    return index
+
+
+def find_delta_base(model_class, original_filename, key_columns):
+    """
+    Find the latest successful conversion of the same logical file (same
+    original filename and key columns) that has a fingerprint index
+    """
+    return (
+        model_class.objects
+        .filter(
+            uploaded_file__original_filename=original_filename,
+            status='success',
+            key_columns=list(key_columns or []),
+        )
+        .exclude(fingerprint_index='')
+        .order_by('-conversion_timestamp', '-id')
+        .first()
+    )
+
+
+def delta_base_ids(model_class):
+    """
+    Ids of the conversions find_delta_base currently returns, one per
+    logical file (kept out of cleanup so the next version can be diffed)
+    """
+    conversions = (
+        model_class.objects
+        .filter(status='success')
+        .exclude(fingerprint_index='')
+        .order_by('-conversion_timestamp', '-id')
+        .values_list('id', 'uploaded_file__original_filename', 'key_columns')
+    )
+    latest = {}
+    for conversion_id, original_filename, key_columns in conversions:
+        latest.setdefault((original_filename, tuple(key_columns or [])), conversion_id)
+    return list(latest.values())
+
+
+def _read_output_rows(path, output_format, positions):
+    """Read the rows at the given positions from a full output file"""
+    import pandas as pd
+
+    if output_format == 'csv':
+        wanted = set(int(position) + 1 for position in positions)
+        df = pd.read_csv(
+            path, encoding='utf-8-sig', dtype=str, keep_default_na=False,
+            skiprows=lambda line: line != 0 and line not in wanted,
+        )
+        return df
+    if output_format == 'ndjson':
+        df = pd.read_json(path, lines=True)
+    elif output_format == 'parquet':
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_feather(path)
+    return df.iloc[sorted(int(position) for position in positions)].reset_index(drop=True)
+
+
+def _removed_rows(base, index, removed, columns):
+    """Values of the removed rows, from the base's output when it holds all rows"""
+    import numpy as np
+    import pandas as pd
+
+    positions = index['positions'][removed]
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+
+    rows = None
+    if base.delta_stats is None and base.output_csv_path:
+        try:
+            with local_copy(base.output_csv_path.name, base.output_csv_path.storage) as path:
+                rows = _read_output_rows(path, base.output_format, positions)
+            if len(rows) != len(positions):
+                rows = None
+        except Exception as e:
+            print(f"Error reading previous output {base.output_csv_path.name}: {e}")
+            rows = None
+
+    if rows is None:
+        # Fall back to the key values kept in the index
+        rows = pd.DataFrame(index=range(len(positions)))
+        for position, column in enumerate(index['key_columns']):
+            rows[str(column)] = index[f'key_values_{position}'][removed][order]
+
+    rows.columns = [str(col) for col in rows.columns]
+    return rows.reindex(columns=columns)
+
+
+def build_delta(df, fingerprints, base=None):
+    """
+    Compare a conversion's rows against a previous conversion of the same file
+
+    Args:
+        df: Cleaned pandas.DataFrame of the new version
+        fingerprints: row_fingerprints(df, ...) result
+        base: ConversionHistory to compare against (None = everything is added)
+
+    Returns:
+        tuple (delta DataFrame with a leading '_change' column holding
+        'added', 'changed' or 'removed', dict with 'rows_added',
+        'rows_changed', 'rows_removed', 'rows_unchanged', 'columns_changed'
+        and 'base_conversion_id')
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = [str(col) for col in df.columns]
+    keys = fingerprints['keys']
+    hashes = fingerprints['hashes']
+
+    if base is not None:
+        index = load_fingerprint_index(base)
+        old_keys = index['keys']
+    else:
+        index = None
+        old_keys = np.empty(0, dtype=np.uint64)
+
+    if len(old_keys):
+        slots = np.searchsorted(old_keys, keys)
+        slots = np.minimum(slots, len(old_keys) - 1)
+        found = old_keys[slots] == keys
+        changed = found & (index['hashes'][slots] != hashes)
+        removed = ~np.isin(old_keys, keys, assume_unique=True)
+    else:
+        found = np.zeros(len(keys), dtype=bool)
+        changed = found
+        removed = np.zeros(0, dtype=bool)
+
+    added = ~found
+    kept = added | changed
+
+    new_rows = df[kept].copy()
+    new_rows.columns = columns
+    new_rows.insert(0, CHANGE_COLUMN, np.where(added[kept], 'added', 'changed'))
+    parts = [new_rows]
+
+    if removed.any():
+        removed_rows = _removed_rows(base, index, removed, columns)
+        removed_rows.insert(0, CHANGE_COLUMN, 'removed')
+        parts.append(removed_rows)
+
+    delta = pd.concat(parts, ignore_index=True) if len(parts) > 1 else new_rows.reset_index(drop=True)
+
+    stats = {
+        'rows_added': int(added.sum()),
+        'rows_changed': int(changed.sum()),
+        'rows_removed': int(removed.sum()),
+        'rows_unchanged': int(found.sum() - changed.sum()),
+        'columns_changed': index is not None and list(index['columns']) != columns,
+        'base_conversion_id': base.id if base is not None else None,
+    }
+    return delta, stats
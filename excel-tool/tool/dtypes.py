@@ -0,0 +1,66 @@
+# Text columns with at most this share of distinct values become categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def optimize_dtypes(df, category_max_unique_ratio=CATEGORY_MAX_UNIQUE_RATIO):
+    """
+    Convert columns to compact dtypes without changing their CSV output
+
+    - integer columns are downcast to the smallest integer type
+    - low-cardinality text columns (codes, flags, labels) become categoricals
+    - other text columns become Arrow-backed strings when pyarrow is installed
+
+    Float columns are left alone: downcasting them would change how values
+    are written to CSV.
+
+    Args:
+        df: pandas.DataFrame
+        category_max_unique_ratio: Max distinct/non-null ratio for categoricals
+
+    Returns:
+        tuple (optimized DataFrame, dict with 'memory_before', 'memory_after'
+        and the new dtype of each converted column)
+    """
+    import pandas as pd
+    from pandas.api import types as ptypes
+
+    memory_before = int(df.memory_usage(index=False, deep=True).sum())
+    arrow_strings = _has_pyarrow()
+    converted = {}
+
+    df = df.copy()
+    for position, column in enumerate(df.columns):
+        series = df.iloc[:, position]
+
+        if ptypes.is_integer_dtype(series.dtype) and not ptypes.is_bool_dtype(series.dtype):
+            optimized = pd.to_numeric(series, downcast='integer')
+        elif ptypes.is_object_dtype(series.dtype) or ptypes.is_string_dtype(series.dtype):
+            non_null = series.dropna()
+            if non_null.empty or pd.api.types.infer_dtype(non_null, skipna=True) != 'string':
+                continue
+            if non_null.nunique() <= category_max_unique_ratio * len(non_null):
+                optimized = series.astype('category')
+            elif arrow_strings and ptypes.is_object_dtype(series.dtype):
+                optimized = series.astype('string[pyarrow]')
+            else:
+                continue
+        else:
+            continue
+
+        if optimized.dtype != series.dtype:
+            df.isetitem(position, optimized)
+            converted[str(column)] = str(optimized.dtype)
+
+    return df, {
+        'memory_before': memory_before,
+        'memory_after': int(df.memory_usage(index=False, deep=True).sum()),
+        'optimized_columns': converted,
+    }
@@ -0,0 +1,349 @@
+import datetime
+import os
+
+from .memory import stage
+from .tracing import span
+
+
+# compressed: the file is already compressed (stored as is in ZIP downloads)
+OUTPUT_FORMATS = {
+    'csv': {'label': 'CSV', 'extension': '.csv', 'content_type': 'text/csv', 'compressed': False},
+    'parquet': {'label': 'Parquet', 'extension': '.parquet', 'content_type': 'application/vnd.apache.parquet',
+                'compressed': True},
+    'feather': {'label': 'Arrow IPC / Feather', 'extension': '.arrow',
+                'content_type': 'application/vnd.apache.arrow.file', 'compressed': True},
+    'ndjson': {'label': 'JSON Lines', 'extension': '.jsonl', 'content_type': 'application/x-ndjson',
+               'compressed': False},
+    'xlsx': {'label': 'Excel (.xlsx)', 'extension': '.xlsx',
+             'content_type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'compressed': True},
+}
+
+OUTPUT_FORMAT_CHOICES = [(name, spec['label']) for name, spec in OUTPUT_FORMATS.items()]
+
+# Rows written per chunk (and per Parquet row group / Arrow record batch)
+DEFAULT_CHUNK_ROWS = 50_000
+
+PARQUET_COMPRESSION = 'zstd'
+ARROW_COMPRESSION = 'zstd'
+
+# Size limits of an Excel worksheet
+XLSX_MAX_ROWS = 1_048_576
+XLSX_MAX_COLUMNS = 16_384
+
+
+def get_output_format(output_format):
+    """
+    Validate an output format name
+
+    Args:
+        output_format: Format name from the request (None = 'csv')
+
+    Returns:
+        Normalized format name
+
+    Raises:
+        ValueError: If the format is not supported
+    """
+    output_format = (output_format or 'csv').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    return output_format
+
+
+def output_extension(output_format):
+    return OUTPUT_FORMATS[output_format]['extension']
+
+
+def output_is_compressed(output_format):
+    return OUTPUT_FORMATS[output_format]['compressed']
+
+
+def content_type_for(filename):
+    """Guess the response content type of an output file from its extension"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.zip':
+        return 'application/zip'
+    for spec in OUTPUT_FORMATS.values():
+        if spec['extension'] == extension:
+            return spec['content_type']
+    return 'application/octet-stream'
+
+
+def _import_pyarrow(output_format):
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ValueError(f"{OUTPUT_FORMATS[output_format]['label']} output requires pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def to_arrow_compatible(df):
+    """
+    Prepare a DataFrame for Arrow: string column names, and mixed-type object
+    columns (e.g. numbers and text in one column) converted to strings
+    """
+    from pandas.api import types as ptypes
+    
+    df = df.copy(deep=False)
+    df.columns = [str(col) for col in df.columns]
+    for position in range(len(df.columns)):
+        series = df.iloc[:, position]
+        if ptypes.is_object_dtype(series.dtype):
+            inferred = ptypes.infer_dtype(series, skipna=True)
+            if inferred not in ('string', 'empty', 'integer', 'floating', 'boolean', 'datetime', 'date'):
+                df.isetitem(position, series.where(series.isna(), series.astype(str)))
+    return df
+
+
+class CsvWriter:
+    """Write chunks to a UTF-8 (BOM) CSV file, byte-identical to df.to_csv"""
+
+    def __init__(self, output_path):
+        self.file = open(output_path, 'w', encoding='utf-8-sig', newline='')
+        self.header_written = False
+
+    def write(self, chunk):
+        chunk.to_csv(self.file, index=False, header=not self.header_written)
+        self.header_written = True
+
+    def close(self):
+        self.file.close()
+
+
+class NdjsonWriter:
+    """Write chunks as JSON Lines (one record per line)"""
+
+    def __init__(self, output_path):
+        self.file = open(output_path, 'w', encoding='utf-8', newline='\n')
+
+    def write(self, chunk):
+        if chunk.empty:
+            return
+        chunk = chunk.copy(deep=False)
+        chunk.columns = [str(col) for col in chunk.columns]
+        text = chunk.to_json(orient='records', lines=True, force_ascii=False, date_format='iso')
+        self.file.write(text if text.endswith('\n') else text + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    """Write chunks as Parquet row groups or Arrow IPC record batches"""
+
+    def __init__(self, output_path, output_format, schema=None):
+        self.pa = _import_pyarrow(output_format)
+        self.output_path = output_path
+        self.output_format = output_format
+        self.schema = schema
+        self.writer = None
+
+    def _open(self, schema):
+        pa = self.pa
+        if self.output_format == 'parquet':
+            return pa.parquet.ParquetWriter(self.output_path, schema, compression=PARQUET_COMPRESSION)
+        options = pa.ipc.IpcWriteOptions(compression=ARROW_COMPRESSION)
+        return pa.ipc.new_file(self.output_path, schema, options=options)
+
+    def _conform(self, chunk):
+        """
+        Convert the object columns the schema types as strings to text: a
+        column that mixes numbers and text is text in the schema, whatever
+        values one chunk of it holds
+        """
+        from pandas.api import types as ptypes
+
+        pa = self.pa
+        chunk = chunk.copy(deep=False)
+        chunk.columns = [str(col) for col in chunk.columns]
+        for position, field in enumerate(self.schema):
+            if not (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+                continue
+            series = chunk.iloc[:, position]
+            if not ptypes.is_object_dtype(series.dtype):
+                continue
+            if ptypes.infer_dtype(series, skipna=True) not in ('string', 'empty'):
+                chunk.isetitem(position, series.where(series.isna(), series.astype(str)))
+        return chunk
+
+    def write(self, chunk):
+        if self.schema is None:
+            chunk = to_arrow_compatible(chunk)
+            self.schema = self.pa.Schema.from_pandas(chunk, preserve_index=False)
+        else:
+            chunk = self._conform(chunk)
+        table = self.pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.writer = self._open(self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None and self.schema is not None:
+            self.writer = self._open(self.schema)
+        if self.writer is not None:
+            self.writer.close()
+
+
+def excel_sheet_title(name):
+    """A valid worksheet title for a sheet name (no []:*?/\\, at most 31 characters)"""
+    title = ''.join(c for c in str(name) if c not in '[]:*?/\\').strip("'")[:31]
+    return title or 'Sheet1'
+
+
+class XlsxWriter:
+    """
+    Write chunks to an .xlsx worksheet with openpyxl's write-only mode
+
+    Rows are streamed to the worksheet XML as they are appended and text is
+    written as inline strings, so memory stays bounded whatever the number
+    of rows. Values keep their dtype: numbers, booleans and dates become
+    Excel numbers, booleans and dates; text (including codes with leading
+    zeros) stays text, even when it looks like a formula.
+    """
+
+    def __init__(self, output_path, sheet_name=None):
+        from openpyxl import Workbook
+
+        self.output_path = output_path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(excel_sheet_title(sheet_name or 'Sheet1'))
+        self.rows = 0
+        # The workbook is only written on close; progress sees an empty file
+        open(output_path, 'wb').close()
+
+    def write(self, chunk):
+        if self.rows == 0:
+            if len(chunk.columns) > XLSX_MAX_COLUMNS:
+                raise ValueError(f"Excel sheets hold at most {XLSX_MAX_COLUMNS:,} columns")
+            self.sheet.append([self._text(str(col)) for col in chunk.columns])
+            self.rows = 1
+        if self.rows + len(chunk) > XLSX_MAX_ROWS:
+            raise ValueError(f"Excel sheets hold at most {XLSX_MAX_ROWS - 1:,} data rows; choose CSV or Parquet")
+
+        columns = [self._values(chunk.iloc[:, position]) for position in range(len(chunk.columns))]
+        for row in zip(*columns):
+            self.sheet.append(row)
+        self.rows += len(chunk)
+
+    def _values(self, series):
+        """Cell values of a column: Python scalars, None for missing values"""
+        import numpy as np
+        from pandas.api import types as ptypes
+
+        dtype = series.dtype
+        if ptypes.is_datetime64_any_dtype(dtype) and getattr(dtype, 'tz', None) is not None:
+            # Excel has no time zones
+            series = series.dt.tz_localize(None)
+        values = series.astype(object).where(series.notna(), None).tolist()
+
+        if ptypes.is_bool_dtype(dtype) or ptypes.is_integer_dtype(dtype) or ptypes.is_datetime64_any_dtype(dtype):
+            return values
+        if ptypes.is_float_dtype(dtype):
+            if np.isinf(series.to_numpy(dtype='float64', na_value=np.nan)).any():
+                values = [str(value) if value is not None and not np.isfinite(value) else value for value in values]
+            return values
+        return [self._value(value) for value in values]
+
+    def _value(self, value):
+        import numpy as np
+
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or isinstance(value, (bool, int, float, datetime.datetime, datetime.date, datetime.time,
+                                               datetime.timedelta)):
+            return value
+        return self._text(value if isinstance(value, str) else str(value))
+
+    def _text(self, value):
+        """A text value, kept as text when Excel would read it as a formula or error"""
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.cell.cell import ERROR_CODES, ILLEGAL_CHARACTERS_RE
+
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            value = ILLEGAL_CHARACTERS_RE.sub('', value)
+        if value.startswith('=') or value in ERROR_CODES:
+            cell = WriteOnlyCell(self.sheet, value=value)
+            cell.data_type = 's'
+            return cell
+        return value
+
+    def close(self):
+        self.workbook.save(self.output_path)
+
+
+def open_writer(output_path, output_format='csv', schema=None, sheet_name=None):
+    """
+    Open a chunked writer for an output format
+
+    Args:
+        output_path: Destination file path
+        output_format: One of OUTPUT_FORMATS
+        schema: Optional pyarrow.Schema for columnar formats (inferred from
+            the first chunk otherwise)
+        sheet_name: Worksheet title of .xlsx output
+
+    Returns:
+        Writer with write(chunk) and close() methods
+    """
+    output_format = get_output_format(output_format)
+    if output_format == 'csv':
+        return CsvWriter(output_path)
+    if output_format == 'ndjson':
+        return NdjsonWriter(output_path)
+    if output_format == 'xlsx':
+        return XlsxWriter(output_path, sheet_name=sheet_name)
+    return ArrowWriter(output_path, output_format, schema=schema)
+
+
+def arrow_schema(df, output_format):
+    """Infer the Arrow schema of a whole DataFrame, so every chunk shares it"""
+    pa = _import_pyarrow(output_format)
+    return pa.Schema.from_pandas(to_arrow_compatible(df.head(0) if df.empty else df), preserve_index=False)
+
+
+def write_dataframe(df, output_path, output_format='csv', chunk_rows=DEFAULT_CHUNK_ROWS, on_chunk=None,
+                    profile=None, sheet_name=None):
+    """
+    Write a DataFrame in bounded row chunks
+
+    Args:
+        df: pandas.DataFrame
+        output_path: Destination file path
+        output_format: One of OUTPUT_FORMATS
+        chunk_rows: Rows per chunk / row group
+        on_chunk: Called with (rows written, bytes on disk) after each chunk;
+            exceptions it raises (e.g. cancellation) stop the write
+        profile: Optional profiling.TableProfile fed with each written chunk
+        sheet_name: Worksheet title of .xlsx output
+
+    Returns:
+        dict with 'rows_written' and 'bytes_written'
+    """
+    output_format = get_output_format(output_format)
+    with stage('write'), span('write', format=output_format, rows=len(df), columns=len(df.columns)) as s:
+        schema = arrow_schema(df, output_format) if output_format in ('parquet', 'feather') else None
+
+        writer = open_writer(output_path, output_format, schema=schema, sheet_name=sheet_name)
+        try:
+            if df.empty:
+                writer.write(df)
+                if profile is not None:
+                    profile.update(df)
+            for start in range(0, len(df), chunk_rows):
+                chunk = df.iloc[start:start + chunk_rows]
+                writer.write(chunk)
+                if profile is not None:
+                    profile.update(chunk)
+                if on_chunk is not None:
+                    on_chunk(min(start + chunk_rows, len(df)), os.path.getsize(output_path))
+        finally:
+            writer.close()
+        bytes_written = os.path.getsize(output_path)
+        s.set(bytes=bytes_written)
+
+    return {
+        'rows_written': len(df),
+        'bytes_written': bytes_written,
+    }
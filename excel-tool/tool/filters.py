@@ -0,0 +1,354 @@
+import datetime
+import functools
+import operator
+import re
+
+
+# Filter syntax:
+#   expression := term (OR term)*
+#   term       := factor (AND factor)*
+#   factor     := '(' expression ')' | column op value | column IN (value, ...)
+#   op         := = == != <> > >= < <= contains startswith endswith
+#
+# Columns are header names as they appear in the sheet (quote them with "..."
+# or `...` when they contain spaces or operators); values are numbers, dates
+# (YYYY-MM-DD) or text, quoted with '...' or "..." when needed.
+# Example: 支店コード = 101 AND (日付 >= 2024-01-01 OR 状態 in (OK, 保留))
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<lparen>\() |
+        (?P<rparen>\)) |
+        (?P<comma>,) |
+        (?P<op>==|!=|<>|>=|<=|=|>|<) |
+        (?P<quoted>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`) |
+        (?P<word>[^\s()=!<>,"'`]+)
+    )''', re.VERBOSE)
+
+WORD_OPERATORS = {'contains', 'startswith', 'endswith', 'in'}
+
+COMPARISONS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Invalid filter near: {text[position:position + 20]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'quoted':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1]) if value[0] != '`' else value[1:-1]
+        elif kind == 'word' and value.lower() in ('and', '&&'):
+            kind = 'and'
+        elif kind == 'word' and value.lower() in ('or', '||'):
+            kind = 'or'
+        elif kind == 'word' and value.lower() in WORD_OPERATORS:
+            kind, value = 'op', value.lower()
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, *kinds):
+        if self.peek() not in kinds:
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else 'end of filter'
+            raise ValueError(f"Invalid filter: expected {' or '.join(kinds)}, found {found!r}")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        node = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f"Invalid filter: unexpected {self.tokens[self.position][1]!r}")
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.peek() == 'or':
+            self.take('or')
+            node = ('or', node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek() == 'and':
+            self.take('and')
+            node = ('and', node, self.factor())
+        return node
+
+    def factor(self):
+        if self.peek() == 'lparen':
+            self.take('lparen')
+            node = self.expression()
+            self.take('rparen')
+            return node
+
+        column = self.take('word', 'quoted')
+        op = self.take('op')
+        if op == 'in':
+            self.take('lparen')
+            values = [self.take('word', 'quoted')]
+            while self.peek() == 'comma':
+                self.take('comma')
+                values.append(self.take('word', 'quoted'))
+            self.take('rparen')
+            return ('cmp', column, op, values)
+        return ('cmp', column, op, self.take('word', 'quoted'))
+
+
+def _to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().replace(',', ''))
+    except ValueError:
+        return None
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    try:
+        return datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _na_strings():
+    """Text cells the pandas parser reads as missing values ('', 'NA', 'n/a', '#N/A', 'NULL', ...)"""
+    from pandas._libs.parsers import STR_NA_VALUES
+
+    return frozenset(STR_NA_VALUES) | {''}
+
+
+def _is_missing(value):
+    """
+    Whether a streamed cell is a missing value in the converted output, so
+    streamed and vectorized filters treat it the same way
+    """
+    if value is None:
+        return True
+    if isinstance(value, float) and value != value:
+        return True
+    return isinstance(value, str) and value in _na_strings()
+
+
+def _compare_value(cell, op, value):
+    """Evaluate one comparison on a single Python cell value"""
+    if _is_missing(cell):
+        return False
+
+    if op == 'in':
+        return any(_compare_value(cell, '=', v) for v in value)
+    if op == 'contains':
+        return value in str(cell)
+    if op == 'startswith':
+        return str(cell).startswith(value)
+    if op == 'endswith':
+        return str(cell).endswith(value)
+
+    compare = COMPARISONS[op]
+    if isinstance(cell, (datetime.date, datetime.datetime)):
+        target = _to_datetime(value)
+        if target is not None:
+            return compare(_to_datetime(cell), target)
+
+    number = _to_number(value)
+    cell_number = _to_number(cell)
+    if number is not None and cell_number is not None:
+        return compare(cell_number, number)
+
+    return compare(str(cell), value)
+
+
+def _format_cells(series):
+    """String form of cells, matching str() of the values the reader produces"""
+    def text(value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    return series.astype(object).map(text)
+
+
+def _series_mask(series, op, value):
+    """Evaluate one comparison on a whole column, returning a NumPy bool array"""
+    import numpy as np
+    import pandas as pd
+    from pandas.api import types as ptypes
+
+    present = series.notna().to_numpy()
+    if series.dtype == object:
+        # Not in place: pandas may return a read-only view of its data
+        present = present & (series != '').to_numpy()
+
+    if op == 'in':
+        mask = np.zeros(len(series), dtype=bool)
+        for v in value:
+            mask |= _series_mask(series, '=', v)
+        return mask
+
+    if op in ('contains', 'startswith', 'endswith'):
+        text = _format_cells(series)
+        if op == 'contains':
+            result = text.str.contains(value, regex=False)
+        elif op == 'startswith':
+            result = text.str.startswith(value)
+        else:
+            result = text.str.endswith(value)
+        return result.fillna(False).to_numpy(dtype=bool) & present
+
+    compare = COMPARISONS[op]
+
+    if ptypes.is_datetime64_any_dtype(series.dtype):
+        target = _to_datetime(value)
+        if target is not None:
+            return compare(series, pd.Timestamp(target)).fillna(False).to_numpy(dtype=bool) & present
+
+    number = _to_number(value)
+    if number is not None:
+        if ptypes.is_numeric_dtype(series.dtype) and not ptypes.is_bool_dtype(series.dtype):
+            values = series.to_numpy(dtype=float, na_value=np.nan)
+            with np.errstate(invalid='ignore'):
+                return compare(values, number) & present
+        numbers = pd.to_numeric(series.astype(object), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        numeric = ~np.isnan(numbers)
+        with np.errstate(invalid='ignore'):
+            result = np.where(numeric, compare(numbers, number), False)
+        if numeric.all():
+            return result & present
+        text_result = compare(_format_cells(series).to_numpy(dtype=object), value)
+        return np.where(numeric, result, text_result).astype(bool) & present
+
+    return compare(_format_cells(series).to_numpy(dtype=object), value).astype(bool) & present
+
+
+class RowFilter:
+    """
+    A parsed row predicate that can be evaluated on streamed rows or on a
+    DataFrame already in memory
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(_tokenize(text)).parse()
+
+    def columns(self, node=None):
+        """Column names referenced by the filter"""
+        node = node or self.tree
+        if node[0] == 'cmp':
+            return {node[1]}
+        return self.columns(node[1]) | self.columns(node[2])
+
+    def _resolve(self, names):
+        lookup = {}
+        for index, name in enumerate(names):
+            lookup.setdefault(str(name), index)
+        missing = [column for column in self.columns() if column not in lookup]
+        if missing:
+            raise ValueError(f"Filter columns not found: {', '.join(sorted(missing))}")
+        return lookup
+
+    def bind(self, names):
+        """
+        Compile the filter against a header row for row-by-row evaluation
+
+        Args:
+            names: Column names in sheet order
+
+        Returns:
+            Function taking a row (sequence of cell values) and returning bool
+        """
+        lookup = self._resolve(names)
+
+        def build(node):
+            if node[0] == 'and':
+                left, right = build(node[1]), build(node[2])
+                return lambda row: left(row) and right(row)
+            if node[0] == 'or':
+                left, right = build(node[1]), build(node[2])
+                return lambda row: left(row) or right(row)
+            _, column, op, value = node
+            index = lookup[column]
+            return lambda row: index < len(row) and _compare_value(row[index], op, value)
+
+        return build(self.tree)
+
+    def mask(self, df):
+        """
+        Evaluate the filter on a whole DataFrame with vectorized NumPy masks
+
+        Args:
+            df: pandas.DataFrame
+
+        Returns:
+            numpy bool array, True for rows to keep
+        """
+        lookup = self._resolve(df.columns)
+
+        def evaluate(node):
+            if node[0] == 'and':
+                return evaluate(node[1]) & evaluate(node[2])
+            if node[0] == 'or':
+                return evaluate(node[1]) | evaluate(node[2])
+            _, column, op, value = node
+            return _series_mask(df.iloc[:, lookup[column]], op, value)
+
+        return evaluate(self.tree)
+
+
+def parse_row_filter(text):
+    """
+    Parse a row filter expression
+
+    Args:
+        text: Filter expression (None or blank = no filter)
+
+    Returns:
+        RowFilter, or None when no filter was given
+
+    Raises:
+        ValueError: If the expression is invalid
+    """
+    if not text or not str(text).strip():
+        return None
+    return RowFilter(str(text))
+
+
+def apply_row_filter(df, row_filter):
+    """
+    Keep only the rows of an in-memory DataFrame matching the filter
+
+    Returns:
+        tuple (filtered DataFrame, dict with 'rows_scanned' and 'rows_kept')
+    """
+    rows_scanned = len(df)
+    df = df[row_filter.mask(df)]
+    return df, {'rows_scanned': rows_scanned, 'rows_kept': len(df)}
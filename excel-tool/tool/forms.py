@@ -1,5 +1,6 @@
 from django import forms
 from .models import UploadedFile
+from .exporters import OUTPUT_FORMAT_CHOICES
 
 
 class ExcelUploadForm(forms.ModelForm):
@@ -17,6 +18,43 @@ class ExcelUploadForm(forms.ModelForm):
         })
     )
     
+    auto_detect_header = forms.BooleanField(
+        required=False,
+        initial=False,
+        help_text='Detect the header row automatically instead of using skip_rows',
+    )
+    
+    output_format = forms.ChoiceField(
+        required=False,
+        initial='csv',
+        choices=OUTPUT_FORMAT_CHOICES,
+        help_text='Output file format',
+    )
+    
+    row_filter = forms.CharField(
+        required=False,
+        max_length=1000,
+        help_text='Keep only rows matching this filter (e.g. Status = OK AND Amount >= 100)',
+    )
+    
+    save_profile = forms.CharField(
+        required=False,
+        max_length=100,
+        help_text='Save the settings of this conversion as a profile with this name, for workbooks with the same layout',
+    )
+    
+    ignore_profiles = forms.BooleanField(
+        required=False,
+        initial=False,
+        help_text='Convert normally even when a saved conversion profile matches the workbook',
+    )
+    
+    job_id = forms.CharField(
+        required=False,
+        max_length=64,
+        help_text='Client-generated id for following progress and cancelling the conversion',
+    )
+    
     class Meta:
         model = UploadedFile
         fields = ['file_path']
@@ -0,0 +1,202 @@
+import datetime
+import hashlib
+import os
+
+from django.core.cache import cache
+
+from .readers import iter_sheet_rows, file_signature, is_file_object
+
+
+# Number of rows streamed from the top of each sheet
+SAMPLE_ROWS = 200
+
+# Highest skip_rows value the upload form accepts
+MAX_SKIP_ROWS = 100
+
+# Rows below a candidate header that are inspected when scoring it
+LOOKAHEAD_ROWS = 20
+
+SAMPLE_CACHE_TIMEOUT = 60 * 60
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _cell_kind(value):
+    """Classify a cell as 'empty', 'text', 'number', 'date' or 'other'"""
+    if _is_empty(value):
+        return 'empty'
+    if isinstance(value, bool):
+        return 'other'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, (datetime.date, datetime.time)):
+        return 'date'
+    if isinstance(value, str):
+        try:
+            float(value.strip().replace(',', ''))
+            return 'number'
+        except ValueError:
+            return 'text'
+    return 'other'
+
+
+def _sample_cache_key(file_path, sheet_name, sample_rows):
+    if is_file_object(file_path):
+        # In-memory uploads are identified by the digest computed on upload
+        content_hash = getattr(file_path, 'content_hash', None)
+        if not content_hash:
+            return None
+        raw = f"sha256:{content_hash}|{sheet_name}|{sample_rows}"
+    else:
+        size, mtime = file_signature(file_path)
+        raw = f"{os.path.abspath(file_path)}|{size}|{mtime}|{sheet_name}|{sample_rows}"
+    return 'header_sample:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def read_sheet_sample(file_path, sheet_name, sample_rows=SAMPLE_ROWS):
+    """
+    Read the first rows of a sheet in streaming mode, using the cache when possible
+
+    The sample is cached per file contents and sheet, so trying a different
+    skip_rows value (or re-running detection) never re-parses the workbook.
+
+    Args:
+        file_path: Path to Excel file, or an uploaded file held in memory
+        sheet_name: Name of the sheet to sample
+        sample_rows: Number of rows to read from the top of the sheet
+
+    Returns:
+        list of rows, each a list of raw cell values
+    """
+    key = _sample_cache_key(file_path, sheet_name, sample_rows)
+    sample = cache.get(key) if key else None
+    if sample is None:
+        sample = [list(row) for row in iter_sheet_rows(file_path, sheet_name, max_rows=sample_rows)]
+        if key:
+            cache.set(key, sample, SAMPLE_CACHE_TIMEOUT)
+    return sample
+
+
+def _score_header_row(sample, index, table_width):
+    """Score how likely sample[index] is the header row of the table below it"""
+    row = sample[index]
+    kinds = [_cell_kind(value) for value in row]
+    filled = [i for i, kind in enumerate(kinds) if kind != 'empty']
+    if len(filled) < 2 and table_width > 1:
+        return 0.0
+
+    # Header rows are wide, mostly text and have distinct labels
+    density = len(filled) / table_width
+    text_ratio = sum(1 for i in filled if kinds[i] == 'text') / len(filled)
+    labels = [str(row[i]).strip() for i in filled]
+    uniqueness = len(set(labels)) / len(labels)
+
+    below = [r for r in sample[index + 1:index + 1 + LOOKAHEAD_ROWS] if any(not _is_empty(v) for v in r)]
+    if not below:
+        return 0.0
+
+    # The rows below should populate the header's columns...
+    filled_below = 0
+    # ...and text labels usually sit on top of numbers or dates
+    type_changes = 0
+    text_columns = 0
+    for i in filled:
+        column_kinds = [_cell_kind(r[i]) if i < len(r) else 'empty' for r in below]
+        non_empty = [kind for kind in column_kinds if kind != 'empty']
+        if non_empty:
+            filled_below += 1
+        if kinds[i] == 'text':
+            text_columns += 1
+            if non_empty and sum(1 for kind in non_empty if kind != 'text') / len(non_empty) >= 0.5:
+                type_changes += 1
+
+    fill_ratio = filled_below / len(filled)
+    type_change_ratio = type_changes / text_columns if text_columns else 0.0
+
+    return 2.0 * density + 2.0 * text_ratio + uniqueness + fill_ratio + type_change_ratio
+
+
+def detect_header_row(sample):
+    """
+    Suggest the skip_rows value for a sheet from a sample of its first rows
+
+    Args:
+        sample: list of rows as returned by read_sheet_sample
+
+    Returns:
+        dict with suggested 'skip_rows' and a 0-1 'confidence'
+    """
+    if not sample:
+        return {'skip_rows': 0, 'confidence': 0.0}
+
+    table_width = max(
+        (sum(1 for value in row if not _is_empty(value)) for row in sample),
+        default=0,
+    )
+    if table_width == 0:
+        return {'skip_rows': 0, 'confidence': 0.0}
+
+    best_index, best_score = 0, 0.0
+    for index in range(min(len(sample), MAX_SKIP_ROWS + 1)):
+        score = _score_header_row(sample, index, table_width)
+        # Strictly greater: on ties the earliest row wins, since a header is
+        # always above the data rows that look like it
+        if score > best_score:
+            best_index, best_score = index, score
+
+    return {
+        'skip_rows': best_index,
+        'confidence': round(best_score / 7.0, 2),
+    }
+
+
+def suggest_skip_rows(file_path, sheet_names):
+    """
+    Detect the header row of every sheet from cached top-of-sheet samples
+
+    Args:
+        file_path: Path to Excel file
+        sheet_names: Sheets to inspect
+
+    Returns:
+        dict mapping sheet name to detect_header_row() result
+    """
+    suggestions = {}
+    for sheet_name in sheet_names:
+        try:
+            suggestions[sheet_name] = detect_header_row(read_sheet_sample(file_path, sheet_name))
+        except Exception as e:
+            print(f"Error detecting header for sheet {sheet_name}: {e}")
+    return suggestions
+
+
+def preview_from_sample(file_path, sheet_name, skip_rows, max_rows=10):
+    """
+    Build a header/rows preview for a skip_rows value from the cached sample
+
+    Args:
+        file_path: Path to Excel file
+        sheet_name: Name of the sheet
+        skip_rows: Number of rows to skip before the header
+        max_rows: Number of data rows to include
+
+    Returns:
+        dict with 'header' and 'rows' lists of display strings
+    """
+    sample = read_sheet_sample(file_path, sheet_name)
+    rows = [row for row in sample[skip_rows:] if any(not _is_empty(v) for v in row)]
+
+    def display(value):
+        if _is_empty(value):
+            return ''
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return str(value)
+
+    header = rows[0] if rows else []
+    return {
+        'header': [display(value) for value in header],
+        'rows': [[display(value) for value in row] for row in rows[1:max_rows + 1]],
+    }
@@ -0,0 +1,106 @@
+import base64
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import F, Q
+
+from .models import ConversionHistory
+
+
+HISTORY_CACHE_TIMEOUT = 5 * 60
+HISTORY_VERSION_KEY = 'conversion_history:version'
+MAX_PAGE_SIZE = 100
+
+
+def _history_version():
+    """Current generation of the history cache (bumped on every write)"""
+    version = cache.get(HISTORY_VERSION_KEY)
+    if version is None:
+        cache.add(HISTORY_VERSION_KEY, 1, None)
+        version = cache.get(HISTORY_VERSION_KEY, 1)
+    return version
+
+
+def invalidate_history_cache():
+    """Drop every cached history page by moving to a new cache generation"""
+    try:
+        cache.incr(HISTORY_VERSION_KEY)
+    except ValueError:
+        cache.set(HISTORY_VERSION_KEY, 2, None)
+
+
+def encode_cursor(timestamp, pk):
+    """Encode the (timestamp, id) position of a row as an opaque cursor"""
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, pk = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def get_history_page(cursor=None, limit=20):
+    """
+    Return one page of conversion history using keyset pagination
+
+    Rows are ordered by (-conversion_timestamp, -id), which is served by the
+    conversion_timestamp_id_idx index, and only the listed columns are
+    fetched. Pages are cached until the next conversion is created or deleted.
+
+    Args:
+        cursor: Cursor returned as 'next_cursor' by the previous page (None = first page)
+        limit: Number of rows per page (capped at MAX_PAGE_SIZE)
+
+    Returns:
+        dict with 'history' rows and 'next_cursor' (None on the last page)
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    cache_key = f"conversion_history:v{_history_version()}:{cursor or ''}:{limit}"
+    page = cache.get(cache_key)
+    if page is not None:
+        return page
+
+    queryset = ConversionHistory.objects.order_by('-conversion_timestamp', '-id').values(
+        'id',
+        'conversion_timestamp',
+        'rows_processed',
+        'columns_count',
+        'status',
+        filename=F('uploaded_file__original_filename'),
+    )
+
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(conversion_timestamp__lt=timestamp) | Q(conversion_timestamp=timestamp, id__lt=pk)
+        )
+
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    page = {
+        'history': [{
+            'id': row['id'],
+            'filename': row['filename'],
+            'timestamp': row['conversion_timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+            'rows_processed': row['rows_processed'],
+            'columns_kept': row['columns_count'],
+            'status': row['status'],
+        } for row in rows],
+        'next_cursor': encode_cursor(rows[-1]['conversion_timestamp'], rows[-1]['id']) if has_more else None,
+    }
+
+    cache.set(cache_key, page, HISTORY_CACHE_TIMEOUT)
+    return page
@@ -0,0 +1,291 @@
+import os
+import posixpath
+import re
+import struct
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+from django.conf import settings
+
+from .readers import detect_excel_format, is_file_object, open_xls_book
+
+
+# Limits applied before any cell is parsed (overridable in settings)
+DEFAULT_MAX_UNCOMPRESSED_SIZE = 500 * 1024 * 1024
+DEFAULT_MAX_COMPRESSION_RATIO = 100
+DEFAULT_MAX_CELLS = 50_000_000
+
+# Rough in-memory cost of one cell once loaded into a DataFrame
+BYTES_PER_CELL = 64
+
+# Bytes of sheet XML / BIFF records per cell, to estimate the cells of a
+# sheet whose dimension is missing or implausible
+SHEET_BYTES_PER_CELL = 16
+
+# A dimension is implausible (stale, e.g. the 'A1' some generators never
+# update) when its sheet takes more than MAX_SHEET_BYTES_PER_CELL per cell
+# it claims, beyond SHEET_OVERHEAD_BYTES for the sheet's head and tail
+MAX_SHEET_BYTES_PER_CELL = 1024
+SHEET_OVERHEAD_BYTES = 64 * 1024
+
+# The <dimension> element sits right after <sheetPr>, well inside this prefix
+DIMENSION_SCAN_BYTES = 64 * 1024
+
+DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension\s+ref="([^"]+)"')
+CELL_REF_RE = re.compile(r'([A-Z]+)(\d+)')
+
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+XLS_RECORD_DIMENSIONS = 0x0200
+XLS_RECORD_EOF = 0x000A
+XLS_SHEET_STATES = {0: 'visible', 1: 'hidden', 2: 'veryHidden'}
+
+
+class WorkbookLimitError(ValueError):
+    """Raised when a workbook exceeds the configured size limits"""
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + (ord(letter) - ord('A') + 1)
+    return index
+
+
+def _parse_dimension(ref):
+    """Convert a dimension ref such as 'A1:F58' to (rows, columns)"""
+    cells = [CELL_REF_RE.match(part) for part in ref.upper().split(':')]
+    if not all(cells):
+        return None, None
+    if len(cells) == 1:
+        return 1, 1
+    first, last = cells[0], cells[-1]
+    rows = int(last.group(2)) - int(first.group(2)) + 1
+    columns = _column_index(last.group(1)) - _column_index(first.group(1)) + 1
+    return rows, columns
+
+
+def _inspect_xlsx(file_path):
+    with zipfile.ZipFile(file_path) as archive:
+        members = {info.filename: info for info in archive.infolist()}
+
+        workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+        rels = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{PKG_REL_NS}Relationship')}
+
+        sheets = []
+        for sheet in workbook.iter(f'{MAIN_NS}sheet'):
+            target = targets.get(sheet.get(f'{REL_NS}id'), '')
+            if target.startswith('/'):
+                part = target.lstrip('/')
+            else:
+                part = posixpath.normpath(posixpath.join('xl', target))
+
+            rows = columns = None
+            member = members.get(part)
+            if member is not None:
+                with archive.open(member) as stream:
+                    match = DIMENSION_RE.search(stream.read(DIMENSION_SCAN_BYTES))
+                if match:
+                    rows, columns = _parse_dimension(match.group(1).decode('ascii'))
+
+            sheets.append({
+                'name': sheet.get('name'),
+                'state': sheet.get('state', 'visible'),
+                'rows': rows,
+                'columns': columns,
+                'compressed_size': member.compress_size if member else 0,
+                'uncompressed_size': member.file_size if member else 0,
+            })
+
+        return {
+            'format': 'xlsx',
+            'sheets': sheets,
+            'compressed_size': sum(info.compress_size for info in members.values()),
+            'uncompressed_size': sum(info.file_size for info in members.values()),
+        }
+
+
+def _xls_dimensions(mem, offset, biff_version):
+    """Scan a sheet substream from its BOF record for the DIMENSIONS record"""
+    position = offset
+    while position + 4 <= len(mem):
+        record_type, length = struct.unpack('<HH', mem[position:position + 4])
+        data = mem[position + 4:position + 4 + length]
+        if record_type == XLS_RECORD_DIMENSIONS:
+            if biff_version >= 80:
+                first_row, last_row, first_col, last_col = struct.unpack('<IIHH', data[:12])
+            else:
+                first_row, last_row, first_col, last_col = struct.unpack('<HHHH', data[:8])
+            return max(last_row - first_row, 0), max(last_col - first_col, 0)
+        if record_type == XLS_RECORD_EOF:
+            break
+        position += 4 + length
+    return None, None
+
+
+def _file_size(file_path):
+    if is_file_object(file_path):
+        size = getattr(file_path, 'size', None)
+        if size is None:
+            size = file_path.seek(0, os.SEEK_END)
+            file_path.seek(0)
+        return size
+    return os.path.getsize(file_path)
+
+
+def _inspect_xls(file_path):
+    # on_demand only decodes the workbook globals (BOUNDSHEET records);
+    # sheet substreams are never parsed here
+    book = open_xls_book(file_path)
+    try:
+        try:
+            # xlrd keeps the absolute BOF offset of each sheet substream in the
+            # Workbook stream, and the sheet states, in private attributes
+            mem = book.mem
+            offsets = list(book._sh_abs_posn)
+            visibility = list(book._sheet_visibility)
+        except (AttributeError, TypeError):
+            offsets = visibility = None
+        names = book.sheet_names()
+        if offsets is None or len(offsets) != len(names) or len(visibility) != len(names):
+            return _inspect_xls_loaded(file_path)
+        ends = sorted(offsets[1:] + [len(mem)])
+
+        sheets = []
+        for index, (name, offset) in enumerate(zip(names, offsets)):
+            rows, columns = _xls_dimensions(mem, offset, book.biff_version)
+            end = next((e for e in ends if e > offset), len(mem))
+            sheets.append({
+                'name': name,
+                'state': XLS_SHEET_STATES.get(visibility[index], 'visible'),
+                'rows': rows,
+                'columns': columns,
+                'compressed_size': end - offset,
+                'uncompressed_size': end - offset,
+            })
+
+        return {
+            'format': 'xls',
+            'sheets': sheets,
+            'compressed_size': _file_size(file_path),
+            'uncompressed_size': len(mem),
+        }
+    finally:
+        book.release_resources()
+
+
+def _inspect_xls_loaded(file_path):
+    """
+    _inspect_xls through xlrd's public API, for xlrd versions without the
+    private attributes it relies on: the workbook is opened in full (every
+    sheet decoded), and the size of each sheet's records is unknown (0)
+    """
+    import xlrd
+
+    if is_file_object(file_path):
+        file_path.seek(0)
+        book = xlrd.open_workbook(file_contents=file_path.read())
+    else:
+        book = xlrd.open_workbook(file_path)
+    try:
+        sheets = [{
+            'name': sheet.name,
+            'state': XLS_SHEET_STATES.get(sheet.visibility, 'visible'),
+            'rows': sheet.nrows,
+            'columns': sheet.ncols,
+            'compressed_size': 0,
+            'uncompressed_size': 0,
+        } for sheet in book.sheets()]
+    finally:
+        book.release_resources()
+
+    size = _file_size(file_path)
+    return {
+        'format': 'xls',
+        'sheets': sheets,
+        'compressed_size': size,
+        'uncompressed_size': size,
+    }
+
+
+def inspect_workbook(file_path):
+    """
+    Read sheet names, dimensions and sizes from workbook metadata only
+
+    For .xlsx the ZIP directory, workbook.xml and each sheet's <dimension>
+    element are read; for .xls the BOUNDSHEET and DIMENSIONS records. No
+    cell data is parsed, so this takes milliseconds even for huge files.
+    Sheets without a plausible dimension get rows and columns of None and
+    a cell count estimated from the size of their XML / records.
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object
+
+    Returns:
+        dict with 'format', 'sheets' (name, state, rows, columns, cells,
+        cells_estimated, sizes), total sizes, 'total_cells',
+        'estimated_memory' and 'elapsed_ms'
+    """
+    started = time.perf_counter()
+
+    try:
+        if detect_excel_format(file_path) == 'xls':
+            info = _inspect_xls(file_path)
+        else:
+            info = _inspect_xlsx(file_path)
+    except Exception as e:
+        raise ValueError(f"Cannot read Excel file: {str(e)}")
+
+    total_cells = 0
+    for sheet in info['sheets']:
+        cells = None
+        if sheet['rows'] is not None and sheet['columns'] is not None:
+            cells = sheet['rows'] * sheet['columns']
+            if sheet['uncompressed_size'] > SHEET_OVERHEAD_BYTES + cells * MAX_SHEET_BYTES_PER_CELL:
+                sheet['rows'] = sheet['columns'] = cells = None
+        sheet['cells_estimated'] = cells is None
+        if cells is None:
+            cells = sheet['uncompressed_size'] // SHEET_BYTES_PER_CELL
+        sheet['cells'] = cells
+        sheet['estimated_memory'] = cells * BYTES_PER_CELL
+        total_cells += cells
+
+    info['total_cells'] = total_cells
+    info['estimated_memory'] = total_cells * BYTES_PER_CELL
+    info['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return info
+
+
+def check_workbook_limits(info):
+    """
+    Reject oversized workbooks and ZIP bombs before any cell is parsed
+
+    Args:
+        info: Result of inspect_workbook
+
+    Raises:
+        WorkbookLimitError: If a size, compression ratio or cell limit is exceeded
+    """
+    max_uncompressed = getattr(settings, 'EXCEL_MAX_UNCOMPRESSED_SIZE', DEFAULT_MAX_UNCOMPRESSED_SIZE)
+    max_ratio = getattr(settings, 'EXCEL_MAX_COMPRESSION_RATIO', DEFAULT_MAX_COMPRESSION_RATIO)
+    max_cells = getattr(settings, 'EXCEL_MAX_CELLS', DEFAULT_MAX_CELLS)
+
+    if info['uncompressed_size'] > max_uncompressed:
+        raise WorkbookLimitError(
+            f"Workbook expands to {info['uncompressed_size'] // (1024 * 1024)}MB, "
+            f"more than the {max_uncompressed // (1024 * 1024)}MB limit"
+        )
+
+    if info['format'] == 'xlsx' and info['compressed_size']:
+        ratio = info['uncompressed_size'] / info['compressed_size']
+        if ratio > max_ratio:
+            raise WorkbookLimitError(f"Suspicious compression ratio ({ratio:.0f}:1), file rejected")
+
+    if info['total_cells'] > max_cells:
+        raise WorkbookLimitError(
+            f"Workbook has {info['total_cells']:,} cells, more than the {max_cells:,} limit"
+        )
@@ -0,0 +1,426 @@
+import http.client
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+
+# Generated workbook profiles: (sheets, rows per sheet)
+WORKBOOK_SIZES = {
+    'small': (1, 200),
+    'medium': (3, 5_000),
+    'large': (2, 50_000),
+}
+
+DEFAULT_MIX = {'small': 6, 'medium': 3, 'large': 1}
+
+ENDPOINTS = ('page', 'upload-simple', 'process-sheets', 'download-zip', 'download-simple')
+
+CSRF_COOKIE_RE = re.compile(r'csrftoken=([^;]+)')
+
+
+def parse_mix(text):
+    """Parse a workbook mix such as 'small=6,medium=3,large=1' into weights"""
+    mix = {}
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        name, _, weight = part.partition('=')
+        if name not in WORKBOOK_SIZES:
+            raise ValueError(f"Unknown workbook size '{name}' (expected one of {', '.join(WORKBOOK_SIZES)})")
+        mix[name] = float(weight or 1)
+    if not mix or not any(mix.values()):
+        raise ValueError('Workbook mix must give at least one size a positive weight')
+    return mix
+
+
+def generate_workbooks(directory, mix, variants=3, seed=0):
+    """
+    Write the test workbooks for a load test
+
+    Every size gets several variants with different content, so sessions do
+    not all upload byte-identical files.
+
+    Returns:
+        dict of size name to list of file paths
+    """
+    import datetime
+    import openpyxl
+
+    rng = random.Random(seed)
+    statuses = ['OK', 'Chờ duyệt', 'Hủy', 'Đã giao']
+    workbooks = {}
+    for size in mix:
+        sheet_count, rows = WORKBOOK_SIZES[size]
+        workbooks[size] = []
+        for variant in range(variants):
+            path = os.path.join(directory, f'{size}_{variant}.xlsx')
+            workbook = openpyxl.Workbook(write_only=True)
+            for sheet_index in range(sheet_count):
+                sheet = workbook.create_sheet(f'Sheet{sheet_index + 1}')
+                sheet.append([f'Báo cáo {size} #{variant}'])
+                sheet.append([])
+                sheet.append(['Mã', 'Khách hàng', 'Ngày', 'Trạng thái', 'Số lượng', 'Số tiền', 'Ghi chú'])
+                start = datetime.date(2024, 1, 1)
+                for row in range(rows):
+                    sheet.append([
+                        row + 1,
+                        f'KH{rng.randrange(10_000):05d}',
+                        start + datetime.timedelta(days=rng.randrange(365)),
+                        rng.choice(statuses),
+                        rng.randrange(1, 500),
+                        round(rng.uniform(10, 100_000), 2),
+                        '' if rng.random() < 0.7 else f'ghi chú {rng.randrange(100)}',
+                    ])
+            workbook.save(path)
+            workbooks[size].append(path)
+    return workbooks
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    # Rounded first so that e.g. 0.07 * 100 (7.000000000000001) is rank 7
+    rank = max(math.ceil(round(fraction * len(sorted_values), 9)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and all its descendants (Linux /proc)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain spaces
+        parent = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(parent, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        pending.extend(children.get(current, []))
+    return total
+
+
+class Recorder:
+    """Thread-safe collection of request timings and RSS samples"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: {} for endpoint in ENDPOINTS}
+        self.sessions = 0
+        self.session_errors = 0
+        self.rss = []
+
+    def record(self, endpoint, seconds, error=None):
+        with self.lock:
+            self.requests[endpoint].append(seconds)
+            if error:
+                self.errors[endpoint][error] = self.errors[endpoint].get(error, 0) + 1
+
+    def session_done(self, failed):
+        with self.lock:
+            self.sessions += 1
+            self.session_errors += int(failed)
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            timings = sorted(self.requests[endpoint])
+            if not timings:
+                continue
+            error_count = sum(self.errors[endpoint].values())
+            endpoints[endpoint] = {
+                'requests': len(timings),
+                'errors': error_count,
+                'error_rate': round(error_count / len(timings), 4),
+                'throughput': round(len(timings) / elapsed, 2),
+                'p50_ms': round(percentile(timings, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(timings, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(timings, 0.99) * 1000, 1),
+                'max_ms': round(timings[-1] * 1000, 1),
+                'error_kinds': self.errors[endpoint],
+            }
+        rss_values = [rss for _, rss in self.rss]
+        return {
+            'elapsed': round(elapsed, 2),
+            'sessions': self.sessions,
+            'session_errors': self.session_errors,
+            'sessions_per_second': round(self.sessions / elapsed, 3) if elapsed else None,
+            'endpoints': endpoints,
+            'rss': {
+                'samples': [(round(t, 1), rss) for t, rss in self.rss],
+                'start': rss_values[0] if rss_values else None,
+                'peak': max(rss_values) if rss_values else None,
+                'end': rss_values[-1] if rss_values else None,
+            },
+        }
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Client:
+    """Minimal keep-alive HTTP client for one simulated user"""
+
+    def __init__(self, base_url, recorder, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.connection = None
+        self.csrf_token = None
+
+    def _connection(self):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, endpoint, method, path, body=None, headers=None):
+        """Send one request, record its latency and return (status, headers, body)"""
+        headers = dict(headers or {})
+        if self.csrf_token:
+            headers['Cookie'] = f'csrftoken={self.csrf_token}'
+            if method == 'POST':
+                headers['X-CSRFToken'] = self.csrf_token
+
+        started = time.perf_counter()
+        try:
+            connection = self._connection()
+            connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            self.recorder.record(endpoint, time.perf_counter() - started, type(e).__name__)
+            raise RequestFailed(f'{endpoint}: {e}')
+        elapsed = time.perf_counter() - started
+
+        if response.status >= 400:
+            self.recorder.record(endpoint, elapsed, f'HTTP {response.status}')
+            raise RequestFailed(f'{endpoint}: HTTP {response.status}')
+        self.recorder.record(endpoint, elapsed)
+        return response.status, response.headers, data
+
+    def post_json(self, endpoint, path, payload):
+        _, _, data = self.request(endpoint, 'POST', path, json.dumps(payload).encode('utf-8'),
+                                  {'Content-Type': 'application/json'})
+        return self._json(endpoint, data)
+
+    def post_file(self, endpoint, path, fields, file_field, file_path):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+            f'filename="{os.path.basename(file_path)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n'
+        )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        _, _, data = self.request(endpoint, 'POST', path, b''.join(parts),
+                                  {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        return self._json(endpoint, data)
+
+    def _json(self, endpoint, data):
+        result = json.loads(data)
+        if not result.get('success'):
+            raise RequestFailed(f"{endpoint}: {result.get('error')}")
+        return result
+
+    def download(self, url):
+        # Download URLs in responses include the /excel/ mount point
+        path = url[len(self.prefix):] if self.prefix and url.startswith(self.prefix) else url
+        self.request('download-simple', 'GET', path)
+
+    def open_page(self):
+        _, headers, _ = self.request('page', 'GET', '/simple/')
+        for value in headers.get_all('Set-Cookie') or []:
+            match = CSRF_COOKIE_RE.search(value)
+            if match:
+                self.csrf_token = match.group(1)
+
+
+def run_session(client, workbook, rng, zip_ratio, output_format):
+    """
+    One user session: upload a workbook, convert it and download the results
+
+    Single-sheet workbooks are converted on upload. Multi-sheet workbooks go
+    through either the download-zip flow or the process-sheets flow (all
+    sheets), chosen at random with probability zip_ratio for the zip.
+    """
+    if client.csrf_token is None:
+        client.open_page()
+
+    uploaded = client.post_file('upload-simple', '/upload-simple/',
+                                {'skip_rows': 0, 'auto_detect_header': 'on', 'output_format': output_format},
+                                'file_path', workbook)
+    if uploaded.get('single_sheet'):
+        client.download(uploaded['download_url'])
+        return
+
+    skip_rows = {name: suggestion['skip_rows']
+                 for name, suggestion in (uploaded.get('header_suggestions') or {}).items() if suggestion}
+    payload = {
+        'temp_file': uploaded['temp_file'],
+        'original_filename': uploaded['original_filename'],
+        'skip_rows': 0,
+        'sheet_skip_rows': skip_rows,
+        'output_format': output_format,
+    }
+    if rng.random() < zip_ratio:
+        result = client.post_json('download-zip', '/download-zip/', payload)
+        client.download(result['download_url'])
+    else:
+        payload['selected_sheets'] = uploaded['sheets']
+        result = client.post_json('process-sheets', '/process-sheets/', payload)
+        for sheet in result['results']:
+            if 'download_url' in sheet:
+                client.download(sheet['download_url'])
+
+
+def run_load(base_url, workbooks, mix, concurrency, duration, sessions=None, think_time=0.0,
+             zip_ratio=0.5, output_format='csv', timeout=300, server_pid=None, sample_interval=1.0,
+             seed=0, on_sample=None):
+    """
+    Closed-loop load: each of `concurrency` users runs sessions back to back
+    (with an optional think time) until `duration` seconds or `sessions`
+    sessions in total have run
+
+    Returns:
+        Recorder.report() dict
+    """
+    recorder = Recorder()
+    sizes = list(mix)
+    weights = [mix[size] for size in sizes]
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    remaining = [sessions]
+    counter_lock = threading.Lock()
+    stop = threading.Event()
+
+    def next_session():
+        if time.monotonic() >= deadline:
+            return False
+        with counter_lock:
+            if remaining[0] is None:
+                return True
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def user(index):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(base_url, recorder, timeout)
+        try:
+            while next_session():
+                workbook = rng.choice(workbooks[rng.choices(sizes, weights)[0]])
+                failed = False
+                try:
+                    run_session(client, workbook, rng, zip_ratio, output_format)
+                except (RequestFailed, ValueError, KeyError):
+                    failed = True
+                recorder.session_done(failed)
+                if think_time:
+                    time.sleep(rng.expovariate(1 / think_time))
+        finally:
+            client.close()
+
+    def sample_rss():
+        while not stop.is_set():
+            rss = process_tree_rss(server_pid)
+            recorder.rss.append((time.monotonic() - started, rss))
+            if on_sample is not None:
+                on_sample(time.monotonic() - started, rss, recorder)
+            stop.wait(sample_interval)
+
+    sampler = None
+    if server_pid is not None:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+    users = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+    stop.set()
+    if sampler is not None:
+        sampler.join()
+        recorder.rss.append((elapsed, process_tree_rss(server_pid)))
+    return recorder.report(elapsed)
+
+
+def start_server(port, workers=1, env=None, cwd=None, startup_timeout=60):
+    """
+    Start uvicorn serving this project on 127.0.0.1 and wait until it answers
+
+    Returns:
+        subprocess.Popen of the server
+    """
+    server_env = dict(os.environ, **(env or {}))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'mysite.asgi:application',
+         '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+        cwd=cwd, env=server_env,
+    )
+
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/excel/simple/')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return server
+        except OSError:
+            pass
+        time.sleep(0.25)
+
+    stop_server(server)
+    raise RuntimeError(f'Server did not answer on port {port} within {startup_timeout}s')
+
+
+def stop_server(server, timeout=15):
+    server.terminate()
+    try:
+        server.wait(timeout)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
@@ -0,0 +1,138 @@
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tool.exporters import OUTPUT_FORMATS
+from tool.loadtest import (
+    DEFAULT_MIX, parse_mix, generate_workbooks, run_load, start_server, stop_server,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay upload -> process -> download sessions against a local uvicorn server '
+        'at fixed concurrency and report throughput, latency percentiles, errors and server RSS'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of an already running server (e.g. http://127.0.0.1:8000/excel); '
+                                          'by default a uvicorn server is started for the test')
+        parser.add_argument('--server-pid', type=int, help='PID of the --url server, for RSS sampling')
+        parser.add_argument('--port', type=int, default=8765, help='Port of the started server')
+        parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes of the started server')
+        parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                            help='Environment variable for the started server (repeatable), e.g. EXCEL_PREWARM=1')
+        parser.add_argument('--concurrency', default='4',
+                            help='Simulated users; a comma-separated list runs one stage per level')
+        parser.add_argument('--duration', type=float, default=60, help='Seconds per stage')
+        parser.add_argument('--sessions', type=int, help='Stop a stage after this many sessions')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Mean pause between sessions of a user (s)')
+        parser.add_argument('--mix', default=','.join(f'{size}={weight}' for size, weight in DEFAULT_MIX.items()),
+                            help='Workbook size weights, e.g. small=6,medium=3,large=1')
+        parser.add_argument('--variants', type=int, default=3, help='Different workbooks generated per size')
+        parser.add_argument('--zip-ratio', type=float, default=0.5,
+                            help='Share of multi-sheet sessions using download-zip instead of process-sheets')
+        parser.add_argument('--output-format', default='csv', choices=OUTPUT_FORMATS)
+        parser.add_argument('--timeout', type=float, default=300, help='Per-request timeout (s)')
+        parser.add_argument('--sample-interval', type=float, default=1.0, help='Server RSS sampling interval (s)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path', help='Write the full report (with RSS timeline) to this file')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+            levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not levels or min(levels) < 1:
+            raise CommandError('Concurrency levels must be positive integers')
+
+        env = {}
+        for item in options['env']:
+            key, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'Invalid --env value {item!r} (expected KEY=VALUE)')
+            env[key] = value
+
+        workbook_dir = tempfile.mkdtemp(prefix='loadtest_')
+        server = None
+        try:
+            self.stdout.write('Generating workbooks...')
+            workbooks = generate_workbooks(workbook_dir, mix, options['variants'], options['seed'])
+
+            if options['url']:
+                base_url = options['url'].rstrip('/')
+                server_pid = options['server_pid']
+            else:
+                self.stdout.write(f"Starting uvicorn with {options['workers']} worker(s) on port {options['port']}...")
+                try:
+                    server = start_server(options['port'], options['workers'], env, cwd=settings.BASE_DIR)
+                except RuntimeError as e:
+                    raise CommandError(str(e))
+                base_url = f"http://127.0.0.1:{options['port']}/excel"
+                server_pid = server.pid
+
+            stages = []
+            for concurrency in levels:
+                self.stdout.write(f'\nConcurrency {concurrency}, {options["duration"]:g}s...')
+                report = run_load(
+                    base_url, workbooks, mix, concurrency, options['duration'],
+                    sessions=options['sessions'],
+                    think_time=options['think_time'],
+                    zip_ratio=options['zip_ratio'],
+                    output_format=options['output_format'],
+                    timeout=options['timeout'],
+                    server_pid=server_pid,
+                    sample_interval=options['sample_interval'],
+                    seed=options['seed'],
+                    on_sample=self._print_sample if options['verbosity'] > 1 else None,
+                )
+                report['concurrency'] = concurrency
+                stages.append(report)
+                self._print_report(report)
+        finally:
+            if server is not None:
+                stop_server(server)
+            shutil.rmtree(workbook_dir, ignore_errors=True)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w', encoding='utf-8') as f:
+                json.dump({
+                    'config': {key: options[key] for key in (
+                        'url', 'workers', 'env', 'duration', 'sessions', 'think_time', 'mix',
+                        'variants', 'zip_ratio', 'output_format', 'seed',
+                    )},
+                    'stages': stages,
+                }, f, indent=2, ensure_ascii=False)
+            self.stdout.write(f"\nReport written to {options['json_path']}")
+
+    def _print_sample(self, elapsed, rss, recorder):
+        self.stdout.write(f'  t={elapsed:6.1f}s  sessions={recorder.sessions:5d}  rss={rss / 2 ** 20:8.1f} MB')
+
+    def _print_report(self, report):
+        self.stdout.write(
+            f"Sessions: {report['sessions']} in {report['elapsed']}s "
+            f"({report['sessions_per_second']}/s), failed: {report['session_errors']}"
+        )
+        self.stdout.write(
+            f"{'endpoint':<16}{'requests':>9}{'req/s':>8}{'errors':>8}{'err %':>7}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+        )
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write(
+                f"{endpoint:<16}{stats['requests']:>9}{stats['throughput']:>8}{stats['errors']:>8}"
+                f"{stats['error_rate'] * 100:>7.1f}{stats['p50_ms']:>9}{stats['p95_ms']:>9}"
+                f"{stats['p99_ms']:>9}{stats['max_ms']:>9}"
+            )
+            for kind, count in stats['error_kinds'].items():
+                self.stdout.write(f'    {kind}: {count}')
+
+        rss = report['rss']
+        if rss['peak'] is not None:
+            self.stdout.write(
+                f"Server RSS: start {rss['start'] / 2 ** 20:.1f} MB, peak {rss['peak'] / 2 ** 20:.1f} MB, "
+                f"end {rss['end'] / 2 ** 20:.1f} MB ({len(rss['samples'])} samples)"
+            )
@@ -0,0 +1,313 @@
+import random
+import threading
+import time
+import tracemalloc
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+# Stages a conversion's memory is broken down by
+STAGES = ('read', 'clean', 'write')
+
+_usage = ContextVar('excel_memory_usage', default=None)
+_stage = ContextVar('excel_memory_stage', default=None)
+
+# tracemalloc is process-wide: one sampled conversion at a time owns it, so
+# its peaks are not reset or inflated by another one
+_tracing_lock = threading.Lock()
+
+
+def _status_bytes(field):
+    """A memory field of /proc/self/status (e.g. VmRSS, VmHWM) in bytes, or None"""
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Resident set size of this process in bytes (None where unavailable)"""
+    return _status_bytes(b'VmRSS:')
+
+
+def rss_high_water_mark():
+    """Peak resident set size of this process in bytes (None where unavailable)"""
+    hwm = _status_bytes(b'VmHWM:')
+    if hwm is not None:
+        return hwm
+    try:
+        import resource
+        import sys
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes, except on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _growth(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def _max(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return max(first, second)
+
+
+class _Snapshot:
+    """Memory counters at one point of a conversion"""
+
+    def __init__(self, traced):
+        self.time = time.perf_counter()
+        self.rss = current_rss()
+        self.hwm = rss_high_water_mark()
+        self.traced = tracemalloc.get_traced_memory()[0] if traced else None
+
+
+class MemoryUsage:
+    """
+    Peak memory of one conversion, by stage
+
+    Every conversion records its RSS growth and how much it raised the
+    process's RSS high-water mark (the conversion that raises it is the one
+    an OOM kill points at). Sampled conversions also trace their Python
+    allocations with tracemalloc, which gives the exact peak of each stage
+    but slows allocations down (see EXCEL_MEMORY_TRACE_SAMPLE_RATE).
+
+    Use track_conversion() to create one, as a context manager or with
+    start() / stop(); library code marks its stages with stage().
+
+    A conversion handling its DataFrames in this process (in_process) first
+    imports the conversion dependencies, so the first one of a process does
+    not count their import in its memory figures.
+    """
+
+    def __init__(self, file_size, traced, in_process=True):
+        self.file_size = file_size
+        self.traced = traced
+        self.in_process = in_process
+        self.started_tracemalloc = False
+        self.stages = {}
+        self.start_snapshot = None
+        self.end = None
+        self.peak_traced = None
+        # Largest growths of the parts run in worker processes
+        self.worker_rss_growth = None
+        self.worker_hwm_growth = None
+
+    def start(self):
+        if self.in_process:
+            from .warmup import import_conversion_modules
+
+            import_conversion_modules()
+        # Another conversion of this process being traced, this one is not
+        self.traced = self.traced and _tracing_lock.acquire(blocking=False)
+        if self.traced and not tracemalloc.is_tracing():
+            # One frame per allocation keeps tracing overhead low
+            tracemalloc.start(1)
+            self.started_tracemalloc = True
+        if self.traced:
+            tracemalloc.reset_peak()
+        self.start_snapshot = _Snapshot(self.traced)
+        self._token = _usage.set(self)
+        return self
+
+    def stop(self):
+        """End the measurement (calling it again does nothing)"""
+        if self.end is not None or self.start_snapshot is None:
+            return
+        _usage.reset(self._token)
+        if self.traced:
+            self._record_traced_peak()
+        self.end = _Snapshot(self.traced)
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        if self.traced:
+            _tracing_lock.release()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def _record_traced_peak(self):
+        """Fold the peak since the last reset into the conversion's peak"""
+        peak = tracemalloc.get_traced_memory()[1] - self.start_snapshot.traced
+        self.peak_traced = _max(self.peak_traced, peak)
+        tracemalloc.reset_peak()
+
+    def _add_stage(self, name, seconds, peak_traced, rss_growth, hwm_growth):
+        stage = self.stages.setdefault(name, {
+            'seconds': 0.0,
+            'peak_traced': None,
+            'rss_growth': None,
+            'hwm_growth': None,
+        })
+        # A stage run once per sheet reports its largest run
+        stage['seconds'] += seconds
+        stage['peak_traced'] = _max(stage['peak_traced'], peak_traced)
+        stage['rss_growth'] = _max(stage['rss_growth'], rss_growth)
+        stage['hwm_growth'] = _max(stage['hwm_growth'], hwm_growth)
+
+    def _record_stage(self, name, before, after, peak_traced):
+        self._add_stage(name, after.time - before.time, peak_traced, _growth(before.rss, after.rss),
+                        _growth(before.hwm, after.hwm))
+
+    def add_worker_usage(self, usage):
+        """
+        Fold in the figures of a part of the conversion run in a worker
+        process (see workers.py), measured there by its own MemoryUsage
+        """
+        for name, figures in usage['stages'].items():
+            self._add_stage(name, figures['seconds'], figures['peak_traced'], figures['rss_growth'],
+                            figures['hwm_growth'])
+        self.peak_traced = _max(self.peak_traced, usage['peak_traced'])
+        self.worker_rss_growth = _max(self.worker_rss_growth, usage['rss_growth'])
+        self.worker_hwm_growth = _max(self.worker_hwm_growth, usage['hwm_growth'])
+
+    def result(self):
+        """
+        The conversion's memory figures
+
+        Returns:
+            dict with 'sampled' (allocations traced), 'file_size', 'peak_traced'
+            (bytes above the conversion's starting point, None when not sampled),
+            'rss_start', 'rss_growth', 'hwm_growth' (of this process),
+            'worker_rss_growth', 'worker_hwm_growth' (of the worker process
+            that ran the conversion, None when it ran here), per-stage figures
+            under 'stages', 'ratio' (peak / file size) and 'flagged' (ratio above
+            EXCEL_MEMORY_RATIO_THRESHOLD, for a peak of at least
+            EXCEL_MEMORY_FLAG_MIN_BYTES: small files always have a high ratio)
+        """
+        peak = self.peak_traced
+        if peak is None:
+            # Without tracing, what the conversion added to the process's RSS
+            # (or to its worker's)
+            peak = _max(_growth(self.start_snapshot.rss, self.end.rss), _growth(self.start_snapshot.hwm, self.end.hwm))
+            peak = _max(peak, _max(self.worker_rss_growth, self.worker_hwm_growth))
+        ratio = round(peak / self.file_size, 2) if peak and self.file_size else None
+        return {
+            'sampled': self.traced,
+            'file_size': self.file_size,
+            'seconds': round(self.end.time - self.start_snapshot.time, 3),
+            'peak_traced': self.peak_traced,
+            'rss_start': self.start_snapshot.rss,
+            'rss_growth': _growth(self.start_snapshot.rss, self.end.rss),
+            'hwm_growth': _growth(self.start_snapshot.hwm, self.end.hwm),
+            'worker_rss_growth': self.worker_rss_growth,
+            'worker_hwm_growth': self.worker_hwm_growth,
+            'stages': {
+                name: dict(figures, seconds=round(figures['seconds'], 3))
+                for name, figures in self.stages.items()
+            },
+            'ratio': ratio,
+            'flagged': (ratio is not None and ratio > settings.EXCEL_MEMORY_RATIO_THRESHOLD
+                        and peak >= settings.EXCEL_MEMORY_FLAG_MIN_BYTES),
+        }
+
+
+class _Stage:
+    def __init__(self, usage, name):
+        self.usage = usage
+        self.name = name
+
+    def __enter__(self):
+        if self.usage.traced:
+            self.usage._record_traced_peak()
+        self.before = _Snapshot(self.usage.traced)
+        self._token = _stage.set(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _stage.reset(self._token)
+        peak_traced = None
+        if self.usage.traced:
+            peak_traced = tracemalloc.get_traced_memory()[1] - self.before.traced
+            self.usage._record_traced_peak()
+        self.usage._record_stage(self.name, self.before, _Snapshot(self.usage.traced), peak_traced)
+        return False
+
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+def stage(name):
+    """
+    Context manager attributing the memory used inside it to a stage of the
+    current conversion (one of STAGES)
+
+    A no-op outside track_conversion(), and inside another stage (e.g.
+    clean_dataframe within the 'clean' stage of utils.process_excel_file).
+    """
+    usage = _usage.get()
+    if usage is None or _stage.get() is not None:
+        return _NOOP_STAGE
+    return _Stage(usage, name)
+
+
+def current_usage():
+    """MemoryUsage of the conversion running in this context (None outside track_conversion())"""
+    return _usage.get()
+
+
+def track_conversion(file_size, in_process=None):
+    """
+    Measure the memory of the conversion run inside the block
+
+    A share of conversions (EXCEL_MEMORY_TRACE_SAMPLE_RATE) is traced with
+    tracemalloc, one at a time per process; the others record RSS only.
+
+    Args:
+        file_size: Size of the converted workbook in bytes (for the
+            memory-to-file-size ratio)
+        in_process: Whether the conversion loads DataFrames in this process
+            (None = only when it is not run in worker processes, see
+            EXCEL_WORKER_PROCESSES)
+
+    Returns:
+        MemoryUsage context manager; call .result() after the block
+    """
+    rate = settings.EXCEL_MEMORY_TRACE_SAMPLE_RATE
+    if in_process is None:
+        in_process = not settings.EXCEL_WORKER_PROCESSES
+    return MemoryUsage(file_size, traced=bool(rate) and random.random() < rate, in_process=in_process)
+
+
+def report_usage(view, filename, usage):
+    """
+    Export a conversion's memory figures as metrics, and log it when its
+    memory-to-file-size ratio is unusually high
+
+    Args:
+        view: Conversion view (one of metrics.CONVERSION_VIEWS)
+        filename: Name of the converted workbook
+        usage: dict from MemoryUsage.result()
+    """
+    from .metrics import record_conversion_memory
+
+    if usage['flagged']:
+        print(f"High memory use converting {filename}: {usage['ratio']}x its size of {usage['file_size']} bytes")
+    try:
+        record_conversion_memory(view, usage)
+    except Exception as e:
+        print(f"Error recording memory metrics for {filename}: {e}")
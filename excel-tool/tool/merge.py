@@ -0,0 +1,224 @@
+import os
+import shutil
+import tempfile
+
+from .exporters import get_output_format, open_writer, arrow_schema, DEFAULT_CHUNK_ROWS
+from .progress import ConversionCancelled
+from .memory import stage
+from .tracing import span
+
+
+def _unified_dtype(dtypes, present_everywhere):
+    """
+    dtype a column gets in the merged output, given its dtype in each sheet
+
+    Numeric columns are widened to a common type; anything else that
+    differs between sheets becomes text. When some sheet lacks the column,
+    integer and bool columns become nullable (Int64, boolean, ...) so those
+    rows are missing without turning 101 into 101.0.
+    """
+    import numpy as np
+    from pandas.api import types as ptypes
+
+    first = dtypes[0]
+    if all(dtype == first for dtype in dtypes):
+        if present_everywhere or not isinstance(first, np.dtype):
+            return first
+        return _nullable(first)
+
+    if all(isinstance(dtype, np.dtype) and ptypes.is_numeric_dtype(dtype) and not ptypes.is_bool_dtype(dtype)
+           for dtype in dtypes):
+        dtype = np.result_type(*dtypes)
+        return dtype if present_everywhere else _nullable(dtype)
+
+    return 'text'
+
+
+def _nullable(dtype):
+    """Nullable pandas dtype of an integer or bool NumPy dtype (other dtypes hold missing values already)"""
+    import numpy as np
+    import pandas as pd
+    from pandas.api import types as ptypes
+
+    if ptypes.is_integer_dtype(dtype) or ptypes.is_bool_dtype(dtype):
+        return pd.array(np.empty(0, dtype=dtype)).dtype
+    return dtype
+
+
+def _align(df, columns, dtypes):
+    """Reindex a sheet to the merged columns and cast each column to its merged dtype"""
+    df = df.reindex(columns=columns)
+    for position, column in enumerate(columns):
+        dtype = dtypes[column]
+        series = df.iloc[:, position]
+        if dtype == 'text':
+            values = series.astype(object)
+            df.isetitem(position, values.where(values.isna(), values.astype(str)))
+        elif series.dtype != dtype:
+            df.isetitem(position, series.astype(dtype))
+    return df
+
+
+def merge_sheets(sheets, output_path, output_format='csv', source_column=None, chunk_rows=DEFAULT_CHUNK_ROWS,
+                 on_chunk=None, profile=None):
+    """
+    Concatenate several sheets into one output with columns aligned by name
+
+    Sheets are loaded one at a time and spooled to disk, so only one sheet is
+    held in memory. Once every sheet's columns and dtypes are known, the
+    spooled sheets are streamed into a single writer in the merged schema
+    (union of all columns, in first-seen order).
+
+    Args:
+        sheets: Iterable of (sheet_name, load) pairs, where load() returns the
+            cleaned DataFrame of that sheet
+        output_path: Destination file path
+        output_format: One of exporters.OUTPUT_FORMATS
+        source_column: Name of a column holding the source sheet name
+            (None = no source column)
+        chunk_rows: Rows per written chunk
+        on_chunk: Called with (rows written, bytes on disk) after each chunk,
+            as in exporters.write_dataframe
+        profile: Optional profiling.TableProfile fed with each written chunk
+
+    Returns:
+        dict with 'rows_written', 'columns', per-sheet 'sheets' reports
+        (rows, columns, missing_columns, extra_columns, error) and
+        'type_conflicts' (column -> {sheet: dtype}) for columns whose type
+        differs between sheets
+    """
+    import pandas as pd
+
+    output_format = get_output_format(output_format)
+    spool_dir = tempfile.mkdtemp(prefix='merge_', dir=os.path.dirname(output_path))
+
+    try:
+        # Pass 1: load, clean and spool each sheet, recording its schema
+        spooled = []
+        reports = []
+        columns = []
+        column_dtypes = {}
+        for index, (sheet_name, load) in enumerate(sheets):
+            try:
+                df = load()
+            except ConversionCancelled:
+                raise
+            except Exception as e:
+                reports.append({'sheet_name': sheet_name, 'rows': 0, 'error': str(e)})
+                continue
+
+            df.columns = [str(col) for col in df.columns]
+            for column in df.columns:
+                if column not in column_dtypes:
+                    columns.append(column)
+                    column_dtypes[column] = {}
+                column_dtypes[column][sheet_name] = df[column].dtype
+
+            spool_path = os.path.join(spool_dir, f'{index}.pkl')
+            with span('merge.spool', sheet=sheet_name, rows=len(df), columns=len(df.columns)):
+                df.to_pickle(spool_path)
+            spooled.append((sheet_name, spool_path, list(df.columns)))
+            reports.append({'sheet_name': sheet_name, 'rows': len(df), 'columns': len(df.columns)})
+            del df
+
+        if not spooled:
+            raise ValueError('None of the selected sheets could be read')
+
+        if source_column:
+            if source_column in column_dtypes:
+                raise ValueError(f"Source column '{source_column}' already exists in the sheets")
+            columns.insert(0, source_column)
+
+        # Merged schema and mismatch report
+        sheet_count = len(spooled)
+        dtypes = {}
+        type_conflicts = {}
+        for column, per_sheet in column_dtypes.items():
+            dtypes[column] = _unified_dtype(list(per_sheet.values()), len(per_sheet) == sheet_count)
+            if len(set(str(dtype) for dtype in per_sheet.values())) > 1:
+                type_conflicts[column] = {sheet: str(dtype) for sheet, dtype in per_sheet.items()}
+        if source_column:
+            dtypes[source_column] = 'text'
+
+        for report in reports:
+            sheet_columns = next((cols for name, _, cols in spooled if name == report['sheet_name']), None)
+            if sheet_columns is None:
+                continue
+            report['missing_columns'] = [col for col in columns if col not in sheet_columns and col != source_column]
+            first_columns = spooled[0][2]
+            report['extra_columns'] = [col for col in sheet_columns if col not in first_columns]
+
+        # Pass 2: stream each spooled sheet into one writer
+        schema = None
+        if output_format in ('parquet', 'feather'):
+            # Inferred from every row: a later value of another type must not break the write
+            schemas = []
+            with span('merge.schema', sheets=len(spooled)):
+                for sheet_name, spool_path, _ in spooled:
+                    df = pd.read_pickle(spool_path)
+                    if source_column:
+                        df.insert(0, source_column, sheet_name)
+                    schemas.append(arrow_schema(_align(df, columns, dtypes), output_format))
+                    del df
+            schema = _merged_schema(schemas, dtypes)
+            del schemas
+
+        with stage('write'), span('write', format=output_format, sheets=len(spooled), columns=len(columns)) as s:
+            rows_written = 0
+            writer = open_writer(output_path, output_format, schema=schema)
+            try:
+                for sheet_name, spool_path, _ in spooled:
+                    df = pd.read_pickle(spool_path)
+                    if source_column:
+                        df.insert(0, source_column, sheet_name)
+                    df = _align(df, columns, dtypes)
+                    if rows_written == 0 and df.empty:
+                        writer.write(df)
+                        if profile is not None:
+                            profile.update(df)
+                    for start in range(0, len(df), chunk_rows):
+                        chunk = df.iloc[start:start + chunk_rows]
+                        writer.write(chunk)
+                        if profile is not None:
+                            profile.update(chunk)
+                        if on_chunk is not None:
+                            on_chunk(rows_written + min(start + chunk_rows, len(df)), os.path.getsize(output_path))
+                    rows_written += len(df)
+                    del df
+            finally:
+                writer.close()
+            s.set(rows=rows_written, bytes=os.path.getsize(output_path))
+
+        return {
+            'rows_written': rows_written,
+            'bytes_written': os.path.getsize(output_path),
+            'columns': columns,
+            'sheets': reports,
+            'type_conflicts': type_conflicts,
+        }
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def _merged_schema(schemas, dtypes):
+    """
+    Arrow schema of the merged output from the schema of each aligned sheet
+
+    Text columns are strings even when every value is empty, and a column
+    typed differently between sheets (e.g. an object column holding numbers
+    in one sheet and text in another) is written as text.
+    """
+    import pyarrow as pa
+
+    def is_text(arrow_type):
+        return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+
+    fields = []
+    for position, field in enumerate(schemas[0]):
+        types = {schema.field(position).type for schema in schemas} - {pa.null()}
+        if len(types) == 1 and (dtypes.get(field.name) != 'text' or is_text(next(iter(types)))):
+            field = pa.field(field.name, types.pop())
+        elif types or dtypes.get(field.name) == 'text':
+            field = pa.field(field.name, pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=schemas[0].metadata)
@@ -0,0 +1,212 @@
+import itertools
+
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+
+# Counters live in the 'metrics' cache, so with a shared cache every server
+# process adds to, and serves, the same numbers. It is kept apart from the
+# default cache, whose culling would silently reset counters and leave
+# gauges (queue depth, running conversions) below zero.
+KEY_PREFIX = 'metrics'
+
+cache = ConnectionProxy(caches, 'metrics')
+
+CONVERSION_VIEWS = ('upload', 'process_sheets', 'download_zip', 'process')
+SCHEDULER_LANES = ('fast', 'bulk')
+WORKER_RECYCLE_REASONS = ('jobs', 'rss', 'exited')
+MEMORY_STAGES = ('read', 'clean', 'write', 'total')
+
+MIB = 1024 * 1024
+BYTE_BUCKETS = tuple(n * MIB for n in (1, 4, 16, 64, 256, 1024, 4096, 16384))
+RATIO_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _increment(key, amount):
+    # incr is atomic in shared caches (Redis, Memcached); add creates the key
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if not cache.add(key, amount, None):
+            cache.incr(key, amount)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Args:
+            labels: dict of label name -> allowed values, in label order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.label_values = tuple(labels.values()) if labels else ()
+
+    def _key(self, values):
+        return ':'.join((KEY_PREFIX, self.name) + tuple(values))
+
+    def _values(self, labels):
+        values = tuple(str(labels[name]) for name in self.label_names)
+        for value, allowed in zip(values, self.label_values):
+            if value not in allowed:
+                raise ValueError(f'Unknown {self.name} label value: {value}')
+        return values
+
+    def inc(self, amount=1, **labels):
+        _increment(self._key(self._values(labels)), amount)
+
+    def render(self):
+        series = list(itertools.product(*self.label_values))
+        stored = cache.get_many([self._key(values) for values in series])
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        for values in series:
+            lines.append(f'{self.name}{_label_text(self.label_names, values)} {stored.get(self._key(values), 0)}')
+        return lines
+
+
+class Gauge(Counter):
+    """A value going up and down, summed over the processes sharing the cache"""
+    TYPE = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        _increment(self._key(self._values(labels)), -amount)
+
+
+class Histogram(Counter):
+    # Sums are kept as integers (cache.incr), in units of 1 / SUM_SCALE
+    SUM_SCALE = 1000
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        if value is None:
+            return
+        values = self._values(labels)
+        for bound in self.buckets:
+            if value <= bound:
+                _increment(self._key(values + (f'le{bound}',)), 1)
+                break
+        else:
+            _increment(self._key(values + ('inf',)), 1)
+        _increment(self._key(values + ('sum',)), int(round(max(value, 0) * self.SUM_SCALE)))
+
+    def render(self):
+        series = list(itertools.product(*self.label_values))
+        slots = [f'le{bound}' for bound in self.buckets] + ['inf', 'sum']
+        stored = cache.get_many([self._key(values + (slot,)) for values in series for slot in slots])
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for values in series:
+            cumulative = 0
+            for bound in self.buckets:
+                cumulative += stored.get(self._key(values + (f'le{bound}',)), 0)
+                labels = _label_text(self.label_names + ('le',), values + (str(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += stored.get(self._key(values + ('inf',)), 0)
+            labels = _label_text(self.label_names + ('le',), values + ('+Inf',))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            total = stored.get(self._key(values + ('sum',)), 0) / self.SUM_SCALE
+            lines.append(f'{self.name}_sum{_label_text(self.label_names, values)} {total:g}')
+            lines.append(f'{self.name}_count{_label_text(self.label_names, values)} {cumulative}')
+        return lines
+
+
+conversions = Counter(
+    'excel_conversions_total', 'Conversions measured, by view',
+    {'view': CONVERSION_VIEWS},
+)
+conversions_sampled = Counter(
+    'excel_conversions_memory_traced_total', 'Conversions whose allocations were traced with tracemalloc',
+    {'view': CONVERSION_VIEWS},
+)
+conversions_flagged = Counter(
+    'excel_conversions_memory_flagged_total', 'Conversions whose memory-to-file-size ratio was unusually high',
+    {'view': CONVERSION_VIEWS},
+)
+conversion_seconds = Histogram(
+    'excel_conversion_seconds', 'Conversion time', SECONDS_BUCKETS,
+    {'view': CONVERSION_VIEWS},
+)
+peak_traced_bytes = Histogram(
+    'excel_conversion_peak_traced_bytes', 'Peak traced Python allocations of traced conversions', BYTE_BUCKETS,
+    {'stage': MEMORY_STAGES},
+)
+rss_growth_bytes = Histogram(
+    'excel_conversion_rss_growth_bytes', 'Growth of the process RSS during a conversion', BYTE_BUCKETS,
+    {'stage': MEMORY_STAGES},
+)
+hwm_growth_bytes = Histogram(
+    'excel_conversion_rss_hwm_growth_bytes', 'How much a conversion raised the process RSS high-water mark',
+    BYTE_BUCKETS,
+)
+memory_ratio = Histogram(
+    'excel_conversion_memory_ratio', 'Peak memory of a conversion divided by its file size', RATIO_BUCKETS,
+)
+queue_depth = Gauge(
+    'excel_conversion_queue_depth', 'Conversions waiting for a slot, by scheduler lane',
+    {'lane': SCHEDULER_LANES},
+)
+conversions_running = Gauge(
+    'excel_conversions_running', 'Conversions running, by scheduler lane',
+    {'lane': SCHEDULER_LANES},
+)
+queue_wait_seconds = Histogram(
+    'excel_conversion_queue_wait_seconds', 'Time conversions waited for a slot, by scheduler lane', WAIT_BUCKETS,
+    {'lane': SCHEDULER_LANES},
+)
+workers_recycled = Counter(
+    'excel_workers_recycled_total', 'Conversion worker processes replaced, by reason',
+    {'reason': WORKER_RECYCLE_REASONS},
+)
+
+REGISTRY = [
+    conversions, conversions_sampled, conversions_flagged, conversion_seconds,
+    peak_traced_bytes, rss_growth_bytes, hwm_growth_bytes, memory_ratio,
+    queue_depth, conversions_running, queue_wait_seconds, workers_recycled,
+]
+
+
+def record_conversion_memory(view, usage):
+    """
+    Add one conversion's memory figures (memory.MemoryUsage.result()) to the metrics
+
+    Args:
+        view: One of CONVERSION_VIEWS
+        usage: dict from MemoryUsage.result()
+    """
+    conversions.inc(view=view)
+    conversion_seconds.observe(usage['seconds'], view=view)
+    if usage['sampled']:
+        conversions_sampled.inc(view=view)
+    if usage['flagged']:
+        conversions_flagged.inc(view=view)
+
+    # Growth of the process the conversion ran in: its worker, if it had one
+    worker = usage['worker_rss_growth'] is not None or usage['worker_hwm_growth'] is not None
+    peak_traced_bytes.observe(usage['peak_traced'], stage='total')
+    rss_growth_bytes.observe(usage['worker_rss_growth' if worker else 'rss_growth'], stage='total')
+    for name, figures in usage['stages'].items():
+        peak_traced_bytes.observe(figures['peak_traced'], stage=name)
+        rss_growth_bytes.observe(figures['rss_growth'], stage=name)
+    hwm_growth_bytes.observe(usage['worker_hwm_growth' if worker else 'hwm_growth'])
+    memory_ratio.observe(usage['ratio'])
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,201 @@
+import json
+import time
+from datetime import datetime
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.urls import Resolver404, resolve
+
+from .cpuprofile import RequestProfiler
+from .tracing import TRACE_ID_HEADER, span, start_trace, finish_trace, current_trace_id
+
+
+class TracingMiddleware:
+    """
+    Record a trace of the request when asked by the X-Excel-Trace header or
+    picked by EXCEL_TRACE_SAMPLE_RATE (see tracing.py)
+
+    The request is the root span; the conversion steps the views record are
+    nested in it. Multipart bodies are parsed in an 'upload.receive' span
+    before the view runs, so receiving the upload is timed on its own.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            # Async views (progress streams) keep running on the event loop
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        trace = start_trace(request)
+        if trace is None:
+            return self.get_response(request)
+
+        try:
+            with span('request', **self._request_attributes(request)) as root:
+                self._receive_upload(request)
+                response = self.get_response(request)
+                self._set_response_attributes(root, response)
+        finally:
+            path = finish_trace(trace, f'{request.method} {request.path}')
+        if path:
+            response[TRACE_ID_HEADER] = trace.trace_id
+        return response
+
+    async def __acall__(self, request):
+        trace = start_trace(request)
+        if trace is None:
+            return await self.get_response(request)
+
+        try:
+            with span('request', **self._request_attributes(request)) as root:
+                await sync_to_async(self._receive_upload)(request)
+                response = await self.get_response(request)
+                self._set_response_attributes(root, response)
+        finally:
+            path = await sync_to_async(finish_trace)(trace, f'{request.method} {request.path}')
+        if path:
+            response[TRACE_ID_HEADER] = trace.trace_id
+        return response
+
+    @staticmethod
+    def _request_attributes(request):
+        return {
+            'method': request.method,
+            'path': request.path,
+            'bytes': int(request.META.get('CONTENT_LENGTH') or 0),
+        }
+
+    @staticmethod
+    def _receive_upload(request):
+        if request.method == 'POST' and request.content_type == 'multipart/form-data':
+            with span('upload.receive') as s:
+                uploads = request.FILES
+                s.set(files=len(uploads), bytes=sum(f.size for f in uploads.values()))
+
+    @staticmethod
+    def _set_response_attributes(root, response):
+        root.set(status=response.status_code)
+        if not response.streaming:
+            root.set(response_bytes=len(response.content))
+
+
+# JSON body parameters recorded with a slow request's profile
+PROFILED_PARAMETERS = (
+    'file_id', 'temp_file', 'original_filename', 'selected_sheets', 'output_format',
+    'merge_sheets', 'skip_rows', 'row_filter', 'delta',
+)
+
+
+class SlowRequestProfileMiddleware:
+    """
+    CPU-profile conversion views and keep the profile of the slow ones
+
+    Every request to a view listed in EXCEL_SLOW_REQUEST_VIEWS runs under
+    cpuprofile.RequestProfiler; when the view took EXCEL_SLOW_REQUEST_SECONDS
+    or longer, the profile is saved as a SlowRequestProfile (listed in the
+    admin with its top functions), linked to the upload and conversion the
+    view recorded on the request (uploaded_file_record, conversion_history).
+
+    The profiler wraps get_response, so the middleware below and their
+    process_view / process_exception hooks run as usual. The middleware is
+    sync only: under ASGI Django calls it in a thread, and sync views below
+    it run in that same thread, so the profiler samples the view.
+    """
+
+    sync_capable = True
+    async_capable = False
+
+    def __init__(self, get_response):
+        if not settings.EXCEL_SLOW_REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self._profiled(request):
+            return self.get_response(request)
+
+        profiler = RequestProfiler(settings.EXCEL_SLOW_REQUEST_PROFILE_INTERVAL)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+        duration = time.perf_counter() - started
+
+        if duration >= settings.EXCEL_SLOW_REQUEST_SECONDS:
+            try:
+                self._save_profile(request, response, profiler, duration)
+            except Exception as e:
+                print(f"Error saving slow request profile for {request.path}: {e}")
+        return response
+
+    @staticmethod
+    def _profiled(request):
+        try:
+            match = resolve(request.path_info, getattr(request, 'urlconf', None))
+        except Resolver404:
+            return False
+        # Async views (progress streams) mostly wait; nothing to profile
+        return match.view_name in settings.EXCEL_SLOW_REQUEST_VIEWS and not iscoroutinefunction(match.func)
+
+    def _save_profile(self, request, response, profiler, duration):
+        from .models import SlowRequestProfile
+        from .utils import cleanup_old_instances
+
+        conversion = self._existing(getattr(request, 'conversion_history', None))
+        uploaded_file = self._existing(getattr(request, 'uploaded_file_record', None))
+        if uploaded_file is None and conversion is not None:
+            uploaded_file = conversion.uploaded_file
+
+        record = SlowRequestProfile(
+            method=request.method,
+            path=request.path[:255],
+            status_code=response.status_code,
+            duration=round(duration, 3),
+            profiler=profiler.engine,
+            top_functions=profiler.top_functions(),
+            request_info=self._request_info(request),
+            uploaded_file=uploaded_file,
+            conversion=conversion,
+        )
+        extension, content = profiler.export()
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        record.profile_file.save(f'profile_{timestamp}{extension}', ContentFile(content), save=False)
+        record.save()
+
+        cleanup_old_instances(SlowRequestProfile, max_instances=settings.EXCEL_SLOW_REQUEST_MAX_PROFILES)
+
+    @staticmethod
+    def _existing(instance):
+        """The instance, unless it was deleted (failed upload, cleanup of old records)"""
+        if instance is None or instance.pk is None:
+            return None
+        return instance if type(instance).objects.filter(pk=instance.pk).exists() else None
+
+    @staticmethod
+    def _request_info(request):
+        info = {}
+        if request.content_type == 'multipart/form-data':
+            info['files'] = [{'name': f.name, 'size': f.size} for f in request.FILES.values()]
+        elif request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                info.update({name: data[name] for name in PROFILED_PARAMETERS if name in data})
+        trace_id = current_trace_id()
+        if trace_id:
+            info['trace_id'] = trace_id
+        return info
@@ -0,0 +1,45 @@
+# Generated by Django 6.0.1 on 2026-10-19 17:54
+
+from django.db import migrations, models
+
+
+def backfill_columns_count(apps, schema_editor):
+    ConversionHistory = apps.get_model('tool', 'ConversionHistory')
+    for conversion in ConversionHistory.objects.only('id', 'columns_selected').iterator():
+        ConversionHistory.objects.filter(id=conversion.id).update(
+            columns_count=len(conversion.columns_selected or [])
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0003_remove_conversionhistory_client_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='columns_count',
+            field=models.IntegerField(default=0, help_text='Number of columns kept (denormalized from columns_selected)'),
+        ),
+        migrations.RunPython(backfill_columns_count, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='conversionhistory',
+            name='output_csv_path',
+            field=models.FileField(upload_to='outputs/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file_path',
+            field=models.FileField(upload_to='uploads/%Y/%m/%d/'),
+        ),
+        migrations.AddIndex(
+            model_name='conversionhistory',
+            index=models.Index(fields=['-conversion_timestamp', '-id'], name='conversion_timestamp_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['-upload_timestamp'], name='upload_timestamp_idx'),
+        ),
+    ]
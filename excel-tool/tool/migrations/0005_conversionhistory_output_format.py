@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-19 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0004_history_indexes_and_columns_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='output_format',
+            field=models.CharField(choices=[('csv', 'CSV'), ('parquet', 'Parquet'), ('feather', 'Arrow IPC / Feather'), ('ndjson', 'JSON Lines')], default='csv', max_length=10),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 6.1.2 on 2026-10-19 18:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0005_conversionhistory_output_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='delta_base',
+            field=models.ForeignKey(blank=True, help_text='Conversion this delta was computed against', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deltas', to='tool.conversionhistory'),
+        ),
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='delta_stats',
+            field=models.JSONField(blank=True, help_text='Added/changed/removed row counts when the output is a delta', null=True),
+        ),
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='fingerprint_index',
+            field=models.FileField(blank=True, help_text='Compressed row fingerprints (see delta.py)', upload_to='fingerprints/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='key_columns',
+            field=models.JSONField(blank=True, default=list, help_text='Columns identifying a row when comparing versions'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0006_conversionhistory_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='column_profile',
+            field=models.JSONField(blank=True, help_text='Per-column statistics of the output (see profiling.py)', null=True),
+        ),
+    ]
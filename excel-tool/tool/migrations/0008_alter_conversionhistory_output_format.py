@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0007_conversionhistory_column_profile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversionhistory',
+            name='output_format',
+            field=models.CharField(choices=[('csv', 'CSV'), ('parquet', 'Parquet'), ('feather', 'Arrow IPC / Feather'), ('ndjson', 'JSON Lines'), ('xlsx', 'Excel (.xlsx)')], default='csv', max_length=10),
+        ),
+    ]
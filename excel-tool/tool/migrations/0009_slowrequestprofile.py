@@ -0,0 +1,36 @@
+# Generated by Django 6.1.2 on 2026-10-19 18:57
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0008_alter_conversionhistory_output_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowRequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('status_code', models.IntegerField()),
+                ('duration', models.FloatField(help_text='Time spent in the view, in seconds')),
+                ('profiler', models.CharField(choices=[('pyinstrument', 'pyinstrument (sampling)'), ('cprofile', 'cProfile')], max_length=20)),
+                ('top_functions', models.JSONField(default=list, help_text='Functions with the most self time (see cpuprofile.py)')),
+                ('profile_file', models.FileField(help_text='Full profile (pyinstrument HTML or cProfile .prof)', upload_to='profiles/%Y/%m/%d/')),
+                ('request_info', models.JSONField(blank=True, default=dict, help_text='Upload names and sizes, sheets and output format of the request')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('conversion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='slow_profiles', to='tool.conversionhistory')),
+                ('uploaded_file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='slow_profiles', to='tool.uploadedfile')),
+            ],
+            options={
+                'ordering': ['-created'],
+                'indexes': [models.Index(fields=['-created'], name='slow_profile_created_idx')],
+            },
+        ),
+    ]
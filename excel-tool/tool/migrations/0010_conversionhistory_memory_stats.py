@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-19 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0009_slowrequestprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionhistory',
+            name='memory_stats',
+            field=models.JSONField(blank=True, help_text='Peak memory by stage and memory-to-file-size ratio (see memory.py)', null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.1.2 on 2026-10-19 19:09
+
+import django.core.validators
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0010_conversionhistory_memory_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversionProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('filename_pattern', models.CharField(blank=True, help_text='Upload names this profile applies to, case-insensitive glob (e.g. HKKSZFIL_回収情報*.xls)', max_length=255)),
+                ('header_fingerprint', models.CharField(blank=True, help_text='Digest of the header row: workbooks with the same header match whatever their name', max_length=40)),
+                ('sheet_names', models.JSONField(blank=True, default=list, help_text='Sheets to convert (empty = the first sheet)')),
+                ('skip_rows', models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)])),
+                ('columns', models.JSONField(default=list, help_text='Header names of the columns to keep, in output order')),
+                ('dtypes', models.JSONField(blank=True, default=dict, help_text='Type of each column: text, category, integer, float, datetime or boolean (default text)')),
+                ('output_format', models.CharField(choices=[('csv', 'CSV'), ('parquet', 'Parquet'), ('feather', 'Arrow IPC / Feather'), ('ndjson', 'JSON Lines'), ('xlsx', 'Excel (.xlsx)')], default='csv', max_length=10)),
+                ('use_count', models.IntegerField(default=0)),
+                ('last_used', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
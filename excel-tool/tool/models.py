@@ -1,7 +1,11 @@
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.utils import timezone
 import json
 
+from .exporters import OUTPUT_FORMAT_CHOICES
+
 
 class UploadedFile(models.Model):
     """Track uploaded Excel files"""
@@ -12,6 +16,9 @@ class UploadedFile(models.Model):
     
     class Meta:
         ordering = ['-upload_timestamp']
+        indexes = [
+            models.Index(fields=['-upload_timestamp'], name='upload_timestamp_idx'),
+        ]
     
     def __str__(self):
         return f"{self.original_filename} ({self.upload_timestamp.strftime('%Y-%m-%d %H:%M')})"
@@ -27,15 +34,109 @@ class ConversionHistory(models.Model):
     uploaded_file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='conversions')
     columns_selected = models.JSONField(help_text="List of column names that were kept")
     columns_removed = models.JSONField(help_text="List of column names that were removed")
+    columns_count = models.IntegerField(default=0, help_text="Number of columns kept (denormalized from columns_selected)")
     output_csv_path = models.FileField(upload_to='outputs/%Y/%m/%d/')
+    output_format = models.CharField(max_length=10, choices=OUTPUT_FORMAT_CHOICES, default='csv')
     conversion_timestamp = models.DateTimeField(default=timezone.now)
     rows_processed = models.IntegerField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='success')
     error_message = models.TextField(blank=True, null=True)
+    key_columns = models.JSONField(default=list, blank=True, help_text="Columns identifying a row when comparing versions")
+    fingerprint_index = models.FileField(upload_to='fingerprints/%Y/%m/%d/', blank=True, help_text="Compressed row fingerprints (see delta.py)")
+    delta_base = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='deltas', help_text="Conversion this delta was computed against")
+    delta_stats = models.JSONField(null=True, blank=True, help_text="Added/changed/removed row counts when the output is a delta")
+    column_profile = models.JSONField(null=True, blank=True, help_text="Per-column statistics of the output (see profiling.py)")
+    memory_stats = models.JSONField(null=True, blank=True, help_text="Peak memory by stage and memory-to-file-size ratio (see memory.py)")
     
     class Meta:
         ordering = ['-conversion_timestamp']
         verbose_name_plural = "Conversion histories"
+        indexes = [
+            # Matches the keyset pagination order of the history API
+            models.Index(fields=['-conversion_timestamp', '-id'], name='conversion_timestamp_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.uploaded_file.original_filename} - {self.conversion_timestamp.strftime('%Y-%m-%d %H:%M')}"
+    
+    def save(self, *args, **kwargs):
+        self.columns_count = len(self.columns_selected or [])
+        super().save(*args, **kwargs)
+
+
+class SlowRequestProfile(models.Model):
+    """CPU profile of a conversion request slower than EXCEL_SLOW_REQUEST_SECONDS"""
+    PROFILER_CHOICES = [
+        ('pyinstrument', 'pyinstrument (sampling)'),
+        ('cprofile', 'cProfile'),
+    ]
+    
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    status_code = models.IntegerField()
+    duration = models.FloatField(help_text="Time spent in the view, in seconds")
+    profiler = models.CharField(max_length=20, choices=PROFILER_CHOICES)
+    top_functions = models.JSONField(default=list, help_text="Functions with the most self time (see cpuprofile.py)")
+    profile_file = models.FileField(upload_to='profiles/%Y/%m/%d/', help_text="Full profile (pyinstrument HTML or cProfile .prof)")
+    request_info = models.JSONField(default=dict, blank=True, help_text="Upload names and sizes, sheets and output format of the request")
+    uploaded_file = models.ForeignKey(UploadedFile, null=True, blank=True, on_delete=models.SET_NULL, related_name='slow_profiles')
+    conversion = models.ForeignKey(ConversionHistory, null=True, blank=True, on_delete=models.SET_NULL, related_name='slow_profiles')
+    created = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['-created'], name='slow_profile_created_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration:.1f}s, {self.created.strftime('%Y-%m-%d %H:%M')})"
+
+
+class ConversionProfile(models.Model):
+    """Saved conversion settings of a recurring workbook layout (see conversion_profiles.py)"""
+    COLUMN_TYPE_CHOICES = [
+        ('text', 'Text'),
+        ('category', 'Category'),
+        ('integer', 'Integer'),
+        ('float', 'Float'),
+        ('datetime', 'Date/time'),
+        ('boolean', 'Boolean'),
+    ]
+    
+    name = models.CharField(max_length=100, unique=True)
+    filename_pattern = models.CharField(max_length=255, blank=True, help_text="Upload names this profile applies to, case-insensitive glob (e.g. HKKSZFIL_回収情報*.xls)")
+    header_fingerprint = models.CharField(max_length=40, blank=True, help_text="Digest of the header row: workbooks with the same header match whatever their name")
+    sheet_names = models.JSONField(default=list, blank=True, help_text="Sheets to convert (empty = the first sheet)")
+    skip_rows = models.IntegerField(default=0, validators=[MinValueValidator(0), MaxValueValidator(100)])
+    columns = models.JSONField(default=list, help_text="Header names of the columns to keep, in output order")
+    dtypes = models.JSONField(default=dict, blank=True, help_text="Type of each column: text, category, integer, float, datetime or boolean (default text)")
+    output_format = models.CharField(max_length=10, choices=OUTPUT_FORMAT_CHOICES, default='csv')
+    use_count = models.IntegerField(default=0)
+    last_used = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def __str__(self):
+        return self.name
+    
+    def clean(self):
+        if not self.filename_pattern and not self.header_fingerprint:
+            raise ValidationError('Set a filename pattern or a header fingerprint, or the profile never matches.')
+        if not isinstance(self.sheet_names, list) or not all(isinstance(name, str) for name in self.sheet_names):
+            raise ValidationError({'sheet_names': 'Expected a list of sheet names.'})
+        if (not isinstance(self.columns, list) or not self.columns
+                or not all(isinstance(column, str) for column in self.columns)):
+            raise ValidationError({'columns': 'Expected a non-empty list of column names.'})
+        if len(set(self.columns)) != len(self.columns):
+            raise ValidationError({'columns': 'Column names must be unique.'})
+        if not isinstance(self.dtypes, dict):
+            raise ValidationError({'dtypes': 'Expected an object mapping column names to types.'})
+        types = {choice for choice, _ in self.COLUMN_TYPE_CHOICES}
+        for column, column_type in self.dtypes.items():
+            if column not in self.columns:
+                raise ValidationError({'dtypes': f'{column} is not one of the columns.'})
+            if column_type not in types:
+                raise ValidationError({'dtypes': f'Unknown type {column_type} for {column}.'})
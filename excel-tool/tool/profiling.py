@@ -0,0 +1,269 @@
+import math
+from datetime import date, datetime, time, timedelta
+
+
+# HyperLogLog registers (2 ** precision); ~1.6% standard error at 12
+HLL_PRECISION = 12
+
+# Counters of the heavy-hitters sketch, and how many top values are reported
+TOP_VALUES_CAPACITY = 64
+TOP_VALUES_REPORTED = 5
+
+# Longest text kept for min/max and top values in the profile
+MAX_VALUE_LENGTH = 100
+
+
+class HyperLogLog:
+    """
+    Approximate distinct count of a stream of 64-bit hashes
+
+    Adding a hash twice does not change the sketch, so only the distinct
+    values of each chunk need to be hashed.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        import numpy as np
+
+        # The remaining hash bits must fit a float64 mantissa (see add)
+        if not 11 <= precision <= 18:
+            raise ValueError('HyperLogLog precision must be between 11 and 18')
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        """Add a numpy array of uint64 hashes"""
+        import numpy as np
+
+        if len(hashes) == 0:
+            return
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        rest_bits = 64 - self.precision
+        index = (hashes >> np.uint64(rest_bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << rest_bits) - 1)
+        # Position of the leftmost 1 bit; frexp is exact for up to 53 bits
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (rest_bits + 1 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def count(self):
+        """Estimated number of distinct hashes added"""
+        import numpy as np
+
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class SpaceSaving:
+    """
+    Heavy-hitters (top values) sketch with a fixed number of counters
+
+    Chunks are summarized with exact counts and merged into the sketch as
+    mergeable summaries: a value missing from one side is assumed to have
+    that side's smallest count, which bounds the error of every count.
+    """
+
+    def __init__(self, capacity=TOP_VALUES_CAPACITY):
+        self.capacity = capacity
+        self.counters = {}  # value -> [count, error]
+        self.overflowed = False
+
+    def _floor(self):
+        """Count a value that is not tracked may have"""
+        if len(self.counters) < self.capacity and not self.overflowed:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def update(self, counts):
+        """
+        Merge the exact value counts of a chunk
+
+        Args:
+            counts: pandas.Series of value -> count, sorted by count descending
+        """
+        floor = self._floor()
+        if len(counts) > self.capacity:
+            # Values beyond the top ones count at most as much as the first left out
+            chunk_floor = int(counts.iloc[self.capacity])
+            counts = counts.iloc[:self.capacity]
+            self.overflowed = True
+        else:
+            chunk_floor = 0
+
+        merged = {}
+        for value, count in zip(counts.index, counts.to_numpy()):
+            tracked = self.counters.get(value)
+            if tracked is None:
+                merged[value] = [int(count) + floor, floor]
+            else:
+                merged[value] = [tracked[0] + int(count), tracked[1]]
+        for value, (count, error) in self.counters.items():
+            if value not in merged:
+                merged[value] = [count + chunk_floor, error + chunk_floor]
+
+        if len(merged) > self.capacity:
+            self.overflowed = True
+            merged = dict(sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:self.capacity])
+        self.counters = merged
+
+    def top(self, n=TOP_VALUES_REPORTED):
+        """The n most frequent values as (value, count, error), count being an upper bound"""
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(value, count, error) for value, (count, error) in ranked]
+
+
+def _json_value(value):
+    """A profile value (min/max/top value) in a JSON-serializable form"""
+    import numpy as np
+
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return str(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    text = str(value)
+    return text[:MAX_VALUE_LENGTH] + '…' if len(text) > MAX_VALUE_LENGTH else text
+
+
+_INFERRED_TYPES = {
+    'string': 'string',
+    'bytes': 'string',
+    'integer': 'integer',
+    'floating': 'float',
+    'mixed-integer-float': 'float',
+    'decimal': 'float',
+    'boolean': 'boolean',
+    'datetime': 'datetime',
+    'datetime64': 'datetime',
+    'date': 'date',
+    'time': 'time',
+    'timedelta': 'duration',
+    'timedelta64': 'duration',
+    'empty': None,
+}
+
+
+def _value_type(series, values):
+    """Profile type of a column chunk, from its dtype or its distinct values"""
+    from pandas.api import types as ptypes
+
+    dtype = series.dtype
+    if ptypes.is_bool_dtype(dtype):
+        return 'boolean'
+    if ptypes.is_integer_dtype(dtype):
+        return 'integer'
+    if ptypes.is_float_dtype(dtype):
+        return 'float'
+    if ptypes.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    if ptypes.is_timedelta64_dtype(dtype):
+        return 'duration'
+    return _INFERRED_TYPES.get(ptypes.infer_dtype(values, skipna=True), 'mixed')
+
+
+def _combined_type(first, second):
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+    if {first, second} == {'integer', 'float'}:
+        return 'float'
+    return 'mixed'
+
+
+class ColumnProfile:
+    """Null count, type, min/max, distinct count and top values of one column"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.null_count = 0
+        self.type = None
+        self.min = None
+        self.max = None
+        self.ordered = True
+        self.distinct = HyperLogLog()
+        self.top_values = SpaceSaving()
+
+    def update(self, series):
+        import pandas as pd
+        from pandas.util import hash_pandas_object
+
+        # One hash-based pass: every statistic below works on the chunk's
+        # distinct values and their counts
+        counts = series.value_counts(dropna=True, sort=True)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Unused categories are listed with a zero count
+            counts = counts[counts > 0]
+            counts.index = counts.index.astype(series.dtype.categories.dtype)
+        non_null = int(counts.sum())
+        self.rows += len(series)
+        self.null_count += len(series) - non_null
+        if not non_null:
+            return
+
+        values = counts.index
+        self.type = _combined_type(self.type, _value_type(series, values))
+        self.distinct.add(hash_pandas_object(values, index=False).to_numpy())
+        self.top_values.update(counts)
+
+        if self.ordered:
+            try:
+                low, high = values.min(), values.max()
+                self.min = low if self.min is None else min(self.min, low)
+                self.max = high if self.max is None else max(self.max, high)
+            except TypeError:
+                # Values of different types (e.g. numbers and text)
+                self.ordered = False
+                self.min = self.max = None
+
+    def result(self):
+        # While no counter was evicted the sketch holds every value exactly
+        exact = not self.top_values.overflowed
+        return {
+            'name': self.name,
+            'type': self.type,
+            'count': self.rows - self.null_count,
+            'null_count': self.null_count,
+            'null_ratio': round(self.null_count / self.rows, 4) if self.rows else 0.0,
+            'min': _json_value(self.min),
+            'max': _json_value(self.max),
+            'distinct': len(self.top_values.counters) if exact else self.distinct.count(),
+            'distinct_exact': exact,
+            'top_values': [
+                {'value': _json_value(value), 'count': count, 'error': error}
+                for value, count, error in self.top_values.top()
+            ],
+        }
+
+
+class TableProfile:
+    """
+    Per-column profile accumulated from the chunks an output is written in
+
+    Pass it as profile= to exporters.write_dataframe or merge.merge_sheets to
+    compute it in the same pass that writes the output.
+    """
+
+    def __init__(self):
+        self.columns = []
+
+    def update(self, chunk):
+        """Add a DataFrame chunk (columns are matched by position)"""
+        if not self.columns:
+            self.columns = [ColumnProfile(str(column)) for column in chunk.columns]
+        for position, column in enumerate(self.columns):
+            column.update(chunk.iloc[:, position])
+
+    def result(self):
+        """List of column profiles (see ColumnProfile.result)"""
+        return [column.result() for column in self.columns]
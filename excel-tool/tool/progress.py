@@ -0,0 +1,235 @@
+import asyncio
+import json
+import re
+import time
+
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+
+# Job state is read and written by several processes (web workers, the
+# conversion worker pool), so it lives in the 'shared' cache (see settings)
+shared_cache = ConnectionProxy(caches, 'shared')
+
+PROGRESS_CACHE_TIMEOUT = 60 * 60
+
+# Minimum delay between two progress updates written to the cache
+PUBLISH_INTERVAL = 0.25
+
+# Server-Sent Events stream: cache polling interval, keep-alive interval,
+# how long to wait for a job that has not started, and the overall limit
+POLL_INTERVAL = 0.5
+KEEPALIVE_INTERVAL = 15
+START_TIMEOUT = 60
+STREAM_TIMEOUT = 60 * 60
+
+JOB_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+
+class ConversionCancelled(Exception):
+    """Raised at a chunk boundary when the user cancelled the conversion"""
+
+
+def valid_job_id(job_id):
+    return bool(job_id) and bool(JOB_ID_RE.match(str(job_id)))
+
+
+def _state_key(job_id):
+    return f'progress:state:{job_id}'
+
+
+def _cancel_key(job_id):
+    return f'progress:cancel:{job_id}'
+
+
+def _link_key(job_id):
+    return f'progress:link:{job_id}'
+
+
+def _resolve(job_id):
+    return shared_cache.get(_link_key(job_id)) or job_id
+
+
+def link_job(job_id, target_job_id):
+    """
+    Make a job follow another one: a duplicate request attached to a running
+    conversion (see singleflight.py) reports and cancels that conversion
+    """
+    if valid_job_id(job_id) and valid_job_id(target_job_id) and job_id != target_job_id:
+        shared_cache.set(_link_key(job_id), target_job_id, PROGRESS_CACHE_TIMEOUT)
+
+
+def get_progress(job_id):
+    """Return the last published state of a job (None if unknown)"""
+    return shared_cache.get(_state_key(_resolve(job_id)))
+
+
+def request_cancel(job_id):
+    """Ask a running conversion to stop at its next chunk boundary"""
+    shared_cache.set(_cancel_key(_resolve(job_id)), True, PROGRESS_CACHE_TIMEOUT)
+
+
+class ProgressTracker:
+    """
+    Publish the progress of one conversion and check for cancellation
+
+    Work is counted in rows: each row is parsed once and written once, so the
+    ETA is extrapolated from the share of (estimated) rows handled so far.
+    Without a job id every method is a no-op, so views can always use one.
+    """
+
+    def __init__(self, job_id=None, sheet_rows=None):
+        """
+        Args:
+            job_id: Client-generated job id (None = don't track)
+            sheet_rows: dict of sheet name to estimated row count (from the
+                workbook inspector), used for the ETA
+        """
+        self.job_id = job_id if valid_job_id(job_id) else None
+        self.sheet_rows = sheet_rows or {}
+        self.sheet_names = []
+        self.started = time.monotonic()
+        self.last_publish = 0.0
+        self.state = {
+            'status': 'running',
+            'stage': 'starting',
+            'sheet_index': 0,
+            'sheet_count': 0,
+            'sheet_name': None,
+            'rows_parsed': 0,
+            'rows_written': 0,
+            'bytes_written': 0,
+            'elapsed': 0.0,
+            'eta': None,
+        }
+        self.done_rows = 0
+        self.sheet_parsed = 0
+        self.sheet_written = 0
+        self.sheet_bytes = 0
+        if self.job_id:
+            # A new run of the same job id starts uncancelled
+            shared_cache.delete(_cancel_key(self.job_id))
+            self.publish(force=True)
+
+    @property
+    def active(self):
+        return self.job_id is not None
+
+    def check_cancelled(self):
+        if self.job_id and shared_cache.get(_cancel_key(self.job_id)):
+            raise ConversionCancelled('Conversion cancelled')
+
+    def _total_rows(self):
+        names = self.sheet_names or list(self.sheet_rows)
+        return sum(self.sheet_rows.get(name) or 0 for name in names)
+
+    def publish(self, force=False):
+        if not self.job_id:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_publish < PUBLISH_INTERVAL:
+            return
+        self.last_publish = now
+
+        elapsed = now - self.started
+        total_work = 2 * self._total_rows()
+        done_work = self.done_rows + self.sheet_parsed + self.sheet_written
+        eta = None
+        if self.state['status'] == 'running' and total_work and done_work:
+            eta = round(max(elapsed * (total_work - done_work) / done_work, 0.0), 1)
+
+        self.state['elapsed'] = round(elapsed, 1)
+        self.state['eta'] = eta
+        shared_cache.set(_state_key(self.job_id), dict(self.state), PROGRESS_CACHE_TIMEOUT)
+
+    def queued(self, lane):
+        """Announce that the job waits for a conversion slot (see scheduler.py)"""
+        self.state.update({'stage': 'queued', 'lane': lane})
+        self.publish(force=True)
+
+    def admitted(self):
+        """The job got its slot: the ETA is extrapolated from here"""
+        self.started = time.monotonic()
+        self.state['stage'] = 'starting'
+        self.publish(force=True)
+
+    def start(self, sheet_names):
+        """Announce the sheets this job will process"""
+        self.state['sheet_count'] = len(sheet_names)
+        self.sheet_names = list(sheet_names)
+        self.publish(force=True)
+
+    def start_sheet(self, index, sheet_name):
+        """Move to sheet number index (0-based)"""
+        self.check_cancelled()
+        self.done_rows += self.sheet_parsed + self.sheet_written
+        self.sheet_parsed = self.sheet_written = self.sheet_bytes = 0
+        self.state.update({
+            'stage': 'parsing',
+            'sheet_index': index + 1,
+            'sheet_name': sheet_name,
+        })
+        self.publish(force=True)
+
+    def parsed(self, rows):
+        """Callback for readers: rows parsed so far in the current sheet"""
+        self.check_cancelled()
+        self.state['rows_parsed'] += rows - self.sheet_parsed
+        self.sheet_parsed = rows
+        self.publish()
+
+    def written(self, rows, bytes_written):
+        """Callback for writers: rows and bytes written so far for the current output"""
+        self.check_cancelled()
+        self.state['stage'] = 'writing'
+        self.state['rows_written'] += rows - self.sheet_written
+        self.state['bytes_written'] += bytes_written - self.sheet_bytes
+        self.sheet_written = rows
+        self.sheet_bytes = bytes_written
+        self.publish()
+
+    def finish(self, status='done', error=None):
+        self.state['status'] = status
+        self.state['stage'] = status
+        if error:
+            self.state['error'] = error
+        self.publish(force=True)
+
+
+async def progress_events(job_id):
+    """
+    Server-Sent Events for a job: one event per state change, until the job
+    finishes
+
+    The stream may be opened before the conversion request starts the job.
+    Reading the cache directly is fine here: cache lookups are short, and the
+    async cache API would queue behind the running conversion in the shared
+    sync thread.
+    """
+    started = time.monotonic()
+    last_sent = started
+    last_state = None
+
+    while True:
+        state = get_progress(job_id)
+        now = time.monotonic()
+
+        if state is not None and state != last_state:
+            yield f"data: {json.dumps(state)}\n\n"
+            last_state = state
+            last_sent = now
+            if state['status'] in FINISHED_STATUSES:
+                return
+        elif now - last_sent >= KEEPALIVE_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_sent = now
+
+        if state is None and now - started > START_TIMEOUT:
+            yield f"data: {json.dumps({'status': 'unknown'})}\n\n"
+            return
+        if now - started > STREAM_TIMEOUT:
+            return
+
+        await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,405 @@
+import os
+import re
+
+
+XLSX_SIGNATURE = b'PK\x03\x04'
+XLS_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# Rows streamed between two progress callbacks
+PROGRESS_EVERY_ROWS = 2000
+
+
+def is_file_object(source):
+    """True for an open file (e.g. an in-memory upload) rather than a path"""
+    return hasattr(source, 'read')
+
+
+def detect_excel_format(file_path):
+    """
+    Detect the workbook format from the file signature
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object (e.g. an
+            upload held in memory)
+
+    Returns:
+        'xlsx' for Office Open XML (ZIP) workbooks, 'xls' for BIFF/OLE2 workbooks
+    """
+    if is_file_object(file_path):
+        file_path.seek(0)
+        signature = file_path.read(8)
+        file_path.seek(0)
+        name = getattr(file_path, 'name', '') or ''
+    else:
+        with open(file_path, 'rb') as f:
+            signature = f.read(8)
+        name = str(file_path)
+
+    if signature.startswith(XLSX_SIGNATURE):
+        return 'xlsx'
+    if signature == XLS_SIGNATURE:
+        return 'xls'
+
+    # Fall back to the extension, the same way the upload form validates files
+    if name.lower().endswith('.xls'):
+        return 'xls'
+    return 'xlsx'
+
+
+def _xls_cell_value(cell, datemode):
+    """Convert an xlrd cell to the Python value pandas would produce"""
+    import xlrd
+
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+        return None
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        try:
+            value = xlrd.xldate.xldate_as_datetime(cell.value, datemode)
+        except Exception:
+            return cell.value
+        # Dates on the epoch day are times of day, as in pandas
+        if (value.year, value.month, value.day) == ((1904, 1, 1) if datemode else (1899, 12, 31)):
+            return value.time()
+        return value
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    if cell.ctype == xlrd.XL_CELL_ERROR:
+        return None
+    if cell.ctype == xlrd.XL_CELL_NUMBER and cell.value == int(cell.value):
+        return int(cell.value)
+    return cell.value
+
+
+def open_xls_book(file_path):
+    """
+    Open an .xls workbook memory-mapped, with on-demand sheet loading
+
+    Only the workbook globals (sheet list, shared strings, formats) are
+    decoded on open; each sheet's BIFF records are decoded when the sheet is
+    first read and released again by iter_sheet_rows. Pass the book to
+    iter_sheet_rows / read_sheet_streamed to read several sheets of one
+    request from a single handle, and call release_resources() when done.
+
+    Args:
+        file_path: Path to Excel file, or a file object (read into memory
+            instead of being mapped)
+
+    Returns:
+        xlrd Book for .xls files, None for .xlsx files (openpyxl's read-only
+        mode already loads one sheet at a time)
+    """
+    if detect_excel_format(file_path) != 'xls':
+        return None
+
+    import xlrd
+
+    if is_file_object(file_path):
+        file_path.seek(0)
+        return xlrd.open_workbook(file_contents=file_path.read(), on_demand=True)
+    return xlrd.open_workbook(file_path, on_demand=True, use_mmap=True)
+
+
+def _iter_xls_rows(book, sheet_name, max_rows):
+    loaded = book.sheet_loaded(sheet_name)
+    sheet = book.sheet_by_name(sheet_name)
+    try:
+        nrows = sheet.nrows if max_rows is None else min(sheet.nrows, max_rows)
+        for row_index in range(nrows):
+            yield tuple(_xls_cell_value(cell, book.datemode) for cell in sheet.row(row_index))
+    finally:
+        # Keep memory bounded by the sheet being read, not the whole workbook
+        if not loaded:
+            book.unload_sheet(sheet_name)
+
+
+def iter_sheet_rows(file_path, sheet_name, max_rows=None, book=None):
+    """
+    Stream raw cell values of a sheet row by row without loading the workbook
+
+    .xlsx files are read with openpyxl in read-only mode and .xls files with
+    xlrd on-demand loading, so only the requested sheet is decoded.
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet to read
+        max_rows: Stop after this many rows (None = read the whole sheet)
+        book: Book from open_xls_book to read from (None = open the file)
+
+    Yields:
+        tuple of cell values (None for empty cells)
+    """
+    if book is not None:
+        yield from _iter_xls_rows(book, sheet_name, max_rows)
+    elif detect_excel_format(file_path) == 'xls':
+        book = open_xls_book(file_path)
+        try:
+            yield from _iter_xls_rows(book, sheet_name, max_rows)
+        finally:
+            book.release_resources()
+    else:
+        import openpyxl
+
+        if is_file_object(file_path):
+            file_path.seek(0)
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+        try:
+            worksheet = workbook[sheet_name]
+            # The <dimension> written by some producers is stale (e.g. "A1");
+            # pd.read_excel ignores it too and reads every row
+            worksheet.reset_dimensions()
+            for row in worksheet.iter_rows(max_row=max_rows, values_only=True):
+                yield row
+        finally:
+            workbook.close()
+
+
+def file_signature(file_path):
+    """Return a (size, mtime) pair identifying the current contents of a file"""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _parser_cell(value):
+    """Convert a streamed cell to the value pandas' Excel readers pass to the parser"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def row_values(row):
+    """Values of a streamed row as passed to the parser, without its trailing empty cells"""
+    values = [_parser_cell(value) for value in row]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+
+def column_names(values):
+    """
+    Name columns from a header row the way pandas does ('Unnamed: N' for
+    blank cells, '.1', '.2', ... suffixes for repeated labels)
+
+    Args:
+        values: Header row cells as returned by row_values
+
+    Returns:
+        list of column names
+    """
+    names = []
+    seen = {}
+    for position, value in enumerate(values):
+        name = str(value) if value != '' else f'Unnamed: {position}'
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def column_position(names, column):
+    """
+    Position of a column in a header row named by column_names, or None
+
+    Blank cells at the end of a header row are dropped before naming it, but
+    pandas still names them 'Unnamed: N' when data rows extend past them.
+    """
+    if column in names:
+        return names.index(column)
+    match = re.fullmatch(r'Unnamed: (\d+)', column)
+    if match is not None and int(match.group(1)) >= len(names):
+        return int(match.group(1))
+    return None
+
+
+def read_sheet_streamed(file_path, sheet_name, skip_rows=0, row_filter=None, on_progress=None,
+                        progress_every=PROGRESS_EVERY_ROWS, book=None):
+    """
+    Stream a sheet into a DataFrame, optionally keeping only rows matching a filter
+
+    Rows are tested as they come out of the reader, so rejected rows are never
+    materialized. The kept rows go through the same parser pd.read_excel uses,
+    giving the same column names and dtypes as pd.read_excel.
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet to read
+        skip_rows: Number of rows to skip before the header row
+        row_filter: filters.RowFilter (None = keep all rows)
+        on_progress: Called with the number of data rows scanned so far every
+            progress_every rows; exceptions it raises (e.g. cancellation)
+            stop the read
+        progress_every: Rows between two on_progress calls
+        book: Book from open_xls_book to read from (None = open the file)
+
+    Returns:
+        tuple (pandas.DataFrame, dict with 'rows_scanned' and 'rows_kept')
+    """
+    from contextlib import closing
+
+    data = []
+    matches = None
+    header_seen = False
+    rows_scanned = 0
+
+    with closing(iter_sheet_rows(file_path, sheet_name, book=book)) as rows:
+        for index, row in enumerate(rows):
+            if index < skip_rows:
+                continue
+
+            values = row_values(row)
+
+            if not header_seen:
+                # Header row: name columns the way pandas does
+                header_seen = True
+                if row_filter is not None:
+                    matches = row_filter.bind(column_names(values))
+                data.append(values)
+                continue
+
+            rows_scanned += 1
+            if matches is None or matches(values):
+                data.append(values)
+            if on_progress is not None and rows_scanned % progress_every == 0:
+                on_progress(rows_scanned)
+
+    if on_progress is not None:
+        on_progress(rows_scanned)
+
+    if not data:
+        raise ValueError(f"Sheet {sheet_name} has no rows after skipping {skip_rows}")
+
+    df = frame_from_rows(data)
+    return df, {'rows_scanned': rows_scanned, 'rows_kept': len(df)}
+
+
+def frame_from_rows(data):
+    """
+    Parse streamed rows (row_values of the header row, then of the data rows)
+    into a DataFrame the way pd.read_excel does
+
+    Args:
+        data: Non-empty list of rows; trailing empty rows are removed from it
+
+    Returns:
+        pandas.DataFrame
+    """
+    from pandas.io.parsers import TextParser
+
+    # pd.read_excel drops trailing empty rows
+    while len(data) > 1 and not data[-1]:
+        data.pop()
+
+    width = max(len(values) for values in data)
+    data = [values + [''] * (width - len(values)) for values in data]
+
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def read_header(file_path, sheet_name, skip_rows=0, book=None):
+    """
+    Read only the header row of a sheet
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet
+        skip_rows: Number of rows above the header row
+        book: Book from open_xls_book to read from (None = open the file)
+
+    Returns:
+        list of column names (see column_names), empty when the sheet ends
+        above that row
+    """
+    from contextlib import closing
+
+    values = []
+    with closing(iter_sheet_rows(file_path, sheet_name, max_rows=skip_rows + 1, book=book)) as rows:
+        for index, row in enumerate(rows):
+            if index == skip_rows:
+                values = row_values(row)
+    return column_names(values)
+
+
+def read_sheet_columns(file_path, sheet_name, columns, skip_rows=0, row_filter=None, on_progress=None,
+                       progress_every=PROGRESS_EVERY_ROWS, book=None):
+    """
+    Stream some columns of a sheet into one list of values per column
+
+    Only the requested cells of each row are kept, and no type is inferred:
+    the caller converts each list to the column's known type. Blank and
+    trailing empty rows are handled like read_sheet_streamed.
+
+    Args:
+        file_path: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet to read
+        columns: Names of the columns to keep (as named by column_names)
+        skip_rows: Number of rows to skip before the header row
+        row_filter: filters.RowFilter, tested against the whole row (None =
+            keep all rows)
+        on_progress: Called with the number of data rows scanned so far every
+            progress_every rows
+        progress_every: Rows between two on_progress calls
+        book: Book from open_xls_book to read from (None = open the file)
+
+    Returns:
+        tuple (dict of column name -> list of values, None for empty cells;
+        dict with 'rows_scanned' and 'rows_kept')
+
+    Raises:
+        ValueError: If the sheet has no header row there, or it lacks some
+            of the columns
+    """
+    from contextlib import closing
+
+    data = {column: [] for column in columns}
+    positions = None
+    matches = None
+    rows_scanned = 0
+    rows_kept = 0
+    # Rows up to the last non-empty one (pd.read_excel drops trailing empty rows)
+    rows_through_last_filled = 0
+
+    with closing(iter_sheet_rows(file_path, sheet_name, book=book)) as rows:
+        for index, row in enumerate(rows):
+            if index < skip_rows:
+                continue
+
+            if positions is None:
+                # Header row: locate the requested columns
+                names = column_names(row_values(row))
+                missing = [column for column in columns if column_position(names, column) is None]
+                if missing:
+                    raise ValueError(f"Sheet {sheet_name} has no column {', '.join(missing)} "
+                                     f"after skipping {skip_rows} rows")
+                positions = [(data[column], column_position(names, column)) for column in columns]
+                if row_filter is not None:
+                    matches = row_filter.bind(names)
+                continue
+
+            rows_scanned += 1
+            if matches is None or matches([_parser_cell(value) for value in row]):
+                for values, position in positions:
+                    value = row[position] if position < len(row) else None
+                    if isinstance(value, float) and value.is_integer():
+                        value = int(value)
+                    elif value == '':
+                        value = None
+                    values.append(value)
+                rows_kept += 1
+                if any(value is not None and value != '' for value in row):
+                    rows_through_last_filled = rows_kept
+            if on_progress is not None and rows_scanned % progress_every == 0:
+                on_progress(rows_scanned)
+
+    if on_progress is not None:
+        on_progress(rows_scanned)
+
+    if positions is None:
+        raise ValueError(f"Sheet {sheet_name} has no rows after skipping {skip_rows}")
+
+    for values in data.values():
+        del values[rows_through_last_filled:]
+    return data, {'rows_scanned': rows_scanned, 'rows_kept': rows_through_last_filled}
@@ -0,0 +1,230 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .inspector import SHEET_BYTES_PER_CELL
+from .tracing import span
+
+
+LANES = ('fast', 'bulk')
+
+# Bytes of sheet XML / BIFF records per cell when a sheet's dimensions are
+# missing from its metadata, or implausible (see inspector.py)
+BYTES_PER_CELL = SHEET_BYTES_PER_CELL
+
+# How often a queued conversion re-checks for cancellation
+POLL_SECONDS = 0.25
+
+
+def estimate_cost(workbook_info, sheet_names=None):
+    """
+    Estimated cost of converting sheets of a workbook, in cells
+
+    Args:
+        workbook_info: Result of inspector.inspect_workbook
+        sheet_names: Sheets to convert (None = every sheet)
+
+    Returns:
+        int number of cells (at least 1)
+    """
+    cells = 0
+    for sheet in workbook_info['sheets']:
+        if sheet_names is not None and sheet['name'] not in sheet_names:
+            continue
+        if sheet['rows'] is not None and sheet['columns'] is not None:
+            cells += sheet['rows'] * sheet['columns']
+        else:
+            cells += (sheet.get('uncompressed_size') or workbook_info['uncompressed_size']) // BYTES_PER_CELL
+    return max(cells, 1)
+
+
+def lane_for(cost):
+    """'fast' for conversions of at most EXCEL_FAST_LANE_MAX_CELLS cells, else 'bulk'"""
+    return 'fast' if cost <= settings.EXCEL_FAST_LANE_MAX_CELLS else 'bulk'
+
+
+def client_id(request):
+    """Who a conversion is queued for: the logged-in user, or else the client address"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f"addr:{request.META.get('REMOTE_ADDR', '')}"
+
+
+class _Job:
+    def __init__(self, cost, client, lane):
+        self.cost = cost
+        self.client = client
+        self.lane = lane
+        self.enqueued = time.monotonic()
+
+
+class ConversionScheduler:
+    """
+    Admit conversions of this process into a fixed number of slots
+
+    Jobs in the 'fast' lane (see lane_for) may use any slot; 'bulk' jobs
+    leave fast_lane_slots free for them, so a small file never waits behind
+    a full set of huge ones. Among the queued jobs that fit a free slot, the
+    cheapest runs first, except that:
+
+    - waiting halves a job's effective cost every aging_seconds, so a large
+      job always gets its turn;
+    - each conversion a client is already running doubles, triples, ... the
+      effective cost of its queued jobs, so one client cannot fill the slots.
+    """
+
+    def __init__(self, slots, fast_lane_slots, aging_seconds):
+        self.slots = slots
+        self.bulk_slots = max(slots - fast_lane_slots, 1)
+        self.aging_seconds = aging_seconds
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._running = {lane: 0 for lane in LANES}
+        self._client_running = collections.Counter()
+
+    def _fits(self, job):
+        if sum(self._running.values()) >= self.slots:
+            return False
+        return job.lane == 'fast' or self._running['bulk'] < self.bulk_slots
+
+    def _priority(self, job, now):
+        age = (now - job.enqueued) / self.aging_seconds
+        return job.cost * 0.5 ** age * (1 + self._client_running[job.client])
+
+    def _next(self):
+        """The queued job to admit now (None = no queued job fits a free slot)"""
+        now = time.monotonic()
+        candidates = [job for job in self._waiting if self._fits(job)]
+        # min keeps the earliest job on ties: FIFO among equals
+        return min(candidates, key=lambda job: self._priority(job, now), default=None)
+
+    def acquire(self, job, check_cancelled=None):
+        """
+        Block until the job is admitted into a slot
+
+        Args:
+            job: _Job to admit
+            check_cancelled: Called while waiting; an exception it raises
+                (e.g. ConversionCancelled) takes the job out of the queue
+        """
+        with self._condition:
+            self._waiting.append(job)
+            try:
+                while self._next() is not job:
+                    self._condition.wait(POLL_SECONDS)
+                    if check_cancelled is not None:
+                        check_cancelled()
+            finally:
+                self._waiting.remove(job)
+            self._running[job.lane] += 1
+            self._client_running[job.client] += 1
+            # The next queued job may fit another free slot
+            self._condition.notify_all()
+
+    def release(self, job):
+        with self._condition:
+            self._running[job.lane] -= 1
+            self._client_running[job.client] -= 1
+            if not self._client_running[job.client]:
+                del self._client_running[job.client]
+            self._condition.notify_all()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """This process's scheduler (None when EXCEL_CONVERSION_SLOTS is 0: no limit)"""
+    global _scheduler
+    if not settings.EXCEL_CONVERSION_SLOTS:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ConversionScheduler(
+                settings.EXCEL_CONVERSION_SLOTS,
+                settings.EXCEL_FAST_LANE_SLOTS,
+                settings.EXCEL_SCHEDULER_AGING_SECONDS,
+            )
+    return _scheduler
+
+
+def _record(metric, method, *args, **labels):
+    # Scheduling must not fail because the metrics cache is unavailable
+    try:
+        getattr(metric, method)(*args, **labels)
+    except Exception as e:
+        print(f"Error recording {metric.name}: {e}")
+
+
+class ConversionSlot:
+    """
+    Context manager running a conversion in a scheduler slot
+
+    Entering it waits in the queue (reported as the 'queued' stage of the
+    job's progress; cancelling the job leaves the queue); leaving it frees
+    the slot.
+    """
+
+    def __init__(self, cost, client, tracker=None):
+        self.scheduler = get_scheduler()
+        self.cost = cost
+        self.tracker = tracker
+        self.job = _Job(cost, client, lane_for(cost))
+        self.wait_seconds = None
+
+    @property
+    def lane(self):
+        return self.job.lane
+
+    def __enter__(self):
+        self.job.enqueued = time.monotonic()
+        check_cancelled = None
+        if self.tracker is not None:
+            self.tracker.queued(self.lane)
+            check_cancelled = self.tracker.check_cancelled
+
+        if self.scheduler is not None:
+            _record(metrics.queue_depth, 'inc', lane=self.lane)
+            try:
+                with span('queue.wait', lane=self.lane, cost=self.cost):
+                    self.scheduler.acquire(self.job, check_cancelled)
+            finally:
+                _record(metrics.queue_depth, 'dec', lane=self.lane)
+
+        self.wait_seconds = time.monotonic() - self.job.enqueued
+        _record(metrics.queue_wait_seconds, 'observe', self.wait_seconds, lane=self.lane)
+        _record(metrics.conversions_running, 'inc', lane=self.lane)
+        if self.tracker is not None:
+            self.tracker.admitted()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.scheduler is not None:
+            self.scheduler.release(self.job)
+        _record(metrics.conversions_running, 'dec', lane=self.lane)
+        return False
+
+    def result(self):
+        return {'lane': self.lane, 'cost': self.cost, 'wait_seconds': round(self.wait_seconds or 0.0, 3)}
+
+
+def conversion_slot(request, workbook_info, sheet_names=None, tracker=None):
+    """
+    Slot for converting sheets of a workbook, queued by estimated cost for
+    the request's client (see ConversionScheduler)
+
+    Args:
+        request: The conversion request
+        workbook_info: Result of inspector.inspect_workbook
+        sheet_names: Sheets that will be converted (None = every sheet)
+        tracker: ProgressTracker of the conversion (None = not tracked)
+
+    Returns:
+        ConversionSlot context manager
+    """
+    return ConversionSlot(estimate_cost(workbook_info, sheet_names), client_id(request), tracker)
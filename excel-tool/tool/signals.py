@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .history import invalidate_history_cache
+from .models import ConversionHistory
+
+
+@receiver(post_save, sender=ConversionHistory)
+@receiver(post_delete, sender=ConversionHistory)
+def conversion_history_changed(sender, **kwargs):
+    """Invalidate cached history pages when a conversion is created, updated or deleted"""
+    invalidate_history_cache()
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+from .progress import link_job, shared_cache as cache
+
+
+# Duplicates within one process wait on the in-memory _flights registry;
+# duplicates reaching another server process are held back by a lease in
+# the 'shared' cache (like progress.py) and read the outcome from there.
+# Taking the lease is only atomic with Redis: with the default file cache
+# two processes receiving the same request at the same instant may both run
+# it, later duplicates and retries still attach.
+# Successful outcomes are replayed to retries for RESULT_TIMEOUT; other
+# outcomes (errors, cancellation) only reach duplicates that were already
+# waiting, and are kept just long enough for them to read it.
+RESULT_TIMEOUT = 10 * 60
+FAILED_RESULT_TIMEOUT = 30
+
+# Upper bound of a conversion: the in-flight marker of a server process that
+# died stops blocking duplicates after this long
+LEASE_TIMEOUT = 60 * 60
+
+# How often a duplicate waiting on another server process checks for the outcome
+WAIT_POLL_INTERVAL = 0.25
+
+IDEMPOTENCY_KEY_RE = re.compile(r'^[\x21-\x7e]{1,255}$')
+
+
+class IdempotencyKeyError(ValueError):
+    """Invalid Idempotency-Key header, or a key reused with other parameters"""
+
+
+def request_key(request, params):
+    """
+    Identify the conversion a request asks for
+
+    Args:
+        request: HttpRequest (its path and Idempotency-Key header are used)
+        params: Request parameters; job_id is ignored, since every click or
+            retry gets a new one
+
+    Returns:
+        tuple (key, fingerprint): fingerprint digests the endpoint and the
+        parameters; key is the Idempotency-Key header when sent, otherwise
+        the fingerprint
+
+    Raises:
+        IdempotencyKeyError: If the header is not 1-255 printable ASCII characters
+    """
+    params = {name: value for name, value in params.items() if name != 'job_id'}
+    fingerprint = hashlib.sha256(
+        json.dumps([request.path, params], sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+    header = request.headers.get('Idempotency-Key')
+    if header is None:
+        return fingerprint, fingerprint
+    if not IDEMPOTENCY_KEY_RE.match(header):
+        raise IdempotencyKeyError('Invalid Idempotency-Key header')
+    return hashlib.sha256(f'{request.path}\n{header}'.encode('utf-8')).hexdigest(), fingerprint
+
+
+def _result_key(key):
+    return f'singleflight:result:{key}'
+
+
+def _lease_key(key):
+    return f'singleflight:lease:{key}'
+
+
+def _check_fingerprint(fingerprint, expected):
+    if fingerprint != expected:
+        raise IdempotencyKeyError('Idempotency-Key was already used with different parameters')
+
+
+class _Flight:
+    """A conversion running in this process, and the duplicates waiting for it"""
+
+    def __init__(self, fingerprint, job_id):
+        self.fingerprint = fingerprint
+        self.job_id = job_id
+        self.outcome = None
+        self.done = threading.Event()
+
+
+# Per process: other processes only see the lease and outcome in the cache
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def run_once(key, fingerprint, job_id, func):
+    """
+    Run func() once for all requests with the same key
+
+    The first request runs func(). Concurrent duplicates, in this process or
+    (through the shared cache) in another one, wait for it and share its outcome;
+    retries arriving after it finished get the stored outcome.
+
+    Args:
+        key, fingerprint: From request_key
+        job_id: Progress job id of this request; a duplicate's job id is
+            linked to the running conversion's, so its progress stream and
+            cancel button follow the shared conversion
+        func: Callable returning the outcome, a dict with the response
+            'status' and 'content'; only 200 outcomes are kept for retries
+
+    Returns:
+        tuple (outcome, shared): shared is True when the outcome is another
+        request's
+
+    Raises:
+        IdempotencyKeyError: If the key was used with different parameters
+    """
+    record = cache.get(_result_key(key))
+    if record is not None and record['outcome']['status'] == 200:
+        _check_fingerprint(fingerprint, record['fingerprint'])
+        return record['outcome'], True
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight(fingerprint, job_id)
+
+    if not leader:
+        _check_fingerprint(fingerprint, flight.fingerprint)
+        link_job(job_id, flight.job_id)
+        flight.done.wait()
+        if flight.outcome is None:
+            raise RuntimeError('The conversion this request was attached to failed')
+        return flight.outcome, True
+
+    try:
+        flight.outcome, shared = _run_leased(key, fingerprint, job_id, func)
+        return flight.outcome, shared
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _run_leased(key, fingerprint, job_id, func):
+    """Run func() unless another server process already runs this conversion"""
+    lease = {'fingerprint': fingerprint, 'job_id': job_id}
+    while not cache.add(_lease_key(key), lease, LEASE_TIMEOUT):
+        other = cache.get(_lease_key(key))
+        if other is not None:
+            _check_fingerprint(fingerprint, other['fingerprint'])
+            link_job(job_id, other['job_id'])
+        record = _wait_for_result(key)
+        if record is not None:
+            _check_fingerprint(fingerprint, record['fingerprint'])
+            return record['outcome'], True
+        # The other process went away without an outcome: run it here
+
+    try:
+        outcome = func()
+        timeout = RESULT_TIMEOUT if outcome['status'] == 200 else FAILED_RESULT_TIMEOUT
+        cache.set(_result_key(key), {'fingerprint': fingerprint, 'outcome': outcome}, timeout)
+        return outcome, False
+    finally:
+        cache.delete(_lease_key(key))
+
+
+def _wait_for_result(key):
+    """Outcome stored by the lease holder (None if it released the lease without one)"""
+    while True:
+        record = cache.get(_result_key(key))
+        if record is not None:
+            return record
+        if cache.get(_lease_key(key)) is None:
+            # The outcome is stored before the lease is released
+            return cache.get(_result_key(key))
+        time.sleep(WAIT_POLL_INTERVAL)
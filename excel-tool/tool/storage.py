@@ -0,0 +1,186 @@
+import hashlib
+import os
+import shutil
+import time
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Blobs this recent may be about to be linked by a save in progress
+ORPHAN_MIN_AGE_SECONDS = 60 * 60
+
+# Extended attribute holding a blob's digest: it belongs to the inode, so
+# every name linked to the blob has it (where the file system supports it)
+DIGEST_XATTR = 'user.sha256'
+
+
+def hash_file(content):
+    """
+    Compute the SHA-256 hex digest of a Django File without loading it at once
+
+    Args:
+        content: django.core.files.File (or UploadedFile)
+
+    Returns:
+        Hex digest string
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks(chunk_size=HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def hash_path(file_path):
+    """Compute the SHA-256 hex digest of a file on disk"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _tag_digest(file_path, digest):
+    try:
+        os.setxattr(file_path, DIGEST_XATTR, digest.encode('ascii'))
+    except (AttributeError, OSError):
+        # No extended attributes here (platform or file system)
+        pass
+
+
+def _tagged_digest(file_path):
+    """Digest recorded by _tag_digest (None when missing or unsupported)"""
+    try:
+        return os.getxattr(file_path, DIGEST_XATTR).decode('ascii')
+    except (AttributeError, OSError):
+        return None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that keeps a single copy of identical files
+
+    Each file is stored once as a blob named after its SHA-256 digest
+    (blobs/ab/abcdef...), and the requested name is a hard link to that blob.
+    Names, paths and URLs therefore behave exactly like FileSystemStorage,
+    while duplicate uploads cost no extra disk space or writes. The blob's
+    link count is its reference count: it is removed together with its last
+    name.
+
+    All names of a blob share its modification time, which is set to the
+    last time that content was stored, so cleanups based on age never remove
+    a name that was just saved. They also share the blob's digest, kept in an
+    extended attribute, so deleting a name does not re-hash the file.
+    """
+
+    blob_dir = 'blobs'
+
+    def blob_name(self, digest):
+        return f'{self.blob_dir}/{digest[:2]}/{digest}'
+
+    def _save(self, name, content):
+        digest = getattr(content, 'content_hash', None) or hash_file(content)
+        blob_name = self.blob_name(digest)
+        blob_path = self.path(blob_name)
+
+        created_blob = False
+        if not os.path.exists(blob_path):
+            # FileSystemStorage moves temporary uploads instead of copying them
+            created_blob = self._save_blob(blob_name, content)
+        _tag_digest(blob_path, digest)
+
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+
+        while True:
+            full_path = self.path(name)
+            try:
+                os.link(blob_path, full_path)
+                # The link has the blob's times: this name was stored now
+                os.utime(full_path)
+                break
+            except FileExistsError:
+                name = self.get_available_name(name)
+            except FileNotFoundError:
+                # The blob was removed with its last name since it was checked:
+                # store it again. A temporary upload was moved into the blob,
+                # so its content is read from the still open file instead.
+                created_blob = self._save_blob(blob_name, File(content))
+                _tag_digest(blob_path, digest)
+            except OSError:
+                # Hard links are not supported here: fall back to a plain copy
+                shutil.copyfile(blob_path, full_path)
+                if created_blob:
+                    os.remove(blob_path)
+                break
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+
+        return str(name).replace('\\', '/')
+
+    def _save_blob(self, blob_name, content):
+        """Store content as the blob blob_name; False when another request stored it concurrently"""
+        saved_blob = super()._save(blob_name, content)
+        if saved_blob != blob_name:
+            os.remove(self.path(saved_blob))
+            return False
+        return True
+
+    def delete(self, name):
+        if not name:
+            raise ValueError('The name must be given to delete().')
+
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        # Two links left means this name and its blob: the last reference
+        blob_path = None
+        if os.path.isfile(path) and stat.st_nlink == 2:
+            blob_path = self.path(self.blob_name(_tagged_digest(path) or hash_path(path)))
+
+        super().delete(name)
+
+        if blob_path:
+            try:
+                blob_stat = os.stat(blob_path)
+            except FileNotFoundError:
+                return
+            if blob_stat.st_ino == stat.st_ino and blob_stat.st_nlink == 1:
+                os.remove(blob_path)
+
+    def collect_orphans(self):
+        """
+        Remove blobs no name links to any more (e.g. after files were deleted
+        outside the storage API), except those stored in the last
+        ORPHAN_MIN_AGE_SECONDS
+
+        Returns:
+            Number of blobs removed
+        """
+        removed = 0
+        root = self.path(self.blob_dir)
+        if not os.path.isdir(root):
+            return removed
+
+        stored_before = time.time() - ORPHAN_MIN_AGE_SECONDS
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                blob_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(blob_path)
+                    if stat.st_nlink == 1 and stat.st_mtime < stored_before:
+                        os.remove(blob_path)
+                        removed += 1
+                except OSError as e:
+                    print(f"Error removing blob {blob_path}: {e}")
+        return removed
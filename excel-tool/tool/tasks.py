@@ -0,0 +1,285 @@
+import functools
+
+from .conversion_profiles import column_type, read_with_profile
+from .delta import build_delta, row_fingerprints, save_fingerprint_index
+from .dtypes import optimize_dtypes
+from .exporters import write_dataframe
+from .memory import stage
+from .merge import merge_sheets
+from .profiling import TableProfile
+from .progress import ConversionCancelled
+from .readers import open_xls_book, read_sheet_streamed
+from .tracing import span
+from .utils import clean_dataframe, convert_to_csv, convert_to_output, process_excel_file
+from .xlsx_parallel import parallel_processes, read_sheet_parallel
+
+
+# Conversion jobs run by workers.run_task, in a worker process or inline.
+# Each takes the job's progress reporter (a ProgressTracker, or the worker's
+# relay of it) first; arguments and results are paths, options and small
+# dicts, never DataFrames, so they are cheap to send between processes.
+
+
+def read_sheet(source, sheet_name, skip_rows, row_filter, progress, book=None):
+    """
+    Read one sheet, streaming it when rows are filtered or progress is
+    tracked so both happen as rows come out of the reader
+
+    .xls sheets are always streamed from book (see readers.open_xls_book)
+    when given: pd.read_excel would decode every sheet of the workbook to
+    return one of them. Huge .xlsx sheets are parsed in row ranges by
+    several processes (see xlsx_parallel).
+
+    Returns:
+        tuple (DataFrame, dict with 'rows_scanned' and 'rows_kept')
+    """
+    processes = parallel_processes(source, sheet_name) if book is None else 0
+    if processes:
+        with stage('read'), span('read_sheet', sheet=sheet_name, engine='parallel', skip_rows=skip_rows,
+                                 processes=processes) as s:
+            df, filtering = read_sheet_parallel(source, sheet_name, skip_rows, row_filter,
+                                                on_progress=progress.parsed, processes=processes)
+            s.set(rows=len(df), columns=len(df.columns), rows_scanned=filtering['rows_scanned'])
+        return df, filtering
+
+    if book is None and row_filter is None and not progress.active:
+        import pandas as pd
+        with stage('read'), span('read_sheet', sheet=sheet_name, engine='pandas', skip_rows=skip_rows) as s:
+            df = pd.read_excel(source, sheet_name=sheet_name, skiprows=skip_rows)
+            s.set(rows=len(df), columns=len(df.columns))
+        return df, {'rows_scanned': len(df), 'rows_kept': len(df)}
+
+    engine = 'xlrd-on-demand' if book is not None else 'streamed'
+    with stage('read'), span('read_sheet', sheet=sheet_name, engine=engine, skip_rows=skip_rows) as s:
+        df, filtering = read_sheet_streamed(source, sheet_name, skip_rows, row_filter,
+                                            on_progress=progress.parsed, book=book)
+        s.set(rows=len(df), columns=len(df.columns), rows_scanned=filtering['rows_scanned'])
+    return df, filtering
+
+
+def _release_book(book):
+    """Close a workbook opened with readers.open_xls_book (None is ignored)"""
+    if book is not None:
+        book.release_resources()
+
+
+def _load_sheet(source, sheet_name, skip_rows, row_filter, progress, book):
+    """Read a sheet, remove empty columns, rename Unnamed ones and store columns in compact dtypes"""
+    df, filtering = read_sheet(source, sheet_name, skip_rows, row_filter, progress, book)
+    original_rows = len(df)
+    original_columns = len(df.columns)
+
+    df, cleaning = clean_dataframe(df)
+    with stage('clean'), span('optimize_dtypes', columns=len(df.columns)):
+        df, memory = optimize_dtypes(df)
+
+    stats = {
+        'original_rows': original_rows,
+        'original_columns': original_columns,
+        'final_columns': len(df.columns),
+        'empty_columns_removed': cleaning['empty_columns_removed'],
+        'unnamed_columns_renamed': cleaning['unnamed_columns_renamed'],
+        'memory_before': memory['memory_before'],
+        'memory_after': memory['memory_after'],
+        'rows_scanned': filtering['rows_scanned'],
+        'rows_kept': filtering['rows_kept'],
+    }
+    return df, stats, cleaning['source_columns']
+
+
+def convert_sheets(progress, source, sheets, output_format, row_filter=None, column_profiles=True, on_demand=True,
+                   keep_going=True):
+    """
+    Convert sheets of a workbook, one output file per sheet
+
+    Args:
+        progress: ProgressTracker of the conversion
+        source: Path to the workbook, or a seekable file object
+        sheets: list of (sheet_name, skip_rows, output_path)
+        output_format: One of exporters.OUTPUT_FORMATS
+        row_filter: filters.RowFilter (None = keep all rows)
+        column_profiles: Profile the written columns (profiling.TableProfile)
+        on_demand: Read .xls sheets from one on-demand handle, so sheets that
+            are not converted are never decoded
+        keep_going: Report a sheet that fails as an error and convert the
+            next one (False = raise)
+
+    Returns:
+        list with, per sheet, a dict with 'sheet_name', 'skip_rows',
+        'stats', 'columns' (output column names), 'source_columns'
+        (clean_dataframe's) and 'column_types' (conversion profile types of
+        the output columns), or with 'sheet_name' and 'error'
+    """
+    book = open_xls_book(source) if on_demand else None
+    results = []
+    try:
+        for index, (sheet_name, skip_rows, output_path) in enumerate(sheets):
+            try:
+                progress.start_sheet(index, sheet_name)
+                df, stats, source_columns = _load_sheet(source, sheet_name, skip_rows, row_filter, progress, book)
+
+                # Write in row chunks; column statistics are gathered from the chunks
+                profile = TableProfile() if column_profiles else None
+                write_dataframe(df, output_path, output_format, on_chunk=progress.written, profile=profile,
+                                sheet_name=sheet_name)
+                if profile is not None:
+                    stats['column_profile'] = profile.result()
+
+                results.append({
+                    'sheet_name': sheet_name,
+                    'skip_rows': skip_rows,
+                    'stats': stats,
+                    'columns': [str(col) for col in df.columns],
+                    'source_columns': source_columns,
+                    'column_types': [column_type(dtype) for dtype in df.dtypes],
+                })
+            except ConversionCancelled:
+                raise
+            except Exception as e:
+                if not keep_going:
+                    raise
+                results.append({'sheet_name': sheet_name, 'error': str(e)})
+    finally:
+        _release_book(book)
+    return results
+
+
+def merge_workbook_sheets(progress, source, sheets, output_path, output_format, row_filter=None, source_column=None):
+    """
+    Convert sheets of a workbook into one output with columns aligned by
+    name (see merge.merge_sheets)
+
+    Args:
+        progress: ProgressTracker of the conversion
+        source: Path to the workbook
+        sheets: list of (sheet_name, skip_rows)
+        output_path: Destination file path
+        output_format: One of exporters.OUTPUT_FORMATS
+        row_filter: filters.RowFilter (None = keep all rows)
+        source_column: Name of a column holding the source sheet name
+
+    Returns:
+        merge.merge_sheets' dict, with the output's 'column_profile'
+    """
+    book = open_xls_book(source)
+    try:
+        def load(index, sheet_name, skip_rows):
+            progress.start_sheet(index, sheet_name)
+            df, _, _ = _load_sheet(source, sheet_name, skip_rows, row_filter, progress, book)
+            return df
+
+        profile = TableProfile()
+        merged = merge_sheets(
+            [
+                (sheet_name, functools.partial(load, index, sheet_name, skip_rows))
+                for index, (sheet_name, skip_rows) in enumerate(sheets)
+            ],
+            output_path,
+            output_format,
+            source_column=source_column,
+            on_chunk=progress.written,
+            profile=profile,
+        )
+    finally:
+        _release_book(book)
+    return dict(merged, column_profile=profile.result())
+
+
+def convert_with_profile(progress, source, profile, sheets, row_filter=None):
+    """
+    Convert sheets with a conversion profile: only the profile's columns are
+    streamed, in their saved types (see conversion_profiles.read_with_profile)
+
+    Args:
+        progress: ProgressTracker of the conversion
+        source: Path to the workbook, or a seekable file object
+        profile: ConversionProfile
+        sheets: list of (sheet_name, output_path)
+        row_filter: filters.RowFilter (None = keep all rows)
+
+    Returns:
+        list with, per sheet, a dict with 'sheet_name', 'rows', 'columns',
+        read_with_profile's 'reading' figures and 'column_profile'
+
+    Raises:
+        conversion_profiles.ProfileMismatch: If the data does not fit the profile
+    """
+    book = open_xls_book(source)
+    results = []
+    try:
+        for index, (sheet_name, output_path) in enumerate(sheets):
+            progress.start_sheet(index, sheet_name)
+            with stage('read'), span('read_sheet', sheet=sheet_name, engine='profile',
+                                     skip_rows=profile.skip_rows) as s:
+                df, reading = read_with_profile(source, sheet_name, profile, row_filter,
+                                                on_progress=progress.parsed, book=book)
+                s.set(rows=len(df), columns=len(df.columns), rows_scanned=reading['rows_scanned'])
+
+            column_profile = TableProfile()
+            write_dataframe(df, output_path, profile.output_format, on_chunk=progress.written,
+                            profile=column_profile, sheet_name=sheet_name)
+            results.append({
+                'sheet_name': sheet_name,
+                'rows': len(df),
+                'columns': len(df.columns),
+                'reading': reading,
+                'column_profile': column_profile.result(),
+            })
+    finally:
+        _release_book(book)
+    return results
+
+
+def process_workbook(progress, file_path, output_name, output_format='csv', columns_to_keep=None, skip_rows=0,
+                     row_filter=None, key_columns=None, delta=False, delta_base=None, preview_rows=100):
+    """
+    utils.process_excel_file, then fingerprint the rows, compare them with a
+    previous conversion (delta mode) and save the output, all in this process
+
+    Args:
+        output_name: Output file name (stored under outputs/)
+        output_format: One of exporters.OUTPUT_FORMATS
+        key_columns: Column names identifying a row for the fingerprints
+        delta: Whether to only output the rows added, changed or removed
+            since delta_base (a ConversionHistory; None = every row is added)
+        preview_rows: Number of output rows returned for the preview
+
+    Returns:
+        process_excel_file's dict without 'dataframe', plus 'output_path',
+        'fingerprint_index' (storage names), 'key_columns', 'delta' (stats
+        or None), 'column_profile', 'columns' and 'preview' (first rows as
+        records)
+
+    Raises:
+        ValueError: If a key column does not exist
+    """
+    import numpy as np
+    import pandas as pd
+
+    result = process_excel_file(file_path, columns_to_keep, remove_empty=True, skip_rows=skip_rows,
+                                row_filter=row_filter)
+    df = result.pop('dataframe')
+
+    # Fingerprint rows so the next version of this file can be diffed
+    with span('fingerprint_rows', rows=len(df)):
+        fingerprints = row_fingerprints(df, key_columns)
+        result['fingerprint_index'] = save_fingerprint_index(fingerprints, output_name)
+    result['key_columns'] = fingerprints['key_columns']
+
+    result['delta'] = None
+    if delta:
+        with span('build_delta', base=delta_base.id if delta_base is not None else None):
+            df, result['delta'] = build_delta(df, fingerprints, delta_base)
+
+    # Save output and profile its columns
+    profile = TableProfile()
+    if output_format == 'csv':
+        result['output_path'] = convert_to_csv(df, output_name)
+        profile.update(df)
+    else:
+        result['output_path'] = convert_to_output(df, output_name, output_format, profile=profile)
+    result['column_profile'] = profile.result()
+
+    result['columns'] = list(df.columns)
+    result['preview'] = df.head(preview_rows).replace({np.nan: None, pd.NaT: None}).to_dict('records')
+    return result
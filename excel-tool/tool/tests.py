@@ -1,3 +1,1773 @@
-from django.test import TestCase
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
 
-# Create your tests here.
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.urls import path
+
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+# Writes the .xls workbooks of the tests (not a dependency of the project)
+HAS_XLWT = importlib.util.find_spec('xlwt') is not None
+
+
+IMPORT_PROBE = """
+import json, os, sys, time
+os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
+import django
+django.setup()
+started = time.perf_counter()
+import mysite.urls
+elapsed = time.perf_counter() - started
+heavy = [name for name in ('pandas', 'numpy', 'openpyxl', 'xlrd', 'pyarrow') if name in sys.modules]
+print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))
+"""
+
+
+def write_workbook(path, rows, sheet_name='Data'):
+    """Save rows (lists of cell values) as a one-sheet .xlsx workbook"""
+    import openpyxl
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = sheet_name
+    for row in rows:
+        worksheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def write_xls(path, sheets):
+    """Save a dict of sheet name to rows as an .xls workbook (with xlwt); sheets named hidden* are hidden"""
+    import xlwt
+
+    workbook = xlwt.Workbook()
+    for name, rows in sheets.items():
+        worksheet = workbook.add_sheet(name)
+        if name.startswith('hidden'):
+            worksheet.visibility = 1
+        for row_index, row in enumerate(rows):
+            for column_index, value in enumerate(row):
+                worksheet.write(row_index, column_index, value)
+    workbook.save(path)
+    return path
+
+
+def rewrite_sheet_xml(path, fix):
+    """Replace the XML of the first sheet of an .xlsx workbook with fix(xml)"""
+    with zipfile.ZipFile(path) as archive:
+        parts = [(info, archive.read(info)) for info in archive.infolist()]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for info, data in parts:
+            if info.filename == 'xl/worksheets/sheet1.xml':
+                data = fix(data)
+            archive.writestr(info.filename, data)
+
+MEMORY_PROBE = """
+import json, os, sys
+os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
+os.environ['EXCEL_WORKER_PROCESSES'] = '0'
+os.environ['EXCEL_MEMORY_TRACE_SAMPLE_RATE'] = '0'
+import django
+django.setup()
+from tool.memory import track_conversion
+with track_conversion(1024) as usage:
+    import pandas as pd
+    pd.DataFrame({'id': range(10)}).to_csv(os.devnull, index=False)
+print(json.dumps(usage.result()))
+"""
+
+
+def run_probe(code, **env):
+    """Run Python code in a fresh interpreter of the project and parse the JSON on its last line"""
+    project_dir = Path(settings.BASE_DIR)
+    env = dict(os.environ, PYTHONPATH=str(project_dir), **env)
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=project_dir, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class ImportTimeTests(SimpleTestCase):
+    # Loading the URLconf (all views) must stay cheap: workers that only
+    # serve pages and downloads should start without the conversion stack
+    IMPORT_BUDGET_SECONDS = 0.5
+
+    def _probe(self):
+        return run_probe(IMPORT_PROBE)
+
+    def test_urlconf_does_not_import_conversion_dependencies(self):
+        self.assertEqual(self._probe()['heavy'], [])
+
+    def test_urlconf_import_time_budget(self):
+        self.assertLess(self._probe()['elapsed'], self.IMPORT_BUDGET_SECONDS)
+
+
+class PrewarmTests(SimpleTestCase):
+    def test_prewarm_loads_conversion_dependencies(self):
+        from .warmup import prewarm
+
+        timings = prewarm()
+        self.assertIn('pandas', sys.modules)
+        self.assertIn('openpyxl', sys.modules)
+        self.assertGreaterEqual(timings['warmup_seconds'], 0)
+
+
+class MemoryUsageTests(SimpleTestCase):
+    def test_first_conversion_does_not_count_imports(self):
+        usage = run_probe(MEMORY_PROBE)
+        self.assertLess(usage['rss_growth'], 16 * 1024 * 1024)
+        self.assertLess(usage['hwm_growth'], 16 * 1024 * 1024)
+
+
+class StreamedReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_stale_dimension_is_ignored(self):
+        import pandas as pd
+
+        from .readers import read_header, read_sheet_streamed
+
+        path = write_workbook(os.path.join(self.directory.name, 'stale.xlsx'),
+                              [['title'], ['id', 'name']] + [[i, f'name {i}'] for i in range(20)])
+        rewrite_sheet_xml(path, lambda xml: re.sub(rb'<dimension ref="[^"]+"', b'<dimension ref="A1"', xml))
+
+        df, filtering = read_sheet_streamed(path, 'Data', skip_rows=1)
+        pd.testing.assert_frame_equal(df, pd.read_excel(path, sheet_name='Data', skiprows=1))
+        self.assertEqual(filtering, {'rows_scanned': 20, 'rows_kept': 20})
+        self.assertEqual(read_header(path, 'Data', skip_rows=1), ['id', 'name'])
+
+
+@unittest.skipUnless(HAS_XLWT, 'xlwt is needed to write .xls workbooks')
+class XlsReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = write_xls(os.path.join(self.directory.name, 'book.xls'), {
+            'First': [['title'], ['id', 'name']] + [[i, f'name {i}'] for i in range(30)],
+            'Second': [['code', 'amount'], ['A1', 1.5], ['A2', 2]],
+        })
+
+    def test_sheets_are_loaded_on_demand_and_released(self):
+        import pandas as pd
+
+        from .readers import open_xls_book, read_header, read_sheet_streamed
+
+        book = open_xls_book(self.path)
+        self.addCleanup(book.release_resources)
+        self.assertTrue(book.on_demand)
+        self.assertEqual(book.sheet_names(), ['First', 'Second'])
+        self.assertFalse(book.sheet_loaded('First') or book.sheet_loaded('Second'))
+
+        first, filtering = read_sheet_streamed(self.path, 'First', skip_rows=1, book=book)
+        pd.testing.assert_frame_equal(first, pd.read_excel(self.path, sheet_name='First', skiprows=1))
+        self.assertEqual(filtering, {'rows_scanned': 30, 'rows_kept': 30})
+        second, _ = read_sheet_streamed(self.path, 'Second', book=book)
+        pd.testing.assert_frame_equal(second, pd.read_excel(self.path, sheet_name='Second'))
+        self.assertEqual(read_header(self.path, 'Second', book=book), ['code', 'amount'])
+        self.assertFalse(book.sheet_loaded('First') or book.sheet_loaded('Second'))
+
+    def test_upload_held_in_memory(self):
+        import io
+
+        from .readers import detect_excel_format, open_xls_book, read_sheet_streamed
+
+        with open(self.path, 'rb') as f:
+            upload = io.BytesIO(f.read())
+        self.assertEqual(detect_excel_format(upload), 'xls')
+        book = open_xls_book(upload)
+        self.addCleanup(book.release_resources)
+        df, _ = read_sheet_streamed(upload, 'Second', book=book)
+        self.assertEqual(df['code'].tolist(), ['A1', 'A2'])
+        self.assertEqual(df['amount'].tolist(), [1.5, 2])
+
+    def test_xlsx_needs_no_book(self):
+        from .readers import open_xls_book
+
+        path = write_workbook(os.path.join(self.directory.name, 'book.xlsx'), [['id'], [1]])
+        self.assertIsNone(open_xls_book(path))
+
+
+class ParallelReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        rows = [['Report'], [], ['id', 'name', 'amount', None, 'city']]
+        for i in range(3000):
+            # Rows left out of the sheet (gaps in row numbers) read as empty rows
+            rows.append([] if i % 97 == 0 else [i, f'name {i % 50}', i * 0.5, None, ['Hà Nội', 'HCM', '東京'][i % 3]])
+        self.path = write_workbook(os.path.join(self.directory.name, 'big.xlsx'), rows)
+
+    def _assert_same_as_serial(self, skip_rows=2, row_filter=None):
+        from unittest import mock
+
+        import pandas as pd
+
+        from . import xlsx_parallel
+        from .readers import read_sheet_streamed
+
+        expected, expected_filtering = read_sheet_streamed(self.path, 'Data', skip_rows, row_filter)
+        progress = []
+        with mock.patch.object(xlsx_parallel, 'MIN_CHUNK_BYTES', 16 * 1024):
+            df, filtering = xlsx_parallel.read_sheet_parallel(self.path, 'Data', skip_rows, row_filter,
+                                                              on_progress=progress.append, processes=2)
+        pd.testing.assert_frame_equal(df, expected)
+        self.assertEqual(filtering, expected_filtering)
+        self.assertEqual(progress[-1], filtering['rows_scanned'])
+
+    def test_matches_serial_reader(self):
+        self._assert_same_as_serial()
+
+    def test_matches_serial_reader_with_filter_and_header_in_data(self):
+        from .filters import parse_row_filter
+
+        self._assert_same_as_serial(row_filter=parse_row_filter('city = HCM AND amount > 100'))
+        self._assert_same_as_serial(skip_rows=40)
+
+    def test_matches_serial_reader_with_stale_dimension(self):
+        rewrite_sheet_xml(self.path, lambda xml: re.sub(rb'<dimension ref="[^"]+"', b'<dimension ref="A1:E10"', xml))
+        self._assert_same_as_serial()
+
+    def test_unnumbered_rows_fall_back_to_serial_reader(self):
+        rewrite_sheet_xml(self.path, lambda xml: re.sub(rb'<row r="\d+"', b'<row', xml))
+        self._assert_same_as_serial()
+
+    def test_shared_strings_round_trip(self):
+        from .xlsx_parallel import _SharedStrings, _write_shared_strings
+
+        strings = ['', 'abc', 'Hà Nội', '東京', 'x' * 1000]
+        path = os.path.join(self.directory.name, 'strings')
+        _write_shared_strings(strings, path)
+        table = _SharedStrings(path)
+        try:
+            self.assertEqual([table[index] for index in range(len(strings))], strings)
+        finally:
+            table.close()
+
+
+@unittest.skipUnless(HAS_PYARROW, 'Parquet and Arrow output need pyarrow')
+class ColumnarOutputTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_mixed_column_with_one_type_per_chunk(self):
+        import pandas as pd
+
+        from .exporters import write_dataframe
+
+        # Numbers in the first chunk, text in the second: the column is text
+        df = pd.DataFrame({'code': pd.Series([1, 2, 3, 'A4', 'A5', None], dtype=object), 'n': range(6)})
+        for output_format, read in (('parquet', pd.read_parquet), ('feather', pd.read_feather)):
+            path = os.path.join(self.directory.name, f'out.{output_format}')
+            write_dataframe(df, path, output_format, chunk_rows=3)
+            back = read(path)
+            self.assertEqual(back['code'].tolist()[:5], ['1', '2', '3', 'A4', 'A5'])
+            self.assertTrue(pd.isna(back['code'].iloc[5]))
+            self.assertEqual(back['n'].tolist(), list(range(6)))
+
+    def test_merged_sheets_with_a_late_value_of_another_type(self):
+        import pandas as pd
+
+        from .merge import merge_sheets
+
+        # The text value comes after the rows a sample would have looked at
+        first = pd.DataFrame({'code': pd.Series([1] * 1500 + ['X1'], dtype=object), 'n': range(1501)})
+        second = pd.DataFrame({'code': pd.Series([7, 8], dtype=object), 'n': [1, 2], 'empty': [None, None]})
+        for output_format, read in (('parquet', pd.read_parquet), ('feather', pd.read_feather)):
+            path = os.path.join(self.directory.name, f'merged.{output_format}')
+            result = merge_sheets([('first', first.copy), ('second', second.copy)], path, output_format,
+                                  source_column='sheet', chunk_rows=500)
+            back = read(path)
+            self.assertEqual(result['rows_written'], 1503)
+            self.assertEqual(back['code'].tolist()[-3:], ['X1', '7', '8'])
+            self.assertEqual(back['sheet'].tolist()[-1], 'second')
+
+
+class DtypeOptimizationTests(SimpleTestCase):
+    def _frame(self):
+        import pandas as pd
+
+        return pd.DataFrame({
+            'id': range(1000),
+            'status': ['OK', 'Hủy'] * 500,
+            'customer': pd.Series([f'KH{i:05d}' for i in range(1000)], dtype=object),
+            'amount': [i / 3 for i in range(1000)],
+            'mixed': [1, 'a'] * 500,
+        })
+
+    def test_compact_dtypes_keep_the_csv_output(self):
+        from .dtypes import optimize_dtypes
+
+        df = self._frame()
+        optimized, stats = optimize_dtypes(df)
+        self.assertEqual(str(optimized['id'].dtype), 'int16')
+        self.assertEqual(str(optimized['status'].dtype), 'category')
+        self.assertEqual(optimized['amount'].dtype, df['amount'].dtype)
+        self.assertEqual(optimized['mixed'].dtype, object)
+        self.assertNotIn('mixed', stats['optimized_columns'])
+        self.assertEqual(stats['optimized_columns']['id'], 'int16')
+        self.assertLess(stats['memory_after'], stats['memory_before'])
+        self.assertEqual(optimized.to_csv(index=False), df.to_csv(index=False))
+
+    def test_distinct_text_uses_arrow_strings_only_with_pyarrow(self):
+        from unittest import mock
+
+        from . import dtypes
+
+        with mock.patch.object(dtypes, '_has_pyarrow', return_value=False):
+            optimized, stats = dtypes.optimize_dtypes(self._frame())
+        self.assertEqual(optimized['customer'].dtype, object)
+        self.assertNotIn('customer', stats['optimized_columns'])
+
+        if HAS_PYARROW:
+            optimized, stats = dtypes.optimize_dtypes(self._frame())
+            self.assertEqual(stats['optimized_columns']['customer'], 'string')
+            self.assertEqual(optimized['customer'].dtype.storage, 'pyarrow')
+
+
+class XlsxOutputTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'out.xlsx')
+
+    def test_values_keep_their_type_across_chunks(self):
+        import datetime
+
+        import openpyxl
+        import pandas as pd
+
+        from .exporters import write_dataframe
+
+        df = pd.DataFrame({
+            'code': ['007', '=1+1', '#N/A', None],
+            'n': [1, 2, 3, 4],
+            'amount': [1.5, float('inf'), None, 2.0],
+            'ok': [True, False, True, False],
+            'day': pd.to_datetime(['2024-01-02', None, '2024-03-04', '2024-05-06']).tz_localize('Asia/Ho_Chi_Minh'),
+        })
+        result = write_dataframe(df, self.path, 'xlsx', chunk_rows=3, sheet_name='Sheet: 1/2')
+        self.assertEqual(result['rows_written'], 4)
+
+        workbook = openpyxl.load_workbook(self.path)
+        self.assertEqual(workbook.sheetnames, ['Sheet 12'])
+        rows = list(workbook.active.iter_rows())
+        self.assertEqual([cell.value for cell in rows[0]], ['code', 'n', 'amount', 'ok', 'day'])
+        self.assertEqual([cell.value for cell in rows[1]], ['007', 1, 1.5, True, datetime.datetime(2024, 1, 2)])
+        self.assertEqual([cell.value for cell in rows[2]][:3], ['=1+1', 2, 'inf'])
+        self.assertEqual([(cell.value, cell.data_type) for cell in rows[2][:1] + rows[3][:1]],
+                         [('=1+1', 's'), ('#N/A', 's')])
+        self.assertEqual([cell.value for cell in rows[3]][2:], [None, True, datetime.datetime(2024, 3, 4)])
+        self.assertIsNone(rows[4][0].value)
+        self.assertIsNone(rows[2][4].value)
+
+    def test_rows_beyond_the_sheet_limit_are_rejected(self):
+        from unittest import mock
+
+        import pandas as pd
+
+        from . import exporters
+
+        df = pd.DataFrame({'n': range(5)})
+        with mock.patch.object(exporters, 'XLSX_MAX_ROWS', 4), self.assertRaises(ValueError):
+            exporters.write_dataframe(df, self.path, 'xlsx', chunk_rows=2)
+        with mock.patch.object(exporters, 'XLSX_MAX_ROWS', 6):
+            exporters.write_dataframe(df, self.path, 'xlsx', chunk_rows=2)
+
+
+class MergeTests(SimpleTestCase):
+    def test_integer_and_bool_columns_missing_from_a_sheet(self):
+        import pandas as pd
+
+        from .merge import merge_sheets
+
+        first = pd.DataFrame({'code': [101, 102], 'ok': [True, False]})
+        second = pd.DataFrame({'name': ['x']})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'merged.csv')
+            merge_sheets([('A', first.copy), ('B', second.copy)], path, 'csv', source_column='sheet')
+            with open(path, encoding='utf-8-sig') as f:
+                self.assertEqual(f.read().splitlines(),
+                                 ['sheet,code,ok,name', 'A,101,True,', 'A,102,False,', 'B,,,x'])
+
+
+class RowFilterTests(SimpleTestCase):
+    def test_mask_on_object_column(self):
+        import pandas as pd
+
+        from .filters import parse_row_filter
+
+        df = pd.DataFrame({'code': pd.Series([1, 'x', '', None, 'x'], dtype=object)})
+        self.assertEqual(parse_row_filter('code = x').mask(df).tolist(), [False, True, False, False, True])
+        self.assertEqual(parse_row_filter('code != x').mask(df).tolist(), [True, False, False, False, False])
+
+    def test_parser(self):
+        from .filters import parse_row_filter
+
+        self.assertIsNone(parse_row_filter('  '))
+        row_filter = parse_row_filter('"支店 コード" = 101 and (日付 >= 2024-01-01 OR 状態 in (OK, \'保 留\'))')
+        self.assertEqual(row_filter.tree, ('and', ('cmp', '支店 コード', '=', '101'),
+                                           ('or', ('cmp', '日付', '>=', '2024-01-01'),
+                                            ('cmp', '状態', 'in', ['OK', '保 留']))))
+        self.assertEqual(row_filter.columns(), {'支店 コード', '日付', '状態'})
+        for text in ('a =', 'a = 1 b', '(a = 1', 'a in 1', 'a ~ 1'):
+            with self.assertRaises(ValueError, msg=text):
+                parse_row_filter(text)
+        with self.assertRaisesRegex(ValueError, 'not found: b'):
+            parse_row_filter('b = 1').bind(['a'])
+
+    def test_streamed_and_vectorized_filters_agree(self):
+        import pandas as pd
+
+        from .filters import apply_row_filter, parse_row_filter
+        from .readers import read_sheet_streamed
+
+        tokens = ['n/a', 'NA', 'NULL', 'null', '#N/A', 'nan', 'None', '-', 'x', ' NA']
+        rows = [['id', '金額', '状態']]
+        for i in range(150):
+            amount = tokens[i % len(tokens)] if i % 2 else i % 20
+            rows.append([i, amount, ['OK', 'NA', None][i % 3]])
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_workbook(os.path.join(directory, 'na.xlsx'), rows)
+            df = pd.read_excel(path, sheet_name='Data')
+            for text in ('金額 > 5', '金額 != 10', '金額 = x', '金額 in (5, -)', '状態 != OK',
+                         '状態 contains A', '金額 <= 3 OR 状態 = OK'):
+                row_filter = parse_row_filter(text)
+                streamed, filtering = read_sheet_streamed(path, 'Data', row_filter=row_filter)
+                expected, expected_filtering = apply_row_filter(df, row_filter)
+                self.assertEqual(streamed['id'].tolist(), expected['id'].tolist(), msg=text)
+                self.assertEqual(filtering, expected_filtering)
+
+
+def _content(data):
+    from django.core.files.base import ContentFile
+
+    return ContentFile(data)
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    def setUp(self):
+        from .storage import ContentAddressedStorage
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.storage = ContentAddressedStorage(location=self.directory.name)
+
+    def _blobs(self):
+        root = os.path.join(self.directory.name, 'blobs')
+        return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files]
+
+    def test_identical_files_share_one_blob_until_the_last_delete(self):
+        from django.core.files.base import ContentFile
+
+        first = self.storage.save('outputs/a.csv', ContentFile(b'id,name\n1,x\n'))
+        second = self.storage.save('outputs/a.csv', ContentFile(b'id,name\n1,x\n'))
+        other = self.storage.save('outputs/b.csv', ContentFile(b'id,name\n2,y\n'))
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self._blobs()), 2)
+        self.assertEqual(os.stat(self.storage.path(first)).st_ino, os.stat(self.storage.path(second)).st_ino)
+
+        self.storage.delete(first)
+        self.assertEqual(self.storage.open(second).read(), b'id,name\n1,x\n')
+        self.assertEqual(len(self._blobs()), 2)
+        self.storage.delete(second)
+        self.storage.delete(other)
+        self.storage.delete(other)
+        self.assertEqual(self._blobs(), [])
+
+    def test_cleanup_keeps_a_new_name_of_old_content(self):
+        from django.core.files.base import ContentFile
+
+        from .workspace import cleanup_old_stored_files
+
+        old = self.storage.save('outputs/old.csv', ContentFile(b'same'))
+        middle = self.storage.save('outputs/middle.csv', ContentFile(b'other'))
+        os.utime(self.storage.path(old), (1_000_000, 1_000_000))
+        os.utime(self.storage.path(middle), (2_000_000, 2_000_000))
+        new = self.storage.save('outputs/new.csv', ContentFile(b'same'))
+
+        # Names of the same content share its (latest) store time
+        cleanup_old_stored_files('outputs', max_files=2, storage=self.storage)
+        self.assertEqual(sorted(self.storage.listdir('outputs')[1]), ['new.csv', 'old.csv'])
+        self.assertEqual(self.storage.open(new).read(), b'same')
+
+    def test_cleanup_removes_orphan_blobs(self):
+        from unittest import mock
+
+        from django.core.files.base import ContentFile
+
+        from . import storage
+        from .workspace import cleanup_old_stored_files
+
+        kept = self.storage.save('outputs/kept.csv', ContentFile(b'kept'))
+        gone = self.storage.save('outputs/gone.csv', ContentFile(b'gone'))
+        os.remove(self.storage.path(gone))
+
+        cleanup_old_stored_files('outputs', storage=self.storage)
+        self.assertEqual(len(self._blobs()), 2)
+        with mock.patch.object(storage, 'ORPHAN_MIN_AGE_SECONDS', -60):
+            cleanup_old_stored_files('outputs', storage=self.storage)
+        self.assertEqual(len(self._blobs()), 1)
+        self.assertEqual(self.storage.open(kept).read(), b'kept')
+
+    def test_blob_removed_during_a_save_is_stored_again(self):
+        from unittest import mock
+
+        from django.core.files.uploadedfile import TemporaryUploadedFile
+
+        first = self.storage.save('outputs/a.csv', _content(b'id\n1\n'))
+        link = os.link
+
+        def link_after_a_concurrent_delete(source, target):
+            # The last other name of the blob is deleted between the blob
+            # check and the link
+            if os.path.exists(self.storage.path(first)):
+                self.storage.delete(first)
+            return link(source, target)
+
+        upload = TemporaryUploadedFile('a.csv', 'text/csv', 5, 'utf-8')
+        upload.write(b'id\n1\n')
+        self.addCleanup(upload.close)
+        with mock.patch.object(os, 'link', link_after_a_concurrent_delete):
+            second = self.storage.save('outputs/b.csv', upload)
+        self.assertEqual(self.storage.open(second).read(), b'id\n1\n')
+        self.assertEqual(os.stat(self.storage.path(second)).st_nlink, 2)
+
+    def test_delete_finds_the_blob_without_hashing(self):
+        from unittest import mock
+
+        from . import storage
+
+        name = self.storage.save('outputs/a.csv', _content(b'id\n1\n'))
+        if storage._tagged_digest(self.storage.path(name)) is None:
+            self.skipTest('No extended attributes on this file system')
+        with mock.patch.object(storage, 'hash_path', side_effect=AssertionError('re-hashed')):
+            self.storage.delete(name)
+        self.assertEqual(self._blobs(), [])
+
+
+class HashingUploadHandlerTests(SimpleTestCase):
+    def _upload(self, data):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test import RequestFactory
+
+        from .uploadhandlers import HashingMemoryFileUploadHandler, HashingTemporaryFileUploadHandler
+
+        request = RequestFactory().post('/upload/', {'file': SimpleUploadedFile('book.xlsx', data)})
+        request.upload_handlers = [HashingMemoryFileUploadHandler(request), HashingTemporaryFileUploadHandler(request)]
+        upload = request.FILES['file']
+        self.addCleanup(upload.close)
+        return upload
+
+    def test_small_and_spooled_uploads_carry_their_digest(self):
+        import hashlib
+
+        from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+
+        data = os.urandom(200_000)
+        with tempfile.TemporaryDirectory() as directory:
+            spool = os.path.join(directory, 'spool')
+            for max_memory_size, upload_class in ((1024 * 1024, InMemoryUploadedFile),
+                                                  (1024, TemporaryUploadedFile)):
+                with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=max_memory_size, FILE_UPLOAD_TEMP_DIR=spool):
+                    upload = self._upload(data)
+                self.assertIsInstance(upload, upload_class)
+                self.assertEqual(upload.content_hash, hashlib.sha256(data).hexdigest())
+                self.assertEqual(upload.read(), data)
+            self.assertTrue(upload.temporary_file_path().startswith(spool))
+
+
+class WorkspaceTests(SimpleTestCase):
+    def setUp(self):
+        from django.core.files.storage import FileSystemStorage
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings_override = override_settings(EXCEL_SCRATCH_DIR=os.path.join(self.directory.name, 'scratch'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.storage = FileSystemStorage(location=os.path.join(self.directory.name, 'media'))
+
+    def _remote_storage(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import Storage
+
+        class RemoteStorage(Storage):
+            # Like S3: files are only reachable through the storage API (no path())
+            def __init__(self):
+                self.files = {}
+
+            def _save(self, name, content):
+                self.files[name] = b''.join(content.chunks())
+                return name
+
+            def _open(self, name, mode='rb'):
+                return ContentFile(self.files[name], name)
+
+            def exists(self, name):
+                return name in self.files
+
+        return RemoteStorage()
+
+    def _scratch(self, data):
+        from .workspace import scratch_path
+
+        path = scratch_path('.csv')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_scratch_file_is_removed_after_the_block(self):
+        from .workspace import scratch_file
+
+        with scratch_file('.csv') as path:
+            self.assertTrue(path.startswith(os.path.join(self.directory.name, 'scratch')))
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_store_file_moves_local_files_and_uploads_remote_ones(self):
+        from .workspace import is_local, store_file
+
+        remote = self._remote_storage()
+        self.assertTrue(is_local(self.storage))
+        self.assertFalse(is_local(remote))
+        for storage in (self.storage, remote):
+            path = self._scratch(b'id\n1\n')
+            inode = os.stat(path).st_ino
+            name = store_file(path, 'outputs/out.csv', storage)
+            self.assertFalse(os.path.exists(path))
+            with storage.open(name) as f:
+                self.assertEqual(f.read(), b'id\n1\n')
+            if storage is self.storage:
+                self.assertEqual(os.stat(storage.path(name)).st_ino, inode)
+        self.assertNotEqual(store_file(self._scratch(b'x'), 'outputs/out.csv', self.storage), 'outputs/out.csv')
+
+    def test_local_copy_of_a_remote_file_is_removed_after_the_block(self):
+        from django.core.files.base import ContentFile
+
+        from .workspace import local_copy
+
+        name = self.storage.save('uploads/book.xlsx', ContentFile(b'local'))
+        with local_copy(name, self.storage) as path:
+            self.assertEqual(path, self.storage.path(name))
+        self.assertTrue(os.path.exists(path))
+
+        remote = self._remote_storage()
+        name = remote.save('uploads/book.xlsx', ContentFile(b'remote'))
+        with local_copy(name, remote) as path:
+            self.assertTrue(path.endswith('.xlsx'))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'remote')
+        self.assertFalse(os.path.exists(path))
+
+    def test_cleanup_keeps_the_newest_files(self):
+        from django.core.files.base import ContentFile
+
+        from .workspace import cleanup_old_stored_files, delete_stored
+
+        names = [self.storage.save(f'outputs/{i}.csv', ContentFile(b'x')) for i in range(5)]
+        for age, name in enumerate(reversed(names)):
+            mtime = 1_700_000_000 - age * 60
+            os.utime(self.storage.path(name), (mtime, mtime))
+        cleanup_old_stored_files('outputs', max_files=2, storage=self.storage)
+        self.assertEqual(sorted(self.storage.listdir('outputs')[1]), ['3.csv', '4.csv'])
+
+        delete_stored(['outputs/3.csv', 'outputs/missing.csv'], self.storage)
+        self.assertEqual(self.storage.listdir('outputs')[1], ['4.csv'])
+        cleanup_old_stored_files('missing', storage=self.storage)
+
+
+class RecordingTracker:
+    """ProgressTracker stand-in recording the progress relayed from a worker"""
+
+    active = True
+
+    def __init__(self, cancel_after=None):
+        self.calls = []
+        self.cancel_after = cancel_after
+
+    def _record(self, *call):
+        from .progress import ConversionCancelled
+
+        self.calls.append(call)
+        if self.cancel_after is not None and len(self.calls) >= self.cancel_after:
+            raise ConversionCancelled('Conversion cancelled')
+
+    def start_sheet(self, index, sheet_name):
+        self._record('start_sheet', index, sheet_name)
+
+    def parsed(self, rows):
+        self._record('parsed', rows)
+
+    def written(self, rows, bytes_written):
+        self._record('written', rows, bytes_written)
+
+
+class WorkerPoolTests(SimpleTestCase):
+    def setUp(self):
+        from .workers import WorkerPool
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = write_workbook(os.path.join(self.directory.name, 'book.xlsx'),
+                                   [['id', 'name']] + [[i, f'name {i}'] for i in range(50)])
+        self.pool = WorkerPool(1, max_jobs=2, max_rss=0)
+        self.addCleanup(self.pool.close)
+
+    def _convert(self, tracker=None, name='out.csv'):
+        output_path = os.path.join(self.directory.name, name)
+        result = self.pool.run('convert_sheets', tracker, source=self.path, sheets=[('Data', 0, output_path)],
+                               output_format='csv')
+        return result, output_path
+
+    def test_runs_jobs_and_relays_progress(self):
+        tracker = RecordingTracker()
+        (result,), output_path = self._convert(tracker)
+        self.assertEqual(result['stats']['rows_kept'], 50)
+        with open(output_path, encoding='utf-8-sig') as f:
+            self.assertEqual(f.readline().strip(), 'id,name')
+        self.assertEqual(tracker.calls[0], ('start_sheet', 0, 'Data'))
+        self.assertEqual(sum(call[1] for call in tracker.calls if call[0] == 'written'), 50)
+
+    def test_recycles_worker_after_max_jobs(self):
+        self._convert(name='first.csv')
+        worker = self.pool._idle[0]
+        self._convert(name='second.csv')
+        self.assertEqual(worker.recycle, 'jobs')
+        self.assertFalse(worker.process.is_alive())
+        self.assertEqual(self.pool._idle, [])
+        self._convert(name='third.csv')
+
+    def test_cancellation_stops_the_job(self):
+        from .progress import ConversionCancelled
+
+        with self.assertRaises(ConversionCancelled):
+            self._convert(RecordingTracker(cancel_after=1))
+        # The worker takes the next job
+        (result,), _ = self._convert(name='next.csv')
+        self.assertEqual(result['stats']['rows_kept'], 50)
+
+    def test_worker_spans_join_the_request_trace(self):
+        import contextvars
+
+        from django.test import RequestFactory
+
+        from .tracing import span, start_trace
+
+        def traced_conversion():
+            trace = start_trace(RequestFactory().get('/', HTTP_X_EXCEL_TRACE='1'))
+            with span('request'):
+                self._convert()
+            return trace
+
+        trace = contextvars.copy_context().run(traced_conversion)
+        spans = {s.name: s for s in trace.spans}
+        worker_pid = spans['worker.run'].attributes['pid']
+        worker_spans = [s for s in trace.spans if s.pid == worker_pid]
+        self.assertIn('read_sheet', [s.name for s in worker_spans])
+        self.assertTrue(all(s.trace is trace for s in trace.spans))
+        span_ids = {s.span_id for s in trace.spans}
+        self.assertTrue(all(s.parent_id in span_ids for s in worker_spans))
+
+    def test_worker_profile_joins_the_request_profile(self):
+        from . import cpuprofile
+
+        profiler = cpuprofile.RequestProfiler(engine='cprofile')
+        profiler.start()
+        try:
+            self._convert()
+        finally:
+            profiler.stop()
+        functions = [item['function'] for item in profiler.top_functions(limit=None)]
+        self.assertIn('convert_sheets', functions)
+
+
+class ColumnProfileTests(SimpleTestCase):
+    def test_hyperloglog_estimates_distinct_count(self):
+        import numpy as np
+        import pandas as pd
+
+        from .profiling import HyperLogLog
+
+        hashes = pd.util.hash_array(np.arange(100_000))
+        sketch = HyperLogLog()
+        sketch.add(hashes)
+        estimate = sketch.count()
+        self.assertLess(abs(estimate - 100_000) / 100_000, 0.05)
+        sketch.add(hashes[:50_000])
+        self.assertEqual(sketch.count(), estimate)
+
+        small = HyperLogLog()
+        small.add(hashes[:100])
+        self.assertAlmostEqual(small.count(), 100, delta=2)
+
+    def test_profile_gathered_while_writing_chunks(self):
+        import numpy as np
+        import pandas as pd
+
+        from .exporters import write_dataframe
+        from .profiling import TableProfile
+
+        rows = 20_000
+        df = pd.DataFrame({
+            'id': np.arange(rows),
+            'city': pd.Series(['HCM', 'Hà Nội', 'HCM', 'Đà Nẵng'] * (rows // 4)),
+            'amount': np.where(np.arange(rows) % 10 == 0, np.nan, np.arange(rows) * 0.5),
+            'code': pd.Series([1 if i % 2 else 'A' for i in range(rows)], dtype=object),
+        })
+        profile = TableProfile()
+        with tempfile.TemporaryDirectory() as directory:
+            write_dataframe(df, os.path.join(directory, 'out.csv'), 'csv', chunk_rows=1000, profile=profile)
+        ids, cities, amounts, codes = profile.result()
+
+        self.assertEqual((ids['type'], ids['min'], ids['max'], ids['count']), ('integer', 0, rows - 1, rows))
+        self.assertFalse(ids['distinct_exact'])
+        self.assertLess(abs(ids['distinct'] - rows) / rows, 0.05)
+
+        self.assertTrue(cities['distinct_exact'])
+        self.assertEqual(cities['distinct'], 3)
+        self.assertEqual(cities['top_values'][0], {'value': 'HCM', 'count': 10_000, 'error': 0})
+        self.assertEqual(sorted((v['value'], v['count'], v['error']) for v in cities['top_values'][1:]),
+                         [('Hà Nội', 5_000, 0), ('Đà Nẵng', 5_000, 0)])
+
+        self.assertEqual((amounts['type'], amounts['null_count'], amounts['null_ratio']), ('float', 2_000, 0.1))
+        self.assertEqual(codes['type'], 'mixed')
+        self.assertIsNone(codes['min'])
+
+
+class HistoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _rows(self, count):
+        import datetime
+
+        started = datetime.datetime(2024, 5, 1, 12, 0, 0)
+        return [{
+            'id': count - i,
+            'conversion_timestamp': started - datetime.timedelta(minutes=i // 2),
+            'rows_processed': 10,
+            'columns_count': 2,
+            'status': 'success',
+            'filename': f'book{i}.xlsx',
+        } for i in range(count)]
+
+    def _queryset(self, rows):
+        from unittest import mock
+
+        queryset = mock.MagicMock()
+        queryset.values.return_value = queryset
+        queryset.filter.return_value = queryset
+        queryset.__getitem__.side_effect = lambda s: rows[s]
+        return queryset
+
+    def test_pages_are_cached_until_a_conversion_changes(self):
+        from unittest import mock
+
+        from django.db.models.signals import post_delete, post_save
+
+        from .history import get_history_page
+        from .models import ConversionHistory
+
+        queryset = self._queryset(self._rows(3))
+        with mock.patch.object(ConversionHistory.objects, 'order_by', return_value=queryset) as order_by:
+            first = get_history_page(limit=2)
+            self.assertEqual(get_history_page(limit=2), first)
+            self.assertEqual(order_by.call_count, 1)
+            get_history_page(limit=3)
+            self.assertEqual(order_by.call_count, 2)
+
+            for signal in (post_save, post_delete):
+                signal.send(sender=ConversionHistory, instance=ConversionHistory(id=1), created=True)
+                get_history_page(limit=2)
+            self.assertEqual(order_by.call_count, 4)
+
+        self.assertEqual([row['id'] for row in first['history']], [3, 2])
+        self.assertEqual(first['history'][0]['timestamp'], '2024-05-01 12:00:00')
+        self.assertEqual(first['history'][0]['columns_kept'], 2)
+
+    def test_cursor_continues_after_the_last_row(self):
+        from unittest import mock
+
+        from .history import MAX_PAGE_SIZE, decode_cursor, get_history_page, invalidate_history_cache
+        from .models import ConversionHistory
+
+        rows = self._rows(3)
+        queryset = self._queryset(rows)
+        with mock.patch.object(ConversionHistory.objects, 'order_by', return_value=queryset):
+            page = get_history_page(limit=2)
+            self.assertEqual(decode_cursor(page['next_cursor']), (rows[1]['conversion_timestamp'], 2))
+            get_history_page(cursor=page['next_cursor'], limit=2)
+            queryset.filter.assert_called_once()
+            queryset.__getitem__.assert_called_with(slice(None, 3))
+
+            invalidate_history_cache()
+            self.assertIsNone(get_history_page(limit=5)['next_cursor'])
+            get_history_page(limit=10_000)
+            queryset.__getitem__.assert_called_with(slice(None, MAX_PAGE_SIZE + 1))
+
+        with self.assertRaises(ValueError):
+            decode_cursor('not a cursor')
+
+
+class DeltaTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        media = override_settings(MEDIA_ROOT=self.directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def _base_conversion(self, df, key_columns):
+        """A previous conversion of df with its output and fingerprint index (not saved to the database)"""
+        from django.core.files.base import ContentFile
+
+        from .delta import row_fingerprints, save_fingerprint_index
+        from .models import ConversionHistory
+
+        conversion = ConversionHistory(id=1, columns_selected=list(df.columns), columns_removed=[],
+                                       rows_processed=len(df), key_columns=key_columns)
+        conversion.output_csv_path.save('sales.csv', ContentFile(df.to_csv(index=False).encode('utf-8-sig')),
+                                        save=False)
+        conversion.fingerprint_index = save_fingerprint_index(row_fingerprints(df, key_columns),
+                                                              conversion.output_csv_path.name)
+        return conversion
+
+    def _versions(self):
+        import pandas as pd
+
+        old = pd.DataFrame({'id': [1, 2, 3, 4, 5], 'name': list('abcde'), 'amount': [10, 20, 30, 40, 50]})
+        # Same values in other dtypes, row 3 edited, row 4 removed, row 6 added
+        new = pd.DataFrame({'id': [1.0, 2.0, 3.0, 5.0, 6.0], 'name': pd.Series(list('abxef'), dtype='category'),
+                            'amount': [10.0, 20.0, 30.0, 50.0, 60.0]})
+        return old, new
+
+    def test_keyed_delta(self):
+        from .delta import build_delta, row_fingerprints
+
+        old, new = self._versions()
+        base = self._base_conversion(old, ['id'])
+        delta, stats = build_delta(new, row_fingerprints(new, ['id']), base)
+        self.assertEqual({key: stats[key] for key in ('rows_added', 'rows_changed', 'rows_removed', 'rows_unchanged')},
+                         {'rows_added': 1, 'rows_changed': 1, 'rows_removed': 1, 'rows_unchanged': 3})
+        self.assertFalse(stats['columns_changed'])
+        self.assertEqual(delta['_change'].tolist(), ['changed', 'added', 'removed'])
+        self.assertEqual(delta['name'].astype(str).tolist(), ['x', 'f', 'd'])
+
+    def test_unkeyed_delta_reports_edits_as_removed_and_added(self):
+        from .delta import build_delta, row_fingerprints
+
+        old, new = self._versions()
+        base = self._base_conversion(old, [])
+        delta, stats = build_delta(new, row_fingerprints(new), base)
+        self.assertEqual((stats['rows_added'], stats['rows_changed'], stats['rows_removed'], stats['rows_unchanged']),
+                         (2, 0, 2, 3))
+        self.assertEqual(sorted(delta.loc[delta['_change'] == 'removed', 'name'].astype(str)), ['c', 'd'])
+
+    def test_without_base_every_row_is_added(self):
+        from .delta import build_delta, row_fingerprints
+
+        _, new = self._versions()
+        delta, stats = build_delta(new, row_fingerprints(new, ['id']))
+        self.assertEqual((stats['rows_added'], stats['base_conversion_id']), (5, None))
+        self.assertEqual(set(delta['_change']), {'added'})
+
+    def test_latest_base_of_each_file_is_kept_by_cleanup(self):
+        from unittest import mock
+
+        from .delta import delta_base_ids
+        from .utils import cleanup_old_instances
+
+        history = mock.MagicMock()
+        history.objects.filter.return_value.exclude.return_value.order_by.return_value.values_list.return_value = [
+            (5, 'sales.xlsx', ['id']), (4, 'stock.xlsx', []), (3, 'sales.xlsx', ['id']), (2, 'sales.xlsx', []),
+        ]
+        keep = delta_base_ids(history)
+        self.assertEqual(keep, [5, 4, 2])
+
+        instances = [mock.MagicMock(id=conversion_id, _meta=mock.MagicMock(fields=[])) for conversion_id in (9, 8, 3)]
+        remaining = mock.MagicMock()
+        remaining.count.return_value = len(instances)
+        remaining.__getitem__.side_effect = lambda item: instances[item]
+        history.objects.exclude.return_value = remaining
+        cleanup_old_instances(history, max_instances=2, keep=keep)
+        history.objects.exclude.assert_called_once_with(pk__in=[5, 4, 2])
+        self.assertEqual([instance.delete.called for instance in instances], [False, False, True])
+
+    def test_duplicate_keys_and_missing_key_column(self):
+        import pandas as pd
+
+        from .delta import row_fingerprints
+
+        df = pd.DataFrame({'id': [1, 1, 2], 'name': ['a', 'a', 'b']})
+        self.assertEqual(len(set(row_fingerprints(df, ['id'])['keys'])), 3)
+        with self.assertRaisesRegex(ValueError, 'Key columns not found: code'):
+            row_fingerprints(df, ['code'])
+
+
+class ProcessWorkbookTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        media = override_settings(MEDIA_ROOT=self.directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def _process(self, rows, output_name, **options):
+        from .tasks import process_workbook
+
+        path = write_workbook(os.path.join(self.directory.name, 'sales.xlsx'), [['id', 'name']] + rows)
+        return process_workbook(None, path, output_name, key_columns=['id'], **options)
+
+    def test_fingerprints_diffs_and_saves_in_the_job(self):
+        from django.core.files.storage import default_storage
+
+        from .models import ConversionHistory
+
+        first = self._process([[1, 'a'], [2, 'b'], [3, 'c']], 'sales_1.csv')
+        self.assertEqual((first['columns'], first['preview'][0], first['delta']),
+                         (['id', 'name'], {'id': 1, 'name': 'a'}, None))
+        self.assertTrue(default_storage.exists(first['fingerprint_index']))
+        # Only names and small dicts come back from the worker
+        self.assertLess(len(json.dumps(first)), 2048)
+
+        base = ConversionHistory(id=1, output_csv_path=first['output_path'], output_format='csv',
+                                 fingerprint_index=first['fingerprint_index'], key_columns=['id'])
+        second = self._process([[1, 'a'], [2, 'x'], [4, 'd']], 'sales_2_delta.csv', delta=True, delta_base=base)
+        self.assertEqual({key: second['delta'][key] for key in ('rows_added', 'rows_changed', 'rows_removed')},
+                         {'rows_added': 1, 'rows_changed': 1, 'rows_removed': 1})
+        with default_storage.open(second['output_path'], 'rb') as f:
+            lines = f.read().decode('utf-8-sig').splitlines()
+        self.assertEqual(lines, ['_change,id,name', 'changed,2,x', 'added,4,d', 'removed,3,c'])
+
+
+@override_settings(EXCEL_WORKER_PROCESSES=0, EXCEL_CONVERSION_SLOTS=0)
+class SimpleViewHistoryTests(SimpleTestCase):
+    def setUp(self):
+        from unittest import mock
+
+        from . import views_simple
+        from .models import ConversionHistory, UploadedFile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        media = override_settings(MEDIA_ROOT=self.directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.recorded = []
+        patches = [
+            mock.patch.object(UploadedFile.objects, 'create', lambda **fields: UploadedFile(id=1, **fields)),
+            mock.patch.object(ConversionHistory.objects, 'create',
+                              lambda **fields: self.recorded.append(fields) or ConversionHistory(**fields)),
+            mock.patch.object(UploadedFile.objects, 'filter'),
+            mock.patch.object(views_simple, 'cleanup_old_instances'),
+            mock.patch.object(views_simple, 'delta_base_ids', return_value=[]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _upload(self, rows, **fields):
+        path = write_workbook(os.path.join(self.directory.name, 'sales.xlsx'), rows)
+        with open(path, 'rb') as f:
+            return self.client.post('/excel/upload-simple/', dict(file_path=f, ignore_profiles='on', **fields))
+
+    def test_single_sheet_upload_is_recorded(self):
+        response = self._upload([['id', 'name'], [1, 'a'], [2, 'b']], output_format='ndjson')
+        self.assertTrue(response.json()['success'], response.content)
+        conversion, = self.recorded
+        self.assertEqual(os.path.basename(conversion['output_csv_path']), response.json()['filename'])
+        self.assertEqual((conversion['output_format'], conversion['columns_selected'], conversion['rows_processed']),
+                         ('ndjson', ['id', 'name'], 2))
+        self.assertEqual(conversion['uploaded_file'].original_filename, 'sales.xlsx')
+        self.assertEqual([column['name'] for column in conversion['column_profile']], ['id', 'name'])
+        self.assertIn('ratio', conversion['memory_stats'])
+
+    def test_zip_of_all_sheets_is_recorded(self):
+        import openpyxl
+
+        path = os.path.join(self.directory.name, 'book.xlsx')
+        workbook = openpyxl.Workbook()
+        workbook.active.append(['id'])
+        workbook.active.append([1])
+        second = workbook.create_sheet('Other')
+        for row in (['id'], [2], [3]):
+            second.append(row)
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            upload = self.client.post('/excel/upload-simple/', {'file_path': f, 'ignore_profiles': 'on'}).json()
+        self.assertEqual(self.recorded, [])
+
+        response = self.client.post('/excel/download-zip/', json.dumps({
+            'temp_file': upload['temp_file'], 'original_filename': 'book.xlsx',
+        }), content_type='application/json')
+        self.assertTrue(response.json()['success'], response.content)
+        conversion, = self.recorded
+        self.assertEqual(os.path.basename(conversion['output_csv_path']), response.json()['filename'])
+        self.assertEqual((conversion['rows_processed'], conversion['uploaded_file'].original_filename),
+                         (3, 'book.xlsx'))
+
+
+CANCEL_PROBE = """
+import json, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
+import django
+django.setup()
+from tool.progress import get_progress, request_cancel
+request_cancel('job-shared-1')
+print(json.dumps(get_progress('job-shared-1')))
+"""
+
+
+class ProgressTests(SimpleTestCase):
+    def setUp(self):
+        from .progress import shared_cache
+
+        shared_cache.clear()
+        self.addCleanup(shared_cache.clear)
+
+    def test_state_and_cancellation_are_shared_between_processes(self):
+        from .progress import ConversionCancelled, ProgressTracker
+
+        tracker = ProgressTracker('job-shared-1', {'Data': 10})
+        tracker.start(['Data'])
+        state = run_probe(CANCEL_PROBE)
+        self.assertEqual((state['status'], state['sheet_count']), ('running', 1))
+        with self.assertRaises(ConversionCancelled):
+            tracker.start_sheet(0, 'Data')
+
+
+SINGLEFLIGHT_PROBE = """
+import json, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
+import django
+django.setup()
+from tool.singleflight import run_once
+outcome, shared = run_once('k', 'f', None, lambda: {'status': 200, 'content': 'other process'})
+print(json.dumps(shared))
+"""
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        from .progress import shared_cache
+
+        shared_cache.clear()
+        self.addCleanup(shared_cache.clear)
+
+    def test_request_key(self):
+        from django.test import RequestFactory
+
+        from .singleflight import IdempotencyKeyError, request_key
+
+        factory = RequestFactory()
+        request = factory.post('/excel/process-sheets/')
+        key, fingerprint = request_key(request, {'temp_file': 'a.xlsx', 'job_id': 'first'})
+        self.assertEqual(key, fingerprint)
+        self.assertEqual(request_key(request, {'temp_file': 'a.xlsx', 'job_id': 'retry'}), (key, fingerprint))
+        self.assertNotEqual(request_key(request, {'temp_file': 'b.xlsx'})[0], key)
+
+        keyed = factory.post('/excel/process-sheets/', HTTP_IDEMPOTENCY_KEY='order-42')
+        header_key, header_fingerprint = request_key(keyed, {'temp_file': 'a.xlsx'})
+        self.assertEqual(header_fingerprint, fingerprint)
+        self.assertNotEqual(header_key, fingerprint)
+        with self.assertRaises(IdempotencyKeyError):
+            request_key(factory.post('/', HTTP_IDEMPOTENCY_KEY='has space'), {})
+
+    def test_concurrent_duplicates_share_one_run(self):
+        import threading
+
+        from .singleflight import run_once
+
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def convert():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return {'status': 200, 'content': {'ok': True}}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(run_once('k', 'f', None, convert)))
+        leader.start()
+        started.wait(10)
+        duplicates = [threading.Thread(target=lambda: results.append(run_once('k', 'f', None, convert)))
+                      for _ in range(3)]
+        for thread in duplicates:
+            thread.start()
+        release.set()
+        for thread in [leader] + duplicates:
+            thread.join(10)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True])
+        self.assertTrue(all(outcome['content'] == {'ok': True} for outcome, _ in results))
+
+        # A retry after it finished gets the stored outcome
+        self.assertEqual(run_once('k', 'f', None, convert), ({'status': 200, 'content': {'ok': True}}, True))
+        self.assertEqual(len(calls), 1)
+
+    def test_failures_are_not_replayed_and_keys_are_bound_to_parameters(self):
+        from .singleflight import IdempotencyKeyError, run_once
+
+        outcomes = iter([{'status': 500, 'content': 'error'}, {'status': 200, 'content': 'done'}])
+        self.assertEqual(run_once('k', 'f', None, lambda: next(outcomes)), ({'status': 500, 'content': 'error'}, False))
+        self.assertEqual(run_once('k', 'f', None, lambda: next(outcomes)), ({'status': 200, 'content': 'done'}, False))
+        with self.assertRaises(IdempotencyKeyError):
+            run_once('k', 'other parameters', None, lambda: {'status': 200, 'content': 'again'})
+
+    def test_retries_in_another_process_get_the_outcome(self):
+        from .singleflight import run_once
+
+        self.assertFalse(run_probe(SINGLEFLIGHT_PROBE))
+        outcome, shared = run_once('k', 'f', None, lambda: self.fail('ran twice'))
+        self.assertEqual((outcome['content'], shared), ('other process', True))
+
+    def test_waits_for_another_process_holding_the_lease(self):
+        import threading
+        from unittest import mock
+
+        from . import singleflight
+        from .progress import shared_cache as cache
+
+        cache.add(singleflight._lease_key('k'), {'fingerprint': 'f', 'job_id': None})
+
+        def finish_elsewhere():
+            cache.set(singleflight._result_key('k'),
+                      {'fingerprint': 'f', 'outcome': {'status': 200, 'content': 'remote'}})
+            cache.delete(singleflight._lease_key('k'))
+
+        timer = threading.Timer(0.1, finish_elsewhere)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        with mock.patch.object(singleflight, 'WAIT_POLL_INTERVAL', 0.01):
+            outcome, shared = singleflight.run_once('k', 'f', None, lambda: self.fail('ran twice'))
+        self.assertEqual((outcome['content'], shared), ('remote', True))
+
+
+class InspectorTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = write_workbook(os.path.join(self.directory.name, 'book.xlsx'),
+                                   [['id', 'name']] + [[i, f'name {i}'] for i in range(5000)])
+
+    def test_reads_dimensions_from_metadata(self):
+        from .inspector import inspect_workbook
+
+        sheet, = inspect_workbook(self.path)['sheets']
+        self.assertEqual((sheet['name'], sheet['rows'], sheet['columns']), ('Data', 5001, 2))
+        self.assertEqual((sheet['cells'], sheet['cells_estimated']), (10002, False))
+
+    def test_stale_or_missing_dimension_falls_back_to_the_sheet_size(self):
+        from .inspector import SHEET_BYTES_PER_CELL, WorkbookLimitError, check_workbook_limits, inspect_workbook
+        from .scheduler import estimate_cost, lane_for
+
+        for dimension in (b'<dimension ref="A1"/>', b''):
+            rewrite_sheet_xml(self.path, lambda xml: re.sub(rb'<dimension ref="[^"]+" ?/>', dimension, xml))
+            info = inspect_workbook(self.path)
+            sheet, = info['sheets']
+            self.assertEqual((sheet['rows'], sheet['columns'], sheet['cells_estimated']), (None, None, True))
+            self.assertEqual(sheet['cells'], sheet['uncompressed_size'] // SHEET_BYTES_PER_CELL)
+            self.assertEqual(info['total_cells'], sheet['cells'])
+            with override_settings(EXCEL_FAST_LANE_MAX_CELLS=10_000):
+                self.assertEqual(lane_for(estimate_cost(info)), 'bulk')
+            with override_settings(EXCEL_MAX_CELLS=10_000), self.assertRaises(WorkbookLimitError):
+                check_workbook_limits(info)
+
+
+    @unittest.skipUnless(HAS_XLWT, 'xlwt is needed to write .xls workbooks')
+    def test_xls_metadata_with_and_without_xlrd_private_attributes(self):
+        from unittest import mock
+
+        from . import inspector
+        from .readers import open_xls_book
+
+        path = write_xls(os.path.join(self.directory.name, 'book.xls'), {
+            'Data': [['id', 'name'], [1, 'a'], [2, 'b']],
+            'hidden sheet': [['x']],
+        })
+
+        def without_private_attributes(source):
+            book = open_xls_book(source)
+            del book._sh_abs_posn
+            return book
+
+        expected = [('Data', 'visible', 3, 2), ('hidden sheet', 'hidden', 1, 1)]
+        for opener in (open_xls_book, without_private_attributes):
+            with mock.patch.object(inspector, 'open_xls_book', opener):
+                info = inspector.inspect_workbook(path)
+            self.assertEqual(info['format'], 'xls')
+            self.assertEqual([(sheet['name'], sheet['state'], sheet['rows'], sheet['columns'])
+                              for sheet in info['sheets']], expected)
+
+
+class ConversionSchedulerTests(SimpleTestCase):
+    def _queue(self, scheduler, jobs, admitted):
+        """Start a thread per job that records its admission and leaves its slot at once"""
+        import threading
+        import time
+
+        def run(job):
+            scheduler.acquire(job)
+            admitted.append(job)
+            scheduler.release(job)
+
+        threads = []
+        for job in jobs:
+            threads.append(threading.Thread(target=run, args=(job,)))
+            threads[-1].start()
+            # Queue them in order, so ties are decided by arrival
+            while len(scheduler._waiting) < len(threads):
+                time.sleep(0.001)
+        return threads
+
+    def test_estimate_cost_and_lane(self):
+        from .scheduler import BYTES_PER_CELL, estimate_cost, lane_for
+
+        info = {'uncompressed_size': 64_000, 'sheets': [
+            {'name': 'a', 'rows': 100, 'columns': 10},
+            {'name': 'b', 'rows': None, 'columns': None, 'uncompressed_size': 1600},
+            {'name': 'c', 'rows': 0, 'columns': 0},
+        ]}
+        self.assertEqual(estimate_cost(info), 1000 + 1600 // BYTES_PER_CELL)
+        self.assertEqual(estimate_cost(info, ['a']), 1000)
+        self.assertEqual(estimate_cost(info, ['c']), 1)
+        with override_settings(EXCEL_FAST_LANE_MAX_CELLS=1000):
+            self.assertEqual((lane_for(1000), lane_for(1001)), ('fast', 'bulk'))
+
+    def test_cheapest_queued_conversion_runs_first(self):
+        from .scheduler import ConversionScheduler, _Job
+
+        scheduler = ConversionScheduler(1, 0, aging_seconds=3600)
+        running = _Job(1, 'x', 'bulk')
+        scheduler.acquire(running)
+        admitted = []
+        jobs = [_Job(100, 'a', 'bulk'), _Job(10, 'b', 'bulk'), _Job(50, 'c', 'bulk'), _Job(10, 'd', 'bulk')]
+        threads = self._queue(scheduler, jobs, admitted)
+        scheduler.release(running)
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([job.cost for job in admitted], [10, 10, 50, 100])
+        self.assertEqual([job.client for job in admitted][:2], ['b', 'd'])
+
+    def test_fast_lane_keeps_a_slot(self):
+        from .scheduler import ConversionScheduler, _Job
+
+        scheduler = ConversionScheduler(2, 1, aging_seconds=3600)
+        bulk = _Job(10**7, 'a', 'bulk')
+        scheduler.acquire(bulk)
+        admitted = []
+        threads = self._queue(scheduler, [_Job(10**7, 'b', 'bulk')], admitted)
+        fast = _Job(100, 'c', 'fast')
+        scheduler.acquire(fast)
+        self.assertEqual(admitted, [])
+        scheduler.release(fast)
+        scheduler.release(bulk)
+        threads[0].join(10)
+        self.assertEqual(len(admitted), 1)
+
+    def test_aging_and_per_client_fairness(self):
+        import time
+
+        from .scheduler import ConversionScheduler, _Job
+
+        scheduler = ConversionScheduler(4, 0, aging_seconds=1)
+        large, small = _Job(1_000_000, 'a', 'bulk'), _Job(5_000, 'b', 'bulk')
+        # Waiting ten aging periods divides the large job's cost by 1024
+        large.enqueued = time.monotonic() - 10
+        scheduler._waiting = [small, large]
+        self.assertIs(scheduler._next(), large)
+
+        busy, other = _Job(100, 'busy', 'bulk'), _Job(150, 'other', 'bulk')
+        scheduler._waiting = [busy, other]
+        self.assertIs(scheduler._next(), busy)
+        scheduler._client_running['busy'] = 1
+        self.assertIs(scheduler._next(), other)
+
+    def test_cancelled_conversion_leaves_the_queue(self):
+        from .progress import ConversionCancelled
+        from .scheduler import ConversionScheduler, _Job
+
+        scheduler = ConversionScheduler(1, 0, aging_seconds=3600)
+        running = _Job(1, 'a', 'bulk')
+        scheduler.acquire(running)
+
+        def cancel():
+            raise ConversionCancelled('Conversion cancelled')
+
+        with self.assertRaises(ConversionCancelled):
+            scheduler.acquire(_Job(1, 'b', 'bulk'), check_cancelled=cancel)
+        self.assertEqual(scheduler._waiting, [])
+        scheduler.release(running)
+        scheduler.acquire(_Job(1, 'c', 'bulk'))
+
+
+class ConversionProfileTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        rows = [['回収情報 2024-01'], ['id', 'name', 'amount', None, 'date']]
+        for i in range(30):
+            rows.append([i, f'name {i}', i * 1.5 if i % 5 else None, f'note {i}', f'2024-01-{i % 28 + 1:02d}'])
+        self.path = write_workbook(os.path.join(self.directory.name, 'HKKSZFIL_回収情報Ｆ_20240131.xlsx'), rows)
+
+    def _profile(self, **fields):
+        from .models import ConversionProfile
+
+        defaults = {
+            'name': 'monthly', 'skip_rows': 1, 'columns': ['id', 'name', 'amount', 'Unnamed: 3'],
+            'dtypes': {'id': 'integer', 'name': 'text', 'amount': 'float', 'Unnamed: 3': 'category'},
+            'output_format': 'csv',
+        }
+        return ConversionProfile(**dict(defaults, **fields))
+
+    def _match(self, filename, profiles):
+        from unittest import mock
+
+        from . import conversion_profiles
+
+        with mock.patch.object(conversion_profiles.ConversionProfile.objects, 'all', return_value=profiles):
+            return conversion_profiles.match_profile(filename, self.path, ['Data'])
+
+    def test_filename_pattern(self):
+        import fnmatch
+
+        from .conversion_profiles import filename_pattern_for
+
+        pattern = filename_pattern_for('HKKSZFIL_回収情報Ｆ_20240131[1].xlsx')
+        self.assertEqual(pattern, 'HKKSZFIL_回収情報Ｆ_*[[]*[]].xlsx')
+        self.assertTrue(fnmatch.fnmatch('HKKSZFIL_回収情報Ｆ_20240229[2].xlsx', pattern))
+        self.assertFalse(fnmatch.fnmatch('HKKSZFIL_回収情報Ｆ_20240229.xlsx', pattern))
+
+    def test_match_by_filename_then_header(self):
+        from .conversion_profiles import header_fingerprint
+        from .readers import read_header
+
+        fingerprint = header_fingerprint(read_header(self.path, 'Data', 1))
+        by_name = self._profile(filename_pattern='hkkszfil_回収情報Ｆ_*.xlsx')
+        changed = self._profile(name='changed', filename_pattern='HKKSZFIL_*.xlsx', columns=['id', 'code'])
+        by_header = self._profile(name='header', header_fingerprint=fingerprint)
+
+        match, rejected = self._match('HKKSZFIL_回収情報Ｆ_20240229.xlsx', [changed, by_name, by_header])
+        self.assertEqual((match.profile.name, match.matched_by, match.sheets), ('monthly', 'filename', ['Data']))
+        self.assertEqual(rejected, [])
+
+        match, rejected = self._match('renamed.xlsx', [changed, by_header])
+        self.assertEqual((match.profile.name, match.matched_by), ('header', 'header'))
+
+        match, rejected = self._match('HKKSZFIL_2024.xlsx', [changed])
+        self.assertIsNone(match)
+        self.assertEqual(rejected, [{'name': 'changed', 'reason': 'sheet Data has no column code in row 2'}])
+
+    def test_fast_path_reads_saved_columns_in_saved_types(self):
+        import pandas as pd
+
+        from .progress import ProgressTracker
+        from .readers import read_sheet_streamed
+        from .tasks import convert_with_profile
+
+        output_path = os.path.join(self.directory.name, 'out.csv')
+        result, = convert_with_profile(ProgressTracker(), self.path, self._profile(), [('Data', output_path)])
+        self.assertEqual((result['rows'], result['columns']), (30, 4))
+        self.assertEqual(result['reading']['unnamed_columns_renamed'], 1)
+
+        expected, _ = read_sheet_streamed(self.path, 'Data', skip_rows=1)
+        expected = expected[['id', 'name', 'amount', 'Unnamed: 3']].rename(columns={'Unnamed: 3': 'Extra_Info_1'})
+        written = pd.read_csv(output_path, encoding='utf-8-sig')
+        pd.testing.assert_frame_equal(written, expected, check_dtype=False)
+
+    def test_layout_change_is_reported(self):
+        from .conversion_profiles import ProfileMismatch, read_with_profile
+
+        with self.assertRaisesRegex(ProfileMismatch, 'name of sheet Data is not integer'):
+            read_with_profile(self.path, 'Data', self._profile(dtypes={'name': 'integer'}))
+        with self.assertRaises(ProfileMismatch):
+            read_with_profile(self.path, 'Data', self._profile(columns=['id', 'code']))
+
+    def test_save_profile(self):
+        from unittest import mock
+
+        from . import conversion_profiles
+
+        with mock.patch.object(conversion_profiles.ConversionProfile.objects, 'update_or_create',
+                               return_value=(None, True)) as update_or_create:
+            conversion_profiles.save_profile('monthly', 'HKKSZFIL_20240131.xlsx', self.path, ['Data'], 1,
+                                             ['id', 'amount'], ['integer', 'float'], 'parquet')
+        defaults = update_or_create.call_args.kwargs['defaults']
+        self.assertEqual(defaults['filename_pattern'], 'HKKSZFIL_*.xlsx')
+        self.assertEqual(defaults['header_fingerprint'],
+                         conversion_profiles.header_fingerprint(['id', 'name', 'amount', 'Unnamed: 3', 'date']))
+        self.assertEqual(defaults['dtypes'], {'id': 'integer', 'amount': 'float'})
+
+
+def profiled_view(request):
+    from django.http import HttpResponse
+
+    return HttpResponse('done')
+
+
+class ViewHookMiddleware:
+    """Records the process_view calls it gets, to check earlier middleware let them through"""
+
+    calls = []
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.calls.append(view_func.__name__)
+
+
+# URLconf of SlowRequestProfileTests (ROOT_URLCONF = 'tool.tests')
+urlpatterns = [path('profiled/', profiled_view, name='profiled')]
+
+
+@override_settings(
+    ROOT_URLCONF='tool.tests',
+    MIDDLEWARE=['tool.middleware.SlowRequestProfileMiddleware', 'tool.tests.ViewHookMiddleware'],
+    EXCEL_SLOW_REQUEST_PROFILING=True,
+    EXCEL_SLOW_REQUEST_SECONDS=0,
+    EXCEL_SLOW_REQUEST_VIEWS=['profiled'],
+)
+class SlowRequestProfileTests(SimpleTestCase):
+    def setUp(self):
+        import functools
+        from unittest import mock
+
+        from . import middleware
+        from .cpuprofile import RequestProfiler
+
+        ViewHookMiddleware.calls = []
+        self.saved = []
+        # cProfile sees every call, however short the view
+        patches = [
+            mock.patch.object(middleware, 'RequestProfiler', functools.partial(RequestProfiler, engine='cprofile')),
+            mock.patch.object(middleware.SlowRequestProfileMiddleware, '_save_profile',
+                              lambda _, request, response, profiler, duration: self.saved.append(profiler)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _profiled_functions(self):
+        profiler, = self.saved
+        return [item['function'] for item in profiler.top_functions(limit=None)]
+
+    def test_profiles_the_view_and_runs_later_process_view_hooks(self):
+        self.assertEqual(self.client.get('/profiled/').content, b'done')
+        self.assertEqual(ViewHookMiddleware.calls, ['profiled_view'])
+        self.assertIn('profiled_view', self._profiled_functions())
+
+    async def test_profiles_sync_views_under_asgi(self):
+        response = await self.async_client.get('/profiled/')
+        self.assertEqual(response.content, b'done')
+        self.assertIn('profiled_view', self._profiled_functions())
+
+    def test_other_views_are_not_profiled(self):
+        self.assertEqual(self.client.get('/missing/').status_code, 404)
+        self.assertEqual(self.saved, [])
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+
+        from . import metrics
+
+        metrics.cache.clear()
+        self.addCleanup(metrics.cache.clear)
+        self.addCleanup(cache.clear)
+
+    def test_series_survive_a_full_default_cache(self):
+        from django.core.cache import cache
+
+        from . import metrics
+
+        metrics.conversions_running.inc(lane='bulk')
+        metrics.queue_wait_seconds.observe(0.3, lane='fast')
+        for i in range(1000):
+            cache.set(f'sample:{i}', i)
+        metrics.conversions_running.dec(lane='bulk')
+
+        text = metrics.render_metrics()
+        self.assertIn('excel_conversions_running{lane="bulk"} 0\n', text)
+        self.assertIn('excel_conversion_queue_wait_seconds_bucket{lane="fast",le="0.5"} 1\n', text)
+        self.assertIn('excel_conversion_queue_wait_seconds_sum{lane="fast"} 0.3\n', text)
+
+
+class LoadTestServer:
+    """Stand-in for the conversion endpoints the load test drives"""
+
+    def __init__(self, single_sheet=True, fail_uploads=False):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        stub = self
+        self.requests = []
+        self.single_sheet = single_sheet
+        self.fail_uploads = fail_uploads
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload, headers=()):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stub.requests.append(('GET', self.path, self.headers.get('Cookie')))
+                if self.path == '/excel/simple/':
+                    self._reply(200, {}, [('Set-Cookie', 'csrftoken=token123; Path=/')])
+                else:
+                    self._reply(200, {'file': self.path})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                stub.requests.append(('POST', self.path, self.headers.get('X-CSRFToken')))
+                if stub.fail_uploads:
+                    self._reply(500, {'success': False})
+                elif self.path == '/excel/upload-simple/':
+                    self._reply(200, {
+                        'success': True, 'single_sheet': stub.single_sheet, 'download_url': '/excel/download/a.csv',
+                        'temp_file': 'temp/a.xlsx', 'original_filename': 'a.xlsx', 'sheets': ['A', 'B'],
+                        'header_suggestions': {'A': {'skip_rows': 2}, 'B': None},
+                    })
+                elif self.path == '/excel/download-zip/':
+                    self._reply(200, {'success': True, 'download_url': '/excel/download/a.zip'})
+                else:
+                    self._reply(200, {'success': True, 'results': [
+                        {'download_url': '/excel/download/A.csv'}, {'error': 'empty'},
+                    ]})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/excel'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LoadTestHarnessTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.workbook = write_workbook(os.path.join(self.directory.name, 'book.xlsx'), [['id'], [1]])
+
+    def _run(self, sessions=4, **stub_options):
+        from .loadtest import run_load
+
+        stub = LoadTestServer(**stub_options)
+        self.addCleanup(stub.close)
+        report = run_load(stub.url, {'small': [self.workbook]}, {'small': 1}, concurrency=2, duration=30,
+                          sessions=sessions, timeout=10, server_pid=os.getpid(), sample_interval=0.05)
+        return stub, report
+
+    def test_single_sheet_sessions(self):
+        stub, report = self._run()
+        self.assertEqual((report['sessions'], report['session_errors']), (4, 0))
+        endpoints = report['endpoints']
+        self.assertEqual({name: stats['requests'] for name, stats in endpoints.items()},
+                         {'page': 2, 'upload-simple': 4, 'download-simple': 4})
+        self.assertLessEqual(endpoints['upload-simple']['p50_ms'], endpoints['upload-simple']['max_ms'])
+        self.assertEqual({token for method, _, token in stub.requests if method == 'POST'}, {'token123'})
+        self.assertGreater(report['rss']['peak'], 0)
+
+    def test_multi_sheet_sessions_and_failures(self):
+        import random
+
+        from .loadtest import Client, Recorder, run_session
+
+        stub = LoadTestServer(single_sheet=False)
+        self.addCleanup(stub.close)
+        recorder = Recorder()
+        client = Client(stub.url, recorder, timeout=10)
+        self.addCleanup(client.close)
+        for zip_ratio in (1, 0):
+            run_session(client, self.workbook, random.Random(0), zip_ratio, 'csv')
+        self.assertEqual([(method, path) for method, path, _ in stub.requests], [
+            ('GET', '/excel/simple/'),
+            ('POST', '/excel/upload-simple/'), ('POST', '/excel/download-zip/'), ('GET', '/excel/download/a.zip'),
+            ('POST', '/excel/upload-simple/'), ('POST', '/excel/process-sheets/'), ('GET', '/excel/download/A.csv'),
+        ])
+
+        _, report = self._run(sessions=3, fail_uploads=True)
+        self.assertEqual((report['sessions'], report['session_errors']), (3, 3))
+        self.assertEqual(report['endpoints']['upload-simple']['error_kinds'], {'HTTP 500': 3})
+        self.assertEqual(report['endpoints']['upload-simple']['error_rate'], 1)
+
+    def test_mix_and_percentiles(self):
+        from .loadtest import parse_mix, percentile
+
+        self.assertEqual(parse_mix('small=6, large'), {'small': 6, 'large': 1})
+        for text in ('huge=1', 'small=0', ''):
+            with self.assertRaises(ValueError):
+                parse_mix(text)
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, f) for f in (0.5, 0.95, 0.99, 1)], [50, 95, 99, 100])
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_command_reports_each_stage(self):
+        import io
+
+        from django.core.management import CommandError, call_command
+
+        stub = LoadTestServer()
+        self.addCleanup(stub.close)
+        report_path = os.path.join(self.directory.name, 'report.json')
+        out = io.StringIO()
+        call_command('loadtest', url=stub.url, concurrency='1,2', sessions=2, mix='small=1', variants=1,
+                     json_path=report_path, stdout=out)
+        with open(report_path, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual([(stage['concurrency'], stage['sessions']) for stage in report['stages']], [(1, 2), (2, 2)])
+        self.assertIn('upload-simple', out.getvalue())
+
+        for options in ({'mix': 'huge=1'}, {'concurrency': '0'}, {'env': ['EXCEL_PREWARM']}):
+            with self.assertRaises(CommandError):
+                call_command('loadtest', url=stub.url, stdout=io.StringIO(), **options)
+
+    def test_generated_workbooks_differ_between_variants(self):
+        import openpyxl
+
+        from .loadtest import generate_workbooks
+
+        workbooks = generate_workbooks(self.directory.name, {'small': 1}, variants=2)
+        first, second = (openpyxl.load_workbook(path, read_only=True) for path in workbooks['small'])
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        first_rows, second_rows = (list(book.active.values) for book in (first, second))
+        self.assertEqual(len(first_rows), 203)
+        self.assertEqual(first_rows[2][:2], ('Mã', 'Khách hàng'))
+        self.assertNotEqual(first_rows[3:], second_rows[3:])
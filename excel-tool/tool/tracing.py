@@ -0,0 +1,338 @@
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+# Request header that turns tracing on for one request (any value but 0)
+TRACE_HEADER = 'X-Excel-Trace'
+
+# Response header naming the trace file of a traced request
+TRACE_ID_HEADER = 'X-Excel-Trace-Id'
+
+_trace = ContextVar('excel_trace', default=None)
+_parent = ContextVar('excel_trace_span', default=None)
+
+
+class _NoopSpan:
+    """Span returned while no trace is recorded: every call is a no-op"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """A timed step of a traced request, with attributes (rows, columns, bytes, engine, ...)"""
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = None
+        self.start_ns = None
+        self.end_ns = None
+        self.pid = os.getpid()
+        self.thread_id = None
+        self.error = None
+
+    def __enter__(self):
+        self.parent_id = _parent.get()
+        self._token = _parent.set(self.span_id)
+        self.thread_id = threading.get_native_id()
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _parent.reset(self._token)
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        self.trace.spans.append(self)
+        return False
+
+    def set(self, **attributes):
+        """Add attributes known only once the step ran (e.g. rows read)"""
+        self.attributes.update(attributes)
+
+
+def span(name, **attributes):
+    """
+    Context manager recording a step of the current request's trace
+
+    Steps nest: a span opened inside another one is its child. Outside a
+    traced request it costs a context variable lookup.
+
+    Args:
+        name: Step name (e.g. 'read_sheet')
+        **attributes: Step attributes; more can be added with .set()
+
+    Example:
+        with span('read_sheet', sheet=sheet_name) as s:
+            df = ...
+            s.set(rows=len(df), columns=len(df.columns))
+    """
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return Span(trace, name, attributes)
+
+
+def tracing_active():
+    """True while the current request is traced"""
+    return _trace.get() is not None
+
+
+def current_trace_id():
+    """Id of the current request's trace (None when it is not traced)"""
+    trace = _trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class Trace:
+    """Spans recorded for one request"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.started = time.time()
+        self.spans = []
+
+
+def trace_context():
+    """
+    What another process needs to record spans of the current trace (see
+    continue_trace())
+
+    Returns:
+        tuple (trace id, id of the current span), or None when not traced
+    """
+    trace = _trace.get()
+    if trace is None:
+        return None
+    return trace.trace_id, _parent.get()
+
+
+def continue_trace(context):
+    """
+    Record the spans of this context as part of another process's trace
+
+    Args:
+        context: tuple from trace_context() in that process; spans opened
+            here are children of its current span
+
+    Returns:
+        Trace whose spans are sent back with export_spans()
+    """
+    trace_id, parent_id = context
+    trace = Trace(trace_id)
+    _trace.set(trace)
+    _parent.set(parent_id)
+    return trace
+
+
+def export_spans(trace):
+    """The spans of a trace as plain dicts, to be added to another process's trace with add_spans()"""
+    return [
+        {
+            'name': s.name,
+            'attributes': {key: _json_attribute(value) for key, value in s.attributes.items()},
+            'span_id': s.span_id,
+            'parent_id': s.parent_id,
+            'start_ns': s.start_ns,
+            'end_ns': s.end_ns,
+            'pid': s.pid,
+            'thread_id': s.thread_id,
+            'error': s.error,
+        }
+        for s in trace.spans
+    ]
+
+
+def add_spans(records):
+    """Add spans recorded by another process (export_spans()) to the current trace"""
+    trace = _trace.get()
+    if trace is None:
+        return
+    for record in records:
+        s = Span(trace, record['name'], record['attributes'])
+        for key in ('span_id', 'parent_id', 'start_ns', 'end_ns', 'pid', 'thread_id', 'error'):
+            setattr(s, key, record[key])
+        trace.spans.append(s)
+
+
+def start_trace(request):
+    """
+    Start a trace for the request when asked by header or picked by sampling
+
+    Returns:
+        Trace, or None when the request is not traced
+    """
+    header = request.headers.get(TRACE_HEADER)
+    if header is not None:
+        if header.strip() in ('', '0'):
+            return None
+    elif not settings.EXCEL_TRACE_SAMPLE_RATE or random.random() >= settings.EXCEL_TRACE_SAMPLE_RATE:
+        return None
+
+    trace = Trace()
+    _trace.set(trace)
+    _parent.set(None)
+    return trace
+
+
+def _json_attribute(value):
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    return str(value)
+
+
+def _chrome_trace(trace, root_name):
+    """Chrome trace-event JSON (chrome://tracing, Perfetto, speedscope)"""
+    pid = os.getpid()
+    events = []
+    # Spans run in worker processes (see workers.py) are shown under their own process
+    for span_pid in sorted({pid} | {s.pid for s in trace.spans}):
+        events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': span_pid, 'tid': 0,
+            'args': {'name': 'excel-tool' if span_pid == pid else f'excel-tool worker {span_pid}'},
+        })
+    for span_pid, thread_id in sorted({(s.pid, s.thread_id) for s in trace.spans}):
+        events.append({
+            'name': 'thread_name', 'ph': 'M', 'pid': span_pid, 'tid': thread_id,
+            'args': {'name': f'thread {thread_id}'},
+        })
+
+    # Parents first, so viewers stack spans that start in the same microsecond correctly
+    for s in sorted(trace.spans, key=lambda s: (s.start_ns, -s.end_ns)):
+        args = {key: _json_attribute(value) for key, value in s.attributes.items()}
+        if s.error:
+            args['error'] = s.error
+        events.append({
+            'name': s.name,
+            'cat': 'excel',
+            'ph': 'X',
+            'ts': s.start_ns / 1000,
+            'dur': (s.end_ns - s.start_ns) / 1000,
+            'pid': s.pid,
+            'tid': s.thread_id,
+            'args': args,
+        })
+
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'trace_id': trace.trace_id, 'request': root_name},
+    }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_trace(trace, root_name):
+    """OTLP/JSON trace (importable by OpenTelemetry collectors, Jaeger, Tempo)"""
+    pid = os.getpid()
+    spans = []
+    for s in sorted(trace.spans, key=lambda s: s.start_ns):
+        attributes = dict(s.attributes)
+        if s.pid != pid:
+            attributes['process.pid'] = s.pid
+        spans.append({
+            'traceId': trace.trace_id,
+            'spanId': s.span_id,
+            'parentSpanId': s.parent_id or '',
+            'name': s.name,
+            # SPAN_KIND_SERVER for the request, SPAN_KIND_INTERNAL for its steps
+            'kind': 2 if s.parent_id is None else 1,
+            'startTimeUnixNano': str(s.start_ns),
+            'endTimeUnixNano': str(s.end_ns),
+            'attributes': [
+                {'key': key, 'value': _otlp_value(value)}
+                for key, value in attributes.items() if value is not None
+            ],
+            'status': {'code': 2, 'message': s.error} if s.error else {},
+        })
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': 'excel-tool'}},
+            {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+        ]},
+        'scopeSpans': [{'scope': {'name': 'tool.tracing'}, 'spans': spans}],
+        'metadata': {'request': root_name},
+    }]}
+
+
+_FORMATS = {
+    'chrome': _chrome_trace,
+    'otlp': _otlp_trace,
+}
+
+
+def finish_trace(trace, root_name):
+    """
+    Write the trace to EXCEL_TRACE_DIR and stop recording
+
+    Files are named <time>_<trace id>.json and only the newest
+    EXCEL_TRACE_MAX_FILES are kept.
+
+    Returns:
+        Path of the written file (None when it could not be written)
+    """
+    _trace.set(None)
+    _parent.set(None)
+
+    trace_format = settings.EXCEL_TRACE_FORMAT
+    if trace_format not in _FORMATS:
+        trace_format = 'chrome'
+    stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(trace.started))
+    path = os.path.join(str(settings.EXCEL_TRACE_DIR), f'{stamp}_{trace.trace_id}.{trace_format}.json')
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(_FORMATS[trace_format](trace, root_name), f)
+        _cleanup_old_traces(os.path.dirname(path), settings.EXCEL_TRACE_MAX_FILES)
+    except OSError as e:
+        print(f"Error writing trace {trace.trace_id}: {e}")
+        return None
+    return path
+
+
+def _cleanup_old_traces(directory, max_files):
+    """Delete the oldest trace files if there are more than max_files"""
+    traces = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json'):
+                try:
+                    traces.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+
+    traces.sort()
+    for _, path in traces[:max(len(traces) - max_files, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadMixin:
+    """
+    Compute the SHA-256 digest of an upload while it is received
+
+    The digest is set as content_hash on the uploaded file, where
+    storage.ContentAddressedStorage and the header sample cache pick it up,
+    so the content never has to be read again just to hash it.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None:
+            # This handler stored the chunk
+            self.digest.update(raw_data)
+        return remaining
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.content_hash = self.digest.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    """Keep small uploads in memory (FILE_UPLOAD_MAX_MEMORY_SIZE), hashed"""
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    """
+    Spool larger uploads to FILE_UPLOAD_TEMP_DIR, hashed
+
+    With the spool directory on the same file system as MEDIA_ROOT, saving
+    the upload to storage renames the spooled file instead of copying it.
+    """
+
+    def new_file(self, *args, **kwargs):
+        if settings.FILE_UPLOAD_TEMP_DIR:
+            os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+        super().new_file(*args, **kwargs)
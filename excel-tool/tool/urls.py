@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views_simple, views_redirect
+from . import views, views_simple, views_redirect
 
 app_name = 'tool'
 
@@ -14,5 +14,21 @@ urlpatterns = [
     
     # Multi-sheet support
     path('process-sheets/', views_simple.process_selected_sheets, name='process_sheets'),
+    path('preview-header/', views_simple.preview_sheet_header, name='preview_header'),
     path('download-zip/', views_simple.download_all_sheets_zip, name='download_zip'),
+    
+    # Conversion progress (Server-Sent Events) and cancellation
+    path('progress/<str:job_id>/', views_simple.conversion_progress, name='progress'),
+    path('cancel/<str:job_id>/', views_simple.cancel_conversion, name='cancel'),
+    
+    # Tracked conversions (ConversionHistory), including delta mode
+    path('upload/', views.upload_file, name='upload_file'),
+    path('process/', views.process_file, name='process'),
+    path('download/<int:conversion_id>/', views.download_csv, name='download_csv'),
+    
+    # Conversion history (keyset-paginated, cached)
+    path('history/', views.get_history, name='history'),
+    
+    # Prometheus metrics
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,10 +1,17 @@
-import pandas as pd
 import os
 from pathlib import Path
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.db import models
 
+from .dtypes import optimize_dtypes
+from .exporters import write_dataframe
+from .filters import apply_row_filter
+from .memory import stage
+from .tracing import span
+from .workspace import scratch_file, store_file
+from .xlsx_parallel import parallel_processes, read_sheet_parallel
+
 
 def read_excel_file(file_path):
     """
@@ -16,13 +23,15 @@ def read_excel_file(file_path):
     Returns:
         pandas.DataFrame
     """
+    import pandas as pd
+    
     try:
         # Try reading with openpyxl first (for .xlsx)
         df = pd.read_excel(file_path, engine='openpyxl')
     except Exception:
         try:
-            # Fallback to xlrd for older .xls files
-            df = pd.read_excel(file_path, engine='xlrd')
+            # Fallback to xlrd for older .xls files (decoding only the first sheet)
+            df = pd.read_excel(file_path, engine='xlrd', engine_kwargs={'on_demand': True})
         except Exception as e:
             raise ValueError(f"Error reading Excel file: {str(e)}")
     
@@ -61,6 +70,47 @@ def remove_empty_rows(df):
     return df.dropna(how='all')
 
 
+def clean_dataframe(df):
+    """
+    Apply the standard cleaning steps to a freshly read sheet
+    
+    1. Remove columns that are completely empty (all NaN)
+    2. Rename 'Unnamed' columns to Extra_Info_N for bot analysis
+    
+    Args:
+        df: pandas.DataFrame
+        
+    Returns:
+        tuple (cleaned DataFrame, dict with 'empty_columns_removed' and
+        'unnamed_columns_renamed' counts, and the 'source_columns' kept
+        under their names in the sheet)
+    """
+    with stage('clean'):
+        original_column_count = len(df.columns)
+        with span('dropna', rows=len(df), columns=original_column_count) as s:
+            df = df.dropna(axis=1, how='all')
+            empty_columns_removed = original_column_count - len(df.columns)
+            s.set(columns_removed=empty_columns_removed)
+        source_columns = [str(col) for col in df.columns]
+        
+        rename_dict = {}
+        extra_counter = 1
+        for col in df.columns:
+            if 'Unnamed' in str(col):
+                rename_dict[col] = f'Extra_Info_{extra_counter}'
+                extra_counter += 1
+        
+        if rename_dict:
+            with span('rename', columns=len(rename_dict)):
+                df = df.rename(columns=rename_dict)
+    
+    return df, {
+        'empty_columns_removed': empty_columns_removed,
+        'unnamed_columns_renamed': len(rename_dict),
+        'source_columns': source_columns,
+    }
+
+
 def convert_to_csv(df, output_filename):
     """
     Convert DataFrame to CSV and save to media storage
@@ -73,7 +123,8 @@ def convert_to_csv(df, output_filename):
         Path to saved CSV file
     """
     # Convert DataFrame to CSV string
-    csv_content = df.to_csv(index=False, encoding='utf-8-sig')
+    with stage('write'):
+        csv_content = df.to_csv(index=False, encoding='utf-8-sig')
     
     # Save to Django storage
     file_path = f'outputs/{output_filename}'
@@ -82,6 +133,26 @@ def convert_to_csv(df, output_filename):
     return saved_path
 
 
+def convert_to_output(df, output_filename, output_format='csv', profile=None):
+    """
+    Write DataFrame in the requested format and save it to media storage
+    
+    Args:
+        df: pandas.DataFrame
+        output_filename: Name for the output file
+        output_format: One of exporters.OUTPUT_FORMATS
+        profile: Optional profiling.TableProfile fed while writing
+        
+    Returns:
+        Path to saved output file
+    """
+    with scratch_file(os.path.splitext(output_filename)[1]) as temp_path:
+        write_dataframe(df, temp_path, output_format, profile=profile)
+        saved_path = store_file(temp_path, f'outputs/{output_filename}')
+    
+    return saved_path
+
+
 def get_csv_as_text(df):
     """
     Convert DataFrame to CSV text for clipboard copying
@@ -95,7 +166,7 @@ def get_csv_as_text(df):
     return df.to_csv(index=False, encoding='utf-8')
 
 
-def process_excel_file(file_path, columns_to_keep=None, remove_empty=True, skip_rows=0):
+def process_excel_file(file_path, columns_to_keep=None, remove_empty=True, skip_rows=0, row_filter=None):
     """
     Complete processing pipeline for Excel file
     
@@ -104,53 +175,58 @@ def process_excel_file(file_path, columns_to_keep=None, remove_empty=True, skip_
         columns_to_keep: List of columns to keep (None = keep all)
         remove_empty: Whether to remove empty rows
         skip_rows: Number of rows to skip from the beginning (default: 0)
+        row_filter: filters.RowFilter applied on the sheet's header names (None = keep all rows)
         
     Returns:
         dict with processed DataFrame and metadata
     """
+    import pandas as pd
+    
     # Read Excel file with skiprows parameter
-    try:
-        # Try reading with openpyxl first (for .xlsx)
-        df = pd.read_excel(file_path, engine='openpyxl', skiprows=skip_rows)
-    except Exception:
+    with stage('read'):
         try:
-            # Fallback to xlrd for older .xls files
-            df = pd.read_excel(file_path, engine='xlrd', skiprows=skip_rows)
-        except Exception as e:
-            raise ValueError(f"Error reading Excel file: {str(e)}")
-    
-    original_rows = len(df)
-    original_columns = list(df.columns)
-    original_column_count = len(df.columns)
-    
-    # Step 1: Remove columns that are completely empty (all NaN)
-    df = df.dropna(axis=1, how='all')
-    empty_columns_removed = original_column_count - len(df.columns)
-    
-    # Step 2: Rename 'Unnamed' columns to more meaningful names for bot analysis
-    rename_dict = {}
-    extra_counter = 1
-    for col in df.columns:
-        if 'Unnamed' in str(col):
-            rename_dict[col] = f'Extra_Info_{extra_counter}'
-            extra_counter += 1
-    
-    if rename_dict:
-        df = df.rename(columns=rename_dict)
-    
-    # Step 3: Filter columns if specified
-    if columns_to_keep:
-        df = filter_columns(df, columns_to_keep)
-        columns_removed = list(set(original_columns) - set(columns_to_keep))
-    else:
-        columns_to_keep = list(df.columns)
-        columns_removed = []
-    
-    # Step 4: Remove empty rows if requested
-    if remove_empty:
-        df = remove_empty_rows(df)
+            # Try reading with openpyxl first (for .xlsx), huge sheets in parallel row ranges
+            if parallel_processes(file_path):
+                df, _ = read_sheet_parallel(file_path, None, skip_rows)
+            else:
+                df = pd.read_excel(file_path, engine='openpyxl', skiprows=skip_rows)
+        except Exception:
+            try:
+                # Fallback to xlrd for older .xls files (decoding only the first sheet)
+                df = pd.read_excel(file_path, engine='xlrd', skiprows=skip_rows, engine_kwargs={'on_demand': True})
+            except Exception as e:
+                raise ValueError(f"Error reading Excel file: {str(e)}")
     
-    processed_rows = len(df)
+    with stage('clean'):
+        original_rows = len(df)
+        
+        # Step 0: Keep only rows matching the filter (vectorized over the sheet)
+        if row_filter is not None:
+            df, filtering = apply_row_filter(df, row_filter)
+        else:
+            filtering = {'rows_scanned': original_rows, 'rows_kept': original_rows}
+        
+        original_columns = list(df.columns)
+        
+        # Steps 1-2: Remove completely empty columns and rename 'Unnamed' columns
+        df, cleaning = clean_dataframe(df)
+        
+        # Step 3: Filter columns if specified
+        if columns_to_keep:
+            df = filter_columns(df, columns_to_keep)
+            columns_removed = list(set(original_columns) - set(columns_to_keep))
+        else:
+            columns_to_keep = list(df.columns)
+            columns_removed = []
+        
+        # Step 4: Remove empty rows if requested
+        if remove_empty:
+            df = remove_empty_rows(df)
+        
+        processed_rows = len(df)
+        
+        # Step 5: Store columns in compact dtypes (CSV output is unchanged)
+        df, memory = optimize_dtypes(df)
     
     return {
         'dataframe': df,
@@ -158,68 +234,44 @@ def process_excel_file(file_path, columns_to_keep=None, remove_empty=True, skip_
         'processed_rows': processed_rows,
         'columns_kept': columns_to_keep,
         'columns_removed': columns_removed,
-        'empty_columns_removed': empty_columns_removed,
-        'unnamed_columns_renamed': len(rename_dict),
+        'empty_columns_removed': cleaning['empty_columns_removed'],
+        'unnamed_columns_renamed': cleaning['unnamed_columns_renamed'],
         'skip_rows': skip_rows,
+        'memory_before': memory['memory_before'],
+        'memory_after': memory['memory_after'],
+        'rows_scanned': filtering['rows_scanned'],
+        'rows_kept': filtering['rows_kept'],
     }
 
 
-def cleanup_old_files(directory_path, max_files=10):
-    """
-    Delete oldest files in a directory if count exceeds max_files
-    
-    Args:
-        directory_path: Path to the directory
-        max_files: Maximum number of files to keep
-    """
-    if not os.path.exists(directory_path):
-        return
-    
-    # Get all files with their modification times
-    files = []
-    for filename in os.listdir(directory_path):
-        filepath = os.path.join(directory_path, filename)
-        if os.path.isfile(filepath):
-            files.append((filepath, os.path.getmtime(filepath)))
-    
-    # Sort files by modification time (oldest first)
-    files.sort(key=lambda x: x[1])
-    
-    # Delete oldest files
-    if len(files) > max_files:
-        files_to_delete = files[:len(files) - max_files]
-        for filepath, _ in files_to_delete:
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                print(f"Error deleting file {filepath}: {e}")
-
-
-def cleanup_old_instances(model_class, max_instances=10):
+def cleanup_old_instances(model_class, max_instances=10, keep=()):
     """
     Delete oldest database instances and their associated files
     
     Args:
         model_class: The Django model class
         max_instances: Maximum number of records to keep
+        keep: Primary keys of instances never deleted (not counted in max_instances)
     """
-    count = model_class.objects.count()
+    instances = model_class.objects.exclude(pk__in=list(keep))
+    count = instances.count()
     if count > max_instances:
         # Get oldest instances (Django's queryset slicing is [start:stop])
         # To get the oldest, we use the default ordering (which is -timestamp)
         # and skip the first 'max_instances'.
-        instances_to_delete = model_class.objects.all()[max_instances:]
+        instances_to_delete = instances[max_instances:]
         for instance in instances_to_delete:
             try:
-                # Manually delete files if they exist
+                # Delete files through their storage so shared blobs are
+                # only removed with their last reference
                 for field in instance._meta.fields:
                     if isinstance(field, models.FileField):
                         file_field = getattr(instance, field.name)
-                        if file_field and os.path.exists(file_field.path):
+                        if file_field and file_field.storage.exists(file_field.name):
                             try:
-                                os.remove(file_field.path)
+                                file_field.delete(save=False)
                             except Exception as fe:
-                                print(f"Error deleting file {file_field.path}: {fe}")
+                                print(f"Error deleting file {file_field.name}: {fe}")
                 
                 instance.delete()
             except Exception as e:
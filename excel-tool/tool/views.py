@@ -4,19 +4,30 @@ from django.views.decorators.http import require_http_methods
 from django.core.files.storage import default_storage
 from django.conf import settings
 import json
-import numpy as np
 import os
 from datetime import datetime
 
 from .models import UploadedFile, ConversionHistory
 from .forms import ExcelUploadForm
-from .utils import read_excel_file, process_excel_file, convert_to_csv, get_csv_as_text, cleanup_old_instances
+from .utils import read_excel_file, cleanup_old_instances
+from .exporters import get_output_format, output_extension, content_type_for
+from .history import get_history_page
+from .filters import parse_row_filter
+from .delta import find_delta_base, delta_base_ids
+from .workspace import local_copy
+from .inspector import inspect_workbook, check_workbook_limits
+from .scheduler import conversion_slot
+from .workers import run_task
+from .memory import track_conversion, report_usage
+from .metrics import render_metrics
 
 
 def index(request):
     """Main page with upload form and history"""
     form = ExcelUploadForm()
-    history = ConversionHistory.objects.select_related('uploaded_file').all()[:10]
+    history = ConversionHistory.objects.select_related('uploaded_file').defer(
+        'columns_selected', 'columns_removed'
+    )[:10]
     
     context = {
         'form': form,
@@ -36,26 +47,34 @@ def upload_file(request):
         uploaded_file.original_filename = request.FILES['file_path'].name
         uploaded_file.file_size = request.FILES['file_path'].size
         uploaded_file.save()
+        # Linked to the request's CPU profile if it turns out slow
+        request.uploaded_file_record = uploaded_file
         
-        # Cleanup old uploads
-        cleanup_old_instances(UploadedFile, max_instances=10)
+        # Cleanup old uploads, except those of the conversions later
+        # versions are diffed against (deleting them cascades)
+        base_uploads = ConversionHistory.objects.filter(
+            id__in=delta_base_ids(ConversionHistory)
+        ).values_list('uploaded_file_id', flat=True)
+        cleanup_old_instances(UploadedFile, max_instances=10, keep=base_uploads)
         
         # Get skip_rows from form
         skip_rows = form.cleaned_data.get('skip_rows', 0) or 0
         
         try:
             # Read Excel file for preview with skip_rows
-            file_path = uploaded_file.file_path.path
             import pandas as pd
             import numpy as np
             
-            try:
-                df = pd.read_excel(file_path, engine='openpyxl', skiprows=skip_rows)
-            except:
+            with local_copy(uploaded_file.file_path.name, uploaded_file.file_path.storage) as file_path:
+                # Reject oversized files and ZIP bombs before any cell is parsed
+                check_workbook_limits(inspect_workbook(file_path))
                 try:
-                    df = pd.read_excel(file_path, engine='xlrd', skiprows=skip_rows)
-                except Exception as e:
-                    raise ValueError(f"Cannot read Excel file: {str(e)}")
+                    df = pd.read_excel(file_path, engine='openpyxl', skiprows=skip_rows)
+                except:
+                    try:
+                        df = pd.read_excel(file_path, engine='xlrd', skiprows=skip_rows, engine_kwargs={'on_demand': True})
+                    except Exception as e:
+                        raise ValueError(f"Cannot read Excel file: {str(e)}")
             
             # Replace NaN and NaT with None for JSON serialization
             df = df.replace({np.nan: None, pd.NaT: None})
@@ -99,41 +118,76 @@ def process_file(request):
         file_id = data.get('file_id')
         columns_to_keep = data.get('columns', [])
         skip_rows = data.get('skip_rows', 0)
+        output_format = get_output_format(data.get('output_format'))
+        row_filter = parse_row_filter(data.get('row_filter'))
+        delta_mode = bool(data.get('delta'))
+        key_columns = data.get('key_columns') or []
         
         uploaded_file = get_object_or_404(UploadedFile, id=file_id)
-        file_path = uploaded_file.file_path.path
-        
-        # Process the file with skip_rows parameter
-        result = process_excel_file(file_path, columns_to_keep, remove_empty=True, skip_rows=skip_rows)
-        df = result['dataframe']
         
         # Generate output filename
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         base_name = os.path.splitext(uploaded_file.original_filename)[0]
-        output_filename = f"{base_name}_{timestamp}.csv"
+        output_filename = f"{base_name}_{timestamp}{output_extension(output_format)}"
+        
+        # Delta mode: only output rows added, changed or removed since the
+        # previous conversion of the same file
+        delta_base = None
+        warning = None
+        if delta_mode:
+            delta_base = find_delta_base(ConversionHistory, uploaded_file.original_filename, key_columns)
+            if delta_base is None:
+                warning = ('No previous conversion of this file with the same key columns to compare with: '
+                           'every row is reported as added')
+            output_filename = f"{base_name}_{timestamp}_delta{output_extension(output_format)}"
         
-        # Save CSV
-        csv_path = convert_to_csv(df, output_filename)
+        # Measure peak memory by stage (read, clean, write)
+        memory_usage = track_conversion(uploaded_file.file_size)
+        with local_copy(uploaded_file.file_path.name, uploaded_file.file_path.storage) as file_path:
+            # Reject oversized files and ZIP bombs before any cell is parsed
+            workbook_info = inspect_workbook(file_path)
+            check_workbook_limits(workbook_info)
+            # Wait for a conversion slot, queued by the estimated cost of
+            # the first sheet (the one converted)
+            slot = conversion_slot(request, workbook_info, [sheet['name'] for sheet in workbook_info['sheets'][:1]])
+            with slot, memory_usage:
+                # Process the file with skip_rows and row filter parameters,
+                # fingerprint its rows, diff them and save the output in a
+                # worker process (see workers.py)
+                result = run_task(
+                    'process_workbook', file_path=file_path, output_name=output_filename,
+                    output_format=output_format, columns_to_keep=columns_to_keep, skip_rows=skip_rows,
+                    row_filter=row_filter, key_columns=key_columns, delta=delta_mode, delta_base=delta_base,
+                )
+        memory_stats = memory_usage.result()
+        report_usage('process', uploaded_file.original_filename, memory_stats)
         
         # Create conversion history
         conversion = ConversionHistory.objects.create(
             uploaded_file=uploaded_file,
             columns_selected=result['columns_kept'],
             columns_removed=result['columns_removed'],
-            output_csv_path=csv_path,
+            output_csv_path=result['output_path'],
+            output_format=output_format,
             rows_processed=result['processed_rows'],
-            status='success'
+            status='success',
+            key_columns=result['key_columns'],
+            fingerprint_index=result['fingerprint_index'],
+            delta_base=delta_base,
+            delta_stats=result['delta'],
+            column_profile=result['column_profile'],
+            memory_stats=memory_stats,
         )
+        request.conversion_history = conversion
         
-        # Cleanup old conversions
-        cleanup_old_instances(ConversionHistory, max_instances=10)
+        # Cleanup old conversions, except the delta bases of each file
+        cleanup_old_instances(ConversionHistory, max_instances=10, keep=delta_base_ids(ConversionHistory))
         
         # Get CSV as text for clipboard
-        csv_text = get_csv_as_text(df)
-        
-        # Prepare preview data for the processed result
-        df_preview = df.replace({np.nan: None, pd.NaT: None})
-        preview_data = df_preview.head(100).to_dict('records')
+        csv_text = None
+        if output_format == 'csv':
+            with conversion.output_csv_path.open('rb') as f:
+                csv_text = f.read().decode('utf-8-sig')
         
         return JsonResponse({
             'success': True,
@@ -141,12 +195,20 @@ def process_file(request):
             'csv_text': csv_text,
             'download_url': f'/excel/download/{conversion.id}/',
             'rows_processed': result['processed_rows'],
+            'rows_scanned': result['rows_scanned'],
+            'rows_kept': result['rows_kept'],
             'empty_columns_removed': result.get('empty_columns_removed', 0),
             'unnamed_columns_renamed': result.get('unnamed_columns_renamed', 0),
-            'preview_data': preview_data,
-            'columns': list(df.columns),
+            'preview_data': result['preview'],
+            'columns': result['columns'],
             'filename': output_filename,
+            'output_format': output_format,
             'total_rows': result['processed_rows'],
+            'delta': result['delta'],
+            'warning': warning,
+            'column_profile': result['column_profile'],
+            'peak_memory': memory_stats,
+            'queue': slot.result(),
         })
     
     except Exception as e:
@@ -157,32 +219,28 @@ def process_file(request):
 
 
 def download_csv(request, conversion_id):
-    """Download processed CSV file"""
+    """Download processed output file"""
     conversion = get_object_or_404(ConversionHistory, id=conversion_id)
     
-    file_path = conversion.output_csv_path.path
-    filename = os.path.basename(file_path)
+    filename = os.path.basename(conversion.output_csv_path.name)
     
-    response = FileResponse(open(file_path, 'rb'), content_type='text/csv')
+    response = FileResponse(conversion.output_csv_path.open('rb'), content_type=content_type_for(filename))
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
     
     return response
 
 
 def get_history(request):
-    """Get conversion history as JSON"""
-    history = ConversionHistory.objects.select_related('uploaded_file').all()[:20]
-    
-    data = [{
-        'id': item.id,
-        'filename': item.uploaded_file.original_filename,
-        'timestamp': item.conversion_timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        'rows_processed': item.rows_processed,
-        'columns_kept': len(item.columns_selected),
-        'status': item.status,
-    } for item in history]
+    """Get conversion history as JSON, one keyset-paginated page at a time"""
+    try:
+        page = get_history_page(
+            cursor=request.GET.get('cursor') or None,
+            limit=request.GET.get('limit', 20),
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    return JsonResponse({'history': data})
+    return JsonResponse(page)
 
 
 def load_conversion(request, conversion_id):
@@ -191,9 +249,9 @@ def load_conversion(request, conversion_id):
     
     try:
         # Read the CSV file
-        file_path = conversion.output_csv_path.path
         import pandas as pd
-        df = pd.read_csv(file_path)
+        with conversion.output_csv_path.open('rb') as f:
+            df = pd.read_csv(f)
         
         preview_data = df.head(100).to_dict('records')
         
@@ -211,3 +269,8 @@ def load_conversion(request, conversion_id):
             'success': False,
             'error': str(e)
         }, status=400)
+
+
+def metrics(request):
+    """Conversion metrics (memory, duration) in the Prometheus text format"""
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,16 +1,241 @@
 from django.shortcuts import render
-from django.http import JsonResponse, FileResponse
+from django.http import HttpResponse, JsonResponse, FileResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
-from django.conf import settings
-import pandas as pd
-import numpy as np
+from django.core.files.storage import default_storage
+from contextlib import ExitStack
 import os
 import zipfile
-import tempfile
 from datetime import datetime
 
+from .models import UploadedFile, ConversionHistory
 from .forms import ExcelUploadForm
-from .utils import cleanup_old_files
+from .exporters import get_output_format, output_extension, output_is_compressed, content_type_for
+from .filters import parse_row_filter
+from .header_detection import suggest_skip_rows, preview_from_sample
+from .inspector import inspect_workbook, check_workbook_limits
+from .progress import ProgressTracker, ConversionCancelled, valid_job_id, request_cancel, progress_events
+from .singleflight import IdempotencyKeyError, request_key, run_once
+from .conversion_profiles import ProfileMismatch, match_profile, mark_used, save_profile
+from .scheduler import conversion_slot
+from .workers import run_task
+from .tracing import span
+from .memory import track_conversion, report_usage
+from .workspace import is_local, local_copy, scratch_file, store_file, delete_stored, cleanup_old_stored_files
+from .utils import cleanup_old_instances
+from .delta import delta_base_ids
+
+
+def _temp_name(temp_filename):
+    """Storage name of an uploaded temp workbook (never outside temp/)"""
+    return f"temp/{os.path.basename(temp_filename)}"
+
+
+def _store_output(local_path, output_filename, stored_names):
+    """
+    Move a finished output into storage under outputs/
+    
+    Returns:
+        The stored file name (the download URL's filename)
+    """
+    with span('store_output', bytes=os.path.getsize(local_path)):
+        name = store_file(local_path, f'outputs/{output_filename}')
+    stored_names.append(name)
+    return os.path.basename(name)
+
+
+def _single_flight(request, convert):
+    """
+    Run convert(request) once for duplicate requests: requests with the same
+    Idempotency-Key header, or else the same parameters, attach to the
+    running conversion or get its stored result (see singleflight.py)
+    """
+    import json
+    
+    try:
+        params = json.loads(request.body)
+        if not isinstance(params, dict):
+            raise ValueError('Expected a JSON object')
+        key, fingerprint = request_key(request, params)
+    except IdempotencyKeyError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': f'Processing error: {str(e)}'}, status=400)
+    
+    def run():
+        response = convert(request)
+        return {'status': response.status_code, 'content': response.content.decode('utf-8')}
+    
+    try:
+        outcome, shared = run_once(key, fingerprint, params.get('job_id'), run)
+    except IdempotencyKeyError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=422)
+    
+    response = HttpResponse(outcome['content'], status=outcome['status'], content_type='application/json')
+    if shared:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _save_profile(name, filename, source, sheet_names, skip_rows, source_columns, column_types, output_format):
+    """
+    Save a conversion's settings as a profile when the request asked for it
+    
+    Returns:
+        dict with the profile 'name', or with an 'error' (the conversion
+        itself succeeded), or None when no profile was requested
+    """
+    name = (name or '').strip()
+    if not name:
+        return None
+    try:
+        profile = save_profile(name, filename, source, sheet_names, skip_rows, source_columns, column_types,
+                               output_format)
+    except Exception as e:
+        print(f"Error saving conversion profile {name}: {e}")
+        return {'name': name, 'error': str(e)}
+    return {'name': profile.name, 'filename_pattern': profile.filename_pattern}
+
+
+def _record_conversion(request, original_filename, file_size, outputs, output_format, memory_stats):
+    """
+    Record a conversion in the conversion history, one entry per output
+    file, like the main page's conversions
+    
+    The workbook itself is not kept by these views, so its UploadedFile
+    has no file. Errors are logged: the conversion itself succeeded.
+    
+    Args:
+        outputs: list of (stored output name, output column names, rows,
+            column profile or None)
+    """
+    try:
+        uploaded_file = UploadedFile.objects.create(
+            original_filename=original_filename[:255],
+            file_path='',
+            file_size=file_size,
+        )
+        request.uploaded_file_record = uploaded_file
+        for name, columns, rows, column_profile in outputs:
+            conversion = ConversionHistory.objects.create(
+                uploaded_file=uploaded_file,
+                columns_selected=columns,
+                columns_removed=[],
+                output_csv_path=name,
+                output_format=output_format,
+                rows_processed=rows,
+                status='success',
+                column_profile=column_profile,
+                memory_stats=memory_stats,
+            )
+            if getattr(request, 'conversion_history', None) is None:
+                request.conversion_history = conversion
+        
+        # Outputs are kept for 20 conversions (see cleanup_old_stored_files)
+        cleanup_old_instances(ConversionHistory, max_instances=20, keep=delta_base_ids(ConversionHistory))
+        UploadedFile.objects.filter(file_path='', conversions__isnull=True).delete()
+    except Exception as e:
+        print(f"Error recording conversion of {original_filename}: {e}")
+
+
+def _cancelled_response(tracker):
+    tracker.finish('cancelled')
+    return JsonResponse({
+        'success': False,
+        'cancelled': True,
+        'error': 'Conversion cancelled'
+    }, status=400)
+
+
+def _convert_with_profile(request, match, source, uploaded_file, row_filter, tracker, stored_names, timestamp, slot):
+    """
+    Convert an upload with its conversion profile: the profile's sheets are
+    converted straight away, streaming only its columns in their saved
+    types (no header detection, preview or dtype inference)
+    
+    Returns:
+        JsonResponse, shaped like a single-sheet upload for one sheet and
+        like process-sheets for several
+    
+    Args:
+        slot: scheduler.ConversionSlot the conversion runs in
+    
+    Raises:
+        conversion_profiles.ProfileMismatch: If the data does not fit the
+            profile (nothing is stored then)
+    """
+    profile = match.profile
+    output_format = profile.output_format
+    base_name = os.path.splitext(uploaded_file.name)[0]
+    single = len(match.sheets) == 1
+    results = []
+    outputs = []
+    
+    with ExitStack() as files:
+        files.enter_context(slot)
+        memory_usage = files.enter_context(track_conversion(uploaded_file.size))
+        tracker.start(match.sheets)
+        
+        with span('cleanup'):
+            cleanup_old_stored_files('outputs', max_files=10 if single else 20)
+        
+        # Read and write the sheets in a worker process (see workers.py)
+        output_paths = [files.enter_context(scratch_file(output_extension(output_format))) for _ in match.sheets]
+        converted = run_task('convert_with_profile', tracker, source=source, profile=profile,
+                             sheets=list(zip(match.sheets, output_paths)), row_filter=row_filter)
+        
+        for sheet, output_path in zip(converted, output_paths):
+            if single:
+                output_filename = f"extract_{base_name}_{timestamp}{output_extension(output_format)}"
+            else:
+                safe_sheet_name = "".join(c for c in sheet['sheet_name'] if c.isalnum() or c in (' ', '-', '_')).strip()
+                output_filename = f"extract_{base_name}_{safe_sheet_name}_{timestamp}{output_extension(output_format)}"
+            output_filename = _store_output(output_path, output_filename, stored_names)
+            outputs.append((stored_names[-1], list(profile.columns), sheet['rows'], sheet['column_profile']))
+            
+            reading = sheet['reading']
+            results.append({
+                'sheet_name': sheet['sheet_name'],
+                'filename': output_filename,
+                'download_url': f'/excel/download-simple/{output_filename}/',
+                'stats': {
+                    'original_rows': sheet['rows'],
+                    'original_columns': sheet['columns'],
+                    'final_columns': sheet['columns'],
+                    'empty_columns_removed': 0,
+                    'unnamed_columns_renamed': reading['unnamed_columns_renamed'],
+                    'rows_scanned': reading['rows_scanned'],
+                    'rows_kept': reading['rows_kept'],
+                    'skip_rows': profile.skip_rows,
+                    'suggested_skip_rows': None,
+                    'column_profile': sheet['column_profile'],
+                }
+            })
+        memory_usage.stop()
+    
+    mark_used(profile)
+    report_usage('upload', uploaded_file.name, memory_usage.result())
+    _record_conversion(request, uploaded_file.name, uploaded_file.size, outputs, output_format, memory_usage.result())
+    tracker.finish()
+    
+    if single:
+        result = results[0]
+        return JsonResponse({
+            'success': True,
+            'single_sheet': True,
+            'filename': result['filename'],
+            'download_url': result['download_url'],
+            'profile': match.as_dict(),
+            'stats': dict(result['stats'], peak_memory=memory_usage.result(), queue=slot.result()),
+        })
+    return JsonResponse({
+        'success': True,
+        'single_sheet': False,
+        'multiple_sheets': False,
+        'profile': match.as_dict(),
+        'results': results,
+        'peak_memory': memory_usage.result(),
+        'queue': slot.result(),
+    })
 
 
 def index(request):
@@ -31,118 +256,191 @@ def upload_and_process(request):
             'error': f'Form validation failed: {errors}'
         }, status=400)
     
+    tracker = ProgressTracker()
+    stored_names = []
+    files = ExitStack()
+    
     try:
         # Get uploaded file
         uploaded_file = request.FILES['file_path']
         skip_rows = int(form.cleaned_data.get('skip_rows', 0) or 0)
+        output_format = get_output_format(form.cleaned_data.get('output_format'))
+        row_filter = parse_row_filter(form.cleaned_data.get('row_filter'))
         
-        # Save file temporarily to check sheets
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
+        # Small uploads are held in memory by the upload handlers, larger ones
+        # spooled to disk; the workbook is read from there
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        temp_filename = f"temp_{timestamp}_{uploaded_file.name}"
-        temp_path = os.path.join(temp_dir, temp_filename)
-        
-        with open(temp_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
-        
-        # Check for multiple sheets
-        try:
-            excel_file = pd.ExcelFile(temp_path, engine='openpyxl')
-        except:
-            try:
-                excel_file = pd.ExcelFile(temp_path, engine='xlrd')
-            except Exception as e:
-                os.remove(temp_path)
-                raise ValueError(f"Cannot read Excel file: {str(e)}")
-        
-        sheet_names = excel_file.sheet_names
+        temp_filename = None
+        if hasattr(uploaded_file, 'temporary_file_path'):
+            source = uploaded_file.temporary_file_path()
+        else:
+            source = uploaded_file
+        
+        # Check for multiple sheets from workbook metadata only, rejecting
+        # oversized files and ZIP bombs before any cell is parsed
+        with span('detect_sheets') as s:
+            workbook_info = inspect_workbook(source)
+            s.set(engine=workbook_info['format'], sheets=len(workbook_info['sheets']),
+                  bytes=workbook_info['uncompressed_size'])
+        check_workbook_limits(workbook_info)
+        
+        sheet_names = [sheet['name'] for sheet in workbook_info['sheets']]
+        
+        tracker = ProgressTracker(
+            form.cleaned_data.get('job_id'),
+            {sheet['name']: sheet['rows'] for sheet in workbook_info['sheets']},
+        )
+        
+        # Workbooks with a saved layout (conversion profile) are converted
+        # directly; only their header rows are read to validate the match
+        profiles_rejected = []
+        if not form.cleaned_data.get('ignore_profiles'):
+            with span('match_profile') as s:
+                match, profiles_rejected = match_profile(uploaded_file.name, source, sheet_names)
+                s.set(profile=match.profile.name if match else None)
+            if match:
+                try:
+                    slot = conversion_slot(request, workbook_info, match.sheets, tracker)
+                    return _convert_with_profile(request, match, source, uploaded_file, row_filter, tracker,
+                                                 stored_names, timestamp, slot)
+                except ProfileMismatch as e:
+                    # e.g. text in a column saved as numbers: convert normally
+                    print(f"Profile {match.profile.name} does not fit {uploaded_file.name}: {e}")
+                    delete_stored(stored_names)
+                    stored_names.clear()
+                    profiles_rejected.append({'name': match.profile.name, 'reason': str(e)})
+        
+        # The sheets are processed by later requests, possibly on another
+        # worker or node: keep the workbook in storage (identical uploads
+        # share one blob; spooled uploads are moved, not copied)
+        if len(sheet_names) > 1:
+            with span('upload.store', bytes=uploaded_file.size):
+                temp_name = default_storage.save(f"temp/temp_{timestamp}_{uploaded_file.name}", uploaded_file)
+            temp_filename = os.path.basename(temp_name)
+            if is_local():
+                # Sample the stored copy, so later requests reuse the samples
+                source = default_storage.path(temp_name)
+        
+        # Suggest a header row per sheet from a small cached sample
+        with span('header_detection', sheets=len(sheet_names)):
+            header_suggestions = suggest_skip_rows(source, sheet_names)
         
         # If single sheet, process immediately (backward compatible)
         if len(sheet_names) == 1:
-            df = pd.read_excel(temp_path, sheet_name=sheet_names[0], skiprows=skip_rows)
-            os.remove(temp_path)  # Clean up temp file
-            
-            original_cols = len(df.columns)
-            original_rows = len(df)
+            suggestion = header_suggestions.get(sheet_names[0])
+            if form.cleaned_data.get('auto_detect_header') and suggestion:
+                skip_rows = suggestion['skip_rows']
             
-            # Remove empty columns
-            df = df.dropna(axis=1, how='all')
-            empty_cols_removed = original_cols - len(df.columns)
-            
-            # Rename Unnamed columns
-            rename_dict = {}
-            extra_counter = 1
-            for col in df.columns:
-                if 'Unnamed' in str(col):
-                    rename_dict[col] = f'Extra_Info_{extra_counter}'
-                    extra_counter += 1
-            
-            if rename_dict:
-                df = df.rename(columns=rename_dict)
+            # Wait for a conversion slot, queued by estimated cost
+            slot = files.enter_context(conversion_slot(request, workbook_info, sheet_names, tracker))
+            tracker.start(sheet_names)
+            # Peak memory of the read, clean and write stages
+            memory_usage = files.enter_context(track_conversion(uploaded_file.size))
             
             # Generate output filename with extract_ prefix and timestamp
             base_name = os.path.splitext(uploaded_file.name)[0]
-            output_filename = f"extract_{base_name}_{timestamp}.csv"
-            
-            # Save to media/outputs/
-            output_dir = os.path.join(settings.MEDIA_ROOT, 'outputs')
-            os.makedirs(output_dir, exist_ok=True)
+            output_filename = f"extract_{base_name}_{timestamp}{output_extension(output_format)}"
             
             # Cleanup old files before saving new one
-            cleanup_old_files(output_dir, max_files=10)
-            
-            output_path = os.path.join(output_dir, output_filename)
+            with span('cleanup'):
+                cleanup_old_stored_files('outputs', max_files=10)
             
-            # Save CSV
-            df.to_csv(output_path, index=False, encoding='utf-8-sig')
+            # Read, clean and write the sheet in a worker process (see
+            # workers.py): output in row chunks to a scratch file, then
+            # stored under outputs/; column statistics are gathered from the
+            # chunks
+            output_path = files.enter_context(scratch_file(output_extension(output_format)))
+            converted, = run_task('convert_sheets', tracker, source=source,
+                                  sheets=[(sheet_names[0], skip_rows, output_path)], output_format=output_format,
+                                  row_filter=row_filter, on_demand=False, keep_going=False)
+            memory_usage.stop()
+            report_usage('upload', uploaded_file.name, memory_usage.result())
+            output_filename = _store_output(output_path, output_filename, stored_names)
+            _record_conversion(
+                request, uploaded_file.name, uploaded_file.size,
+                [(stored_names[-1], converted['columns'], converted['stats']['original_rows'],
+                  converted['stats'].get('column_profile'))],
+                output_format, memory_usage.result(),
+            )
+            saved_profile = _save_profile(form.cleaned_data.get('save_profile'), uploaded_file.name, source,
+                                          sheet_names, skip_rows, converted['source_columns'],
+                                          converted['column_types'], output_format)
+            tracker.finish()
             
             return JsonResponse({
                 'success': True,
                 'single_sheet': True,
                 'filename': output_filename,
                 'download_url': f'/excel/download-simple/{output_filename}/',
-                'stats': {
-                    'original_rows': original_rows,
-                    'original_columns': original_cols,
-                    'final_columns': len(df.columns),
-                    'empty_columns_removed': empty_cols_removed,
-                    'unnamed_columns_renamed': len(rename_dict),
-                }
+                'profiles_rejected': profiles_rejected,
+                'saved_profile': saved_profile,
+                'stats': dict(
+                    converted['stats'],
+                    skip_rows=skip_rows,
+                    suggested_skip_rows=suggestion['skip_rows'] if suggestion else None,
+                    peak_memory=memory_usage.result(),
+                    queue=slot.result(),
+                )
             })
         
         # Multiple sheets - return sheet info for user selection
         else:
+            tracker.finish()
             return JsonResponse({
                 'success': True,
                 'single_sheet': False,
                 'multiple_sheets': True,
                 'sheets': sheet_names,
+                'sheet_info': workbook_info['sheets'],
+                'header_suggestions': header_suggestions,
                 'temp_file': temp_filename,
                 'skip_rows': skip_rows,
-                'original_filename': uploaded_file.name
+                'output_format': output_format,
+                'original_filename': uploaded_file.name,
+                'profiles_rejected': profiles_rejected,
             })
         
+    except ConversionCancelled:
+        # The partial output is a scratch file, removed below
+        delete_stored(stored_names)
+        return _cancelled_response(tracker)
+    
     except Exception as e:
+        tracker.finish('failed', str(e))
         return JsonResponse({
             'success': False,
             'error': f'Processing error: {str(e)}'
         }, status=400)
+    
+    finally:
+        files.close()
 
 
 @require_http_methods(["POST"])
 def process_selected_sheets(request):
-    """Process selected sheets from Excel file"""
+    """Process selected sheets from Excel file (duplicate requests share one run)"""
+    return _single_flight(request, _process_selected_sheets)
+
+
+def _process_selected_sheets(request):
     import json
     
+    tracker = ProgressTracker()
+    stored_names = []
+    files = ExitStack()
+    
     try:
         data = json.loads(request.body)
         temp_filename = data.get('temp_file')
         selected_sheets = data.get('selected_sheets', [])
         skip_rows = int(data.get('skip_rows', 0))
+        sheet_skip_rows = data.get('sheet_skip_rows') or {}
         original_filename = data.get('original_filename', 'file')
+        output_format = get_output_format(data.get('output_format'))
+        row_filter = parse_row_filter(data.get('row_filter'))
+        merge = bool(data.get('merge_sheets'))
+        source_column = (data.get('source_column') or '').strip() or None
+        profile_name = data.get('save_profile')
         
         if not temp_filename or not selected_sheets:
             return JsonResponse({
@@ -150,106 +448,224 @@ def process_selected_sheets(request):
                 'error': 'Missing required parameters'
             }, status=400)
         
-        temp_path = os.path.join(settings.MEDIA_ROOT, 'temp', temp_filename)
+        temp_name = _temp_name(temp_filename)
         
-        if not os.path.exists(temp_path):
+        if not default_storage.exists(temp_name):
             return JsonResponse({
                 'success': False,
                 'error': 'Temporary file not found'
             }, status=404)
         
-        # Process each selected sheet
+        # The workbook may have been uploaded through another worker or node
+        with span('fetch_workbook', local=is_local()):
+            temp_path = files.enter_context(local_copy(temp_name))
+        
+        with span('detect_sheets') as s:
+            workbook_info = inspect_workbook(temp_path)
+            s.set(engine=workbook_info['format'], sheets=len(workbook_info['sheets']),
+                  bytes=workbook_info['uncompressed_size'])
+        tracker = ProgressTracker(
+            data.get('job_id'),
+            {sheet['name']: sheet['rows'] for sheet in workbook_info['sheets']},
+        )
+        slot = files.enter_context(conversion_slot(request, workbook_info, selected_sheets, tracker))
+        tracker.start(selected_sheets)
+        file_size = os.path.getsize(temp_path)
+        memory_usage = files.enter_context(track_conversion(file_size))
+        
+        # Process each selected sheet, honouring a per-sheet header row when
+        # given; sheets are read, cleaned and written in a worker process
+        # (see workers.py)
         results = []
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         base_name = os.path.splitext(original_filename)[0]
+        sheets = [(sheet_name, int(sheet_skip_rows.get(sheet_name, skip_rows))) for sheet_name in selected_sheets]
+        
+        if merge:
+            # Merge sheets: one output, columns aligned by name
+            output_filename = f"extract_{base_name}_merged_{timestamp}{output_extension(output_format)}"
+            output_path = files.enter_context(scratch_file(output_extension(output_format)))
+            merged = run_task('merge_workbook_sheets', tracker, source=temp_path, sheets=sheets,
+                              output_path=output_path, output_format=output_format, row_filter=row_filter,
+                              source_column=source_column)
+            output_filename = _store_output(output_path, output_filename, stored_names)
+            outputs = [(stored_names[-1], merged['columns'], merged['rows_written'], merged['column_profile'])]
+            
+            results.append({
+                'sheet_name': f"Merged ({len(selected_sheets)} sheets)",
+                'filename': output_filename,
+                'download_url': f'/excel/download-simple/{output_filename}/',
+                'stats': {
+                    'original_rows': merged['rows_written'],
+                    'final_columns': len(merged['columns']),
+                    'sheets': merged['sheets'],
+                    'type_conflicts': merged['type_conflicts'],
+                    'column_profile': merged['column_profile'],
+                }
+            })
         
-        for sheet_name in selected_sheets:
-            try:
-                # Read sheet
-                df = pd.read_excel(temp_path, sheet_name=sheet_name, skiprows=skip_rows)
-                
-                original_cols = len(df.columns)
-                original_rows = len(df)
-                
-                # Remove empty columns
-                df = df.dropna(axis=1, how='all')
-                empty_cols_removed = original_cols - len(df.columns)
-                
-                # Rename Unnamed columns
-                rename_dict = {}
-                extra_counter = 1
-                for col in df.columns:
-                    if 'Unnamed' in str(col):
-                        rename_dict[col] = f'Extra_Info_{extra_counter}'
-                        extra_counter += 1
-                
-                if rename_dict:
-                    df = df.rename(columns=rename_dict)
+        else:
+            # One scratch output per sheet, stored under outputs/ once written
+            output_paths = [files.enter_context(scratch_file(output_extension(output_format))) for _ in sheets]
+            converted = run_task('convert_sheets', tracker, source=temp_path,
+                                 sheets=[sheet + (path,) for sheet, path in zip(sheets, output_paths)],
+                                 output_format=output_format, row_filter=row_filter)
+            
+            # Layout of the first converted sheet, for save_profile
+            layout = None
+            outputs = []
+            for sheet, output_path in zip(converted, output_paths):
+                if 'error' in sheet:
+                    results.append(sheet)
+                    continue
                 
                 # Generate output filename
-                safe_sheet_name = "".join(c for c in sheet_name if c.isalnum() or c in (' ', '-', '_')).strip()
-                output_filename = f"extract_{base_name}_{safe_sheet_name}_{timestamp}.csv"
-                
-                # Save to media/outputs/
-                output_dir = os.path.join(settings.MEDIA_ROOT, 'outputs')
-                os.makedirs(output_dir, exist_ok=True)
-                
-                output_path = os.path.join(output_dir, output_filename)
-                
-                # Save CSV
-                df.to_csv(output_path, index=False, encoding='utf-8-sig')
+                safe_sheet_name = "".join(c for c in sheet['sheet_name'] if c.isalnum() or c in (' ', '-', '_')).strip()
+                output_filename = f"extract_{base_name}_{safe_sheet_name}_{timestamp}{output_extension(output_format)}"
+                output_filename = _store_output(output_path, output_filename, stored_names)
+                outputs.append((stored_names[-1], sheet['columns'], sheet['stats']['original_rows'],
+                                sheet['stats'].get('column_profile')))
+                if layout is None:
+                    layout = (sheet['skip_rows'], sheet['source_columns'], sheet['column_types'])
                 
                 results.append({
-                    'sheet_name': sheet_name,
+                    'sheet_name': sheet['sheet_name'],
                     'filename': output_filename,
                     'download_url': f'/excel/download-simple/{output_filename}/',
-                    'stats': {
-                        'original_rows': original_rows,
-                        'original_columns': original_cols,
-                        'final_columns': len(df.columns),
-                        'empty_columns_removed': empty_cols_removed,
-                        'unnamed_columns_renamed': len(rename_dict),
-                    }
-                })
-                
-            except Exception as e:
-                results.append({
-                    'sheet_name': sheet_name,
-                    'error': str(e)
+                    'stats': dict(sheet['stats'], skip_rows=sheet['skip_rows']),
                 })
         
-        # Cleanup temp file
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        memory_usage.stop()
+        report_usage('process_sheets', original_filename, memory_usage.result())
+        _record_conversion(request, original_filename, file_size, outputs, output_format, memory_usage.result())
         
-        # Cleanup old files
-        output_dir = os.path.join(settings.MEDIA_ROOT, 'outputs')
-        cleanup_old_files(output_dir, max_files=20)
+        # Profiles describe one table per sheet, not a merge of sheets
+        saved_profile = None
+        if not merge and layout is not None:
+            saved_profile = _save_profile(profile_name, original_filename, temp_path, selected_sheets, *layout,
+                                          output_format)
         
+        # Cleanup temp file and old files
+        with span('cleanup'):
+            try:
+                default_storage.delete(temp_name)
+            except:
+                pass
+            
+            cleanup_old_stored_files('outputs', max_files=20)
+        
+        tracker.finish()
         return JsonResponse({
             'success': True,
-            'results': results
+            'results': results,
+            'saved_profile': saved_profile,
+            'peak_memory': memory_usage.result(),
+            'queue': slot.result(),
         })
         
+    except ConversionCancelled:
+        # Drop partial outputs; the uploaded workbook is kept so the sheets
+        # can be processed again (e.g. with a different skip_rows)
+        delete_stored(stored_names)
+        return _cancelled_response(tracker)
+    
     except Exception as e:
+        tracker.finish('failed', str(e))
         return JsonResponse({
             'success': False,
             'error': f'Processing error: {str(e)}'
         }, status=400)
+    
+    finally:
+        files.close()
+
+
+async def conversion_progress(request, job_id):
+    """Stream the progress of a conversion as Server-Sent Events"""
+    if not valid_job_id(job_id):
+        return JsonResponse({'success': False, 'error': 'Invalid job id'}, status=400)
+    
+    # Async view: a long-lived stream must not hold the sync worker thread
+    response = StreamingHttpResponse(progress_events(job_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_http_methods(["POST"])
+async def cancel_conversion(request, job_id):
+    """Ask a running conversion to stop at its next chunk boundary"""
+    if not valid_job_id(job_id):
+        return JsonResponse({'success': False, 'error': 'Invalid job id'}, status=400)
+    
+    request_cancel(job_id)
+    return JsonResponse({'success': True, 'job_id': job_id})
+
+
+@require_http_methods(["POST"])
+def preview_sheet_header(request):
+    """Preview the header a skip_rows value would produce, from the cached sample"""
+    import json
+    
+    try:
+        data = json.loads(request.body)
+        temp_filename = data.get('temp_file')
+        sheet_name = data.get('sheet_name')
+        skip_rows = int(data.get('skip_rows', 0))
+        
+        if not temp_filename or sheet_name is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'Missing required parameters'
+            }, status=400)
+        
+        temp_name = _temp_name(temp_filename)
+        
+        if not default_storage.exists(temp_name):
+            return JsonResponse({
+                'success': False,
+                'error': 'Temporary file not found'
+            }, status=404)
+        
+        with local_copy(temp_name) as temp_path:
+            preview = preview_from_sample(temp_path, sheet_name, skip_rows)
+        
+        return JsonResponse({
+            'success': True,
+            'sheet_name': sheet_name,
+            'skip_rows': skip_rows,
+            'header': preview['header'],
+            'rows': preview['rows'],
+        })
+        
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': f'Preview error: {str(e)}'
+        }, status=400)
 
 
 @require_http_methods(["POST"])
 def download_all_sheets_zip(request):
-    """Process all sheets and return as ZIP file"""
+    """Process all sheets and return as ZIP file (duplicate requests share one run)"""
+    return _single_flight(request, _download_all_sheets_zip)
+
+
+def _download_all_sheets_zip(request):
     import json
     
+    tracker = ProgressTracker()
+    stored_names = []
+    files = ExitStack()
+    
     try:
         data = json.loads(request.body)
         temp_filename = data.get('temp_file')
         skip_rows = int(data.get('skip_rows', 0))
+        sheet_skip_rows = data.get('sheet_skip_rows') or {}
         original_filename = data.get('original_filename', 'file')
+        output_format = get_output_format(data.get('output_format'))
+        row_filter = parse_row_filter(data.get('row_filter'))
         
         if not temp_filename:
             return JsonResponse({
@@ -257,110 +673,139 @@ def download_all_sheets_zip(request):
                 'error': 'Missing required parameters'
             }, status=400)
         
-        temp_path = os.path.join(settings.MEDIA_ROOT, 'temp', temp_filename)
+        temp_name = _temp_name(temp_filename)
         
-        if not os.path.exists(temp_path):
+        if not default_storage.exists(temp_name):
             return JsonResponse({
                 'success': False,
                 'error': 'Temporary file not found'
             }, status=404)
         
-        # Read all sheets
-        try:
-            excel_file = pd.ExcelFile(temp_path, engine='openpyxl')
-        except:
-            excel_file = pd.ExcelFile(temp_path, engine='xlrd')
-        
-        sheet_names = excel_file.sheet_names
-        
-        # Create temporary directory for CSV files
+        # The workbook may have been uploaded through another worker or node
+        with span('fetch_workbook', local=is_local()):
+            temp_path = files.enter_context(local_copy(temp_name))
+        
+        # List sheets from workbook metadata only
+        with span('detect_sheets') as s:
+            workbook_info = inspect_workbook(temp_path)
+            s.set(engine=workbook_info['format'], sheets=len(workbook_info['sheets']),
+                  bytes=workbook_info['uncompressed_size'])
+        check_workbook_limits(workbook_info)
+        sheet_names = [sheet['name'] for sheet in workbook_info['sheets']]
+        tracker = ProgressTracker(
+            data.get('job_id'),
+            {sheet['name']: sheet['rows'] for sheet in workbook_info['sheets']},
+        )
+        slot = files.enter_context(conversion_slot(request, workbook_info, tracker=tracker))
+        tracker.start(sheet_names)
+        file_size = os.path.getsize(temp_path)
+        memory_usage = files.enter_context(track_conversion(file_size))
+        
+        # Create temporary output files for each sheet
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         base_name = os.path.splitext(original_filename)[0]
-        csv_files = []
-        
-        for sheet_name in sheet_names:
-            try:
-                # Read sheet
-                df = pd.read_excel(temp_path, sheet_name=sheet_name, skiprows=skip_rows)
-                
-                # Remove empty columns
-                df = df.dropna(axis=1, how='all')
-                
-                # Rename Unnamed columns
-                rename_dict = {}
-                extra_counter = 1
-                for col in df.columns:
-                    if 'Unnamed' in str(col):
-                        rename_dict[col] = f'Extra_Info_{extra_counter}'
-                        extra_counter += 1
-                
-                if rename_dict:
-                    df = df.rename(columns=rename_dict)
-                
-                # Generate CSV filename
-                safe_sheet_name = "".join(c for c in sheet_name if c.isalnum() or c in (' ', '-', '_')).strip()
-                csv_filename = f"extract_{safe_sheet_name}.csv"
-                
-                # Save to temp location
-                temp_csv_path = os.path.join(tempfile.gettempdir(), csv_filename)
-                df.to_csv(temp_csv_path, index=False, encoding='utf-8-sig')
-                
-                csv_files.append((csv_filename, temp_csv_path))
-                
-            except Exception as e:
-                print(f"Error processing sheet {sheet_name}: {str(e)}")
+        output_files = []
+        rows_processed = 0
+        
+        # Read, clean and write every sheet in a worker process (see
+        # workers.py), honouring a per-sheet header row when given; each
+        # .xls sheet is decoded, converted and unloaded before the next one
+        output_paths = [files.enter_context(scratch_file(output_extension(output_format))) for _ in sheet_names]
+        converted = run_task(
+            'convert_sheets', tracker, source=temp_path,
+            sheets=[
+                (sheet_name, int(sheet_skip_rows.get(sheet_name, skip_rows)), output_path)
+                for sheet_name, output_path in zip(sheet_names, output_paths)
+            ],
+            output_format=output_format, row_filter=row_filter, column_profiles=False,
+        )
+        
+        for sheet, output_path in zip(converted, output_paths):
+            if 'error' in sheet:
+                print(f"Error processing sheet {sheet['sheet_name']}: {sheet['error']}")
+                continue
+            
+            # Generate output filename
+            safe_sheet_name = "".join(c for c in sheet['sheet_name'] if c.isalnum() or c in (' ', '-', '_')).strip()
+            sheet_filename = f"extract_{safe_sheet_name}{output_extension(output_format)}"
+            output_files.append((sheet_filename, output_path))
+            rows_processed += sheet['stats']['original_rows']
         
         # Create ZIP file
         zip_filename = f"extract_{base_name}_{timestamp}.zip"
-        zip_dir = os.path.join(settings.MEDIA_ROOT, 'outputs')
-        os.makedirs(zip_dir, exist_ok=True)
-        
-        zip_path = os.path.join(zip_dir, zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for csv_filename, csv_path in csv_files:
-                zipf.write(csv_path, csv_filename)
-        
-        # Cleanup temp CSV files
-        for _, csv_path in csv_files:
+        zip_path = files.enter_context(scratch_file('.zip'))
+        tracker.check_cancelled()
+        
+        # Already compressed outputs (.xlsx, Parquet, Arrow) are stored as is
+        compress_type = zipfile.ZIP_STORED if output_is_compressed(output_format) else zipfile.ZIP_DEFLATED
+        with span('zip', files=len(output_files), compressed=compress_type == zipfile.ZIP_DEFLATED) as s:
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for sheet_filename, output_path in output_files:
+                    zipf.write(output_path, sheet_filename, compress_type=compress_type)
+            s.set(bytes=os.path.getsize(zip_path))
+        memory_usage.stop()
+        report_usage('download_zip', original_filename, memory_usage.result())
+        
+        with span('cleanup'):
+            # Cleanup temp output files
+            for _, output_path in output_files:
+                try:
+                    os.remove(output_path)
+                except:
+                    pass
+            
+            # Cleanup temp Excel file
             try:
-                os.remove(csv_path)
+                default_storage.delete(temp_name)
             except:
                 pass
         
-        # Cleanup temp Excel file
-        try:
-            os.remove(temp_path)
-        except:
-            pass
-        
-        # Cleanup old files
-        cleanup_old_files(zip_dir, max_files=20)
+        # Store the ZIP under outputs/ and cleanup old files
+        zip_filename = _store_output(zip_path, zip_filename, stored_names)
+        _record_conversion(request, original_filename, file_size, [(stored_names[-1], [], rows_processed, None)],
+                           output_format, memory_usage.result())
+        with span('cleanup'):
+            cleanup_old_stored_files('outputs', max_files=20)
         
+        tracker.finish()
         return JsonResponse({
             'success': True,
             'filename': zip_filename,
             'download_url': f'/excel/download-simple/{zip_filename}/',
-            'sheets_processed': len(csv_files)
+            'sheets_processed': len(output_files),
+            'output_format': output_format,
+            'peak_memory': memory_usage.result(),
+            'queue': slot.result(),
         })
         
+    except ConversionCancelled:
+        # The per-sheet outputs are scratch files, removed below; the
+        # uploaded workbook is kept
+        delete_stored(stored_names)
+        return _cancelled_response(tracker)
+    
     except Exception as e:
+        tracker.finish('failed', str(e))
         return JsonResponse({
             'success': False,
             'error': f'Processing error: {str(e)}'
         }, status=400)
+    
+    finally:
+        files.close()
 
 
 def download_simple(request, filename):
-    """Download processed CSV file"""
+    """Download a processed output file"""
     from urllib.parse import quote
     
-    file_path = os.path.join(settings.MEDIA_ROOT, 'outputs', filename)
+    # Any worker or node may serve the download: read it from storage
+    name = f'outputs/{os.path.basename(filename)}'
     
-    if not os.path.exists(file_path):
+    if not default_storage.exists(name):
         return JsonResponse({'error': 'File not found'}, status=404)
     
-    response = FileResponse(open(file_path, 'rb'), content_type='text/csv')
+    response = FileResponse(default_storage.open(name, 'rb'), content_type=content_type_for(filename))
     # Properly encode filename for Content-Disposition to handle special characters
     encoded_filename = quote(filename)
     response['Content-Disposition'] = f'attachment; filename*=UTF-8\'\'{encoded_filename}'
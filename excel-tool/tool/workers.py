@@ -0,0 +1,370 @@
+import atexit
+import contextvars
+import io
+import multiprocessing
+import pickle
+import signal
+import threading
+
+from django.conf import settings
+
+from . import metrics
+from .cpuprofile import RequestProfiler, current_profiler
+from .memory import current_usage
+from .progress import ConversionCancelled
+from .readers import is_file_object
+from .tracing import add_spans, continue_trace, export_spans, span, trace_context
+
+
+# Loaded once by the fork server, so a new worker starts without importing them
+PRELOAD_MODULES = ['numpy', 'pandas', 'openpyxl', 'xlrd']
+
+# Seconds a stopped worker gets to exit before it is terminated
+STOP_TIMEOUT = 5
+
+
+class WorkerCrashed(RuntimeError):
+    """A worker process exited while running a job (e.g. killed for using too much memory)"""
+
+
+def process_context():
+    """
+    multiprocessing context for starting worker processes: a fork server
+    preloading PRELOAD_MODULES where available, else spawn
+    """
+    # Forking a threaded web process is unsafe; a fork server is single-threaded
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(PRELOAD_MODULES)
+    return context
+
+
+class _Relay:
+    """
+    A job's ProgressTracker, as seen from inside a worker: calls are sent to
+    the web process, which answers a cancelled job with 'cancel'
+    """
+
+    def __init__(self, conn, active):
+        self.conn = conn
+        self.active = active
+
+    def _send(self, method, *args):
+        self.conn.send(('progress', method, args))
+        if self.conn.poll() and self.conn.recv() == 'cancel':
+            raise ConversionCancelled('Conversion cancelled')
+
+    def start_sheet(self, index, sheet_name):
+        self._send('start_sheet', index, sheet_name)
+
+    def parsed(self, rows):
+        self._send('parsed', rows)
+
+    def written(self, rows, bytes_written):
+        self._send('written', rows, bytes_written)
+
+
+def _portable_error(error):
+    """The job's exception if it can be sent to the web process, else a RuntimeError with its message"""
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError(f'{type(error).__name__}: {error}')
+    return error
+
+
+def _read_all(file):
+    file.seek(0)
+    return file.read()
+
+
+def _run_job(conn, name, kwargs, traced, active, trace, profiling):
+    """
+    Run one job in the worker, in a context of its own, measuring its
+    memory and recording its spans and CPU profile for the web process
+
+    Returns:
+        tuple (reply, memory figures, spans or None, profile or None)
+    """
+    from . import tasks
+    from .memory import MemoryUsage
+
+    trace = continue_trace(trace) if trace is not None else None
+    profiler = RequestProfiler(*profiling) if profiling is not None else None
+    usage = MemoryUsage(0, traced)
+    if profiler is not None:
+        profiler.start()
+    try:
+        with usage:
+            reply = ('done', getattr(tasks, name)(_Relay(conn, active), **kwargs))
+    except ConversionCancelled:
+        reply = ('cancelled', None)
+    except Exception as e:
+        reply = ('error', _portable_error(e))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    return (
+        reply,
+        usage.result(),
+        export_spans(trace) if trace is not None else None,
+        profiler.result() if profiler is not None else None,
+    )
+
+
+def _serve(conn, max_jobs, max_rss):
+    """
+    Worker process main loop: run jobs of tasks.py sent by the web process
+    until stopped, or until recycled after max_jobs jobs or once its RSS
+    reaches max_rss bytes (0 = no limit)
+    """
+    import django
+
+    # Interrupts go to the web process, which stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    django.setup()
+
+    from .memory import current_rss
+
+    if settings.EXCEL_PREWARM:
+        from .warmup import prewarm
+
+        prewarm()
+
+    jobs = 0
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        if message == 'cancel':
+            # Cancellation of a job that had already finished
+            continue
+
+        reply, usage, spans, profile = contextvars.Context().run(_run_job, conn, *message)
+
+        jobs += 1
+        rss = current_rss()
+        recycle = None
+        if jobs >= max_jobs:
+            recycle = 'jobs'
+        elif max_rss and rss is not None and rss >= max_rss:
+            recycle = 'rss'
+        conn.send(reply + (usage, spans, profile, recycle))
+        if recycle:
+            return
+
+
+class _Worker:
+    def __init__(self, context, max_jobs, max_rss):
+        self.conn, child_conn = context.Pipe()
+        # Not a daemon: a job may start processes of its own (see xlsx_parallel);
+        # get_pool stops idle workers at exit
+        self.process = context.Process(target=_serve, args=(child_conn, max_jobs, max_rss), name='excel-worker')
+        self.process.start()
+        child_conn.close()
+        # Why the worker must be replaced (None = it takes more jobs)
+        self.recycle = None
+
+    def run(self, name, kwargs, tracker):
+        """
+        Run a job in the worker, relaying its progress to tracker (see
+        WorkerPool.run); its memory figures, spans and CPU profile are added
+        to the current conversion's, trace and request profile
+        """
+        usage = current_usage()
+        profiler = current_profiler()
+        self.conn.send((
+            name, kwargs, usage is not None and usage.traced, tracker is not None and tracker.active,
+            trace_context(), (profiler.interval, profiler.engine) if profiler is not None else None,
+        ))
+
+        cancelled = False
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                self.recycle = 'exited'
+                self.process.join(STOP_TIMEOUT)
+                raise WorkerCrashed(
+                    f'Conversion worker {self.process.pid} exited during the conversion '
+                    f'(exit code {self.process.exitcode})'
+                )
+
+            if message[0] == 'progress':
+                if tracker is not None and not cancelled:
+                    try:
+                        getattr(tracker, message[1])(*message[2])
+                    except ConversionCancelled:
+                        # The worker stops at its next progress report
+                        cancelled = True
+                        self.conn.send('cancel')
+                continue
+
+            status, value, worker_usage, spans, profile, self.recycle = message
+            if usage is not None:
+                usage.add_worker_usage(worker_usage)
+            if spans:
+                add_spans(spans)
+            if profile is not None and profiler is not None:
+                profiler.add(profile)
+            if status == 'error':
+                raise value
+            if cancelled or status == 'cancelled':
+                raise ConversionCancelled('Conversion cancelled')
+            return value
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes running the conversion jobs of tasks.py
+
+    pandas/openpyxl parses leave a fragmented heap that a long-lived process
+    never returns to the OS, so its RSS ratchets up with every large file.
+    Jobs run in worker processes instead; a worker is replaced after
+    max_jobs jobs, or once its RSS reaches max_rss bytes, and its memory
+    goes back to the OS when it exits. Jobs take and return paths and small
+    dicts (outputs are written to files by the worker): DataFrames never
+    cross the process boundary, so the web process stays small.
+
+    Workers are started on first use, up to processes of them.
+    """
+
+    def __init__(self, processes, max_jobs, max_rss):
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self._context = process_context()
+        self._condition = threading.Condition()
+        self._idle = []
+        self._started = 0
+
+    def _checkout(self):
+        with self._condition:
+            while True:
+                if self._idle:
+                    worker = self._idle.pop()
+                    if worker.process.is_alive():
+                        return worker
+                    # Died while idle (e.g. killed by the OOM killer)
+                    worker.recycle = 'exited'
+                    self._retire(worker)
+                elif self._started < self.processes:
+                    self._started += 1
+                    break
+                else:
+                    self._condition.wait()
+        try:
+            return _Worker(self._context, self.max_jobs, self.max_rss)
+        except Exception:
+            with self._condition:
+                self._started -= 1
+                self._condition.notify()
+            raise
+
+    def _retire(self, worker):
+        """Stop a worker that must be replaced; called with the condition held"""
+        worker.stop()
+        self._started -= 1
+        try:
+            metrics.workers_recycled.inc(reason=worker.recycle)
+        except Exception as e:
+            print(f"Error recording {metrics.workers_recycled.name}: {e}")
+
+    def _checkin(self, worker):
+        with self._condition:
+            if worker.recycle:
+                self._retire(worker)
+            else:
+                self._idle.append(worker)
+            self._condition.notify()
+
+    def run(self, name, tracker=None, **kwargs):
+        """
+        Run a job in a worker, waiting for one to be free
+
+        Args:
+            name: Name of the job function in tasks.py
+            tracker: ProgressTracker the job's progress is relayed to; its
+                cancellation stops the job
+            **kwargs: Job arguments (an in-memory upload is sent as bytes)
+
+        Returns:
+            The job's result
+
+        Raises:
+            The job's exception, or WorkerCrashed if its worker exited
+        """
+        kwargs = {
+            key: io.BytesIO(_read_all(value)) if is_file_object(value) else value
+            for key, value in kwargs.items()
+        }
+        worker = self._checkout()
+        try:
+            with span('worker.run', task=name, pid=worker.process.pid):
+                return worker.run(name, kwargs, tracker)
+        finally:
+            self._checkin(worker)
+
+    def close(self):
+        """Stop the idle workers"""
+        with self._condition:
+            while self._idle:
+                self._idle.pop().stop()
+                self._started -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """This process's worker pool (None when EXCEL_WORKER_PROCESSES is 0: jobs run in the web process)"""
+    global _pool
+    if not settings.EXCEL_WORKER_PROCESSES:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(
+                settings.EXCEL_WORKER_PROCESSES,
+                settings.EXCEL_WORKER_MAX_JOBS,
+                settings.EXCEL_WORKER_MAX_RSS_MB * 1024 * 1024,
+            )
+            atexit.register(_pool.close)
+    return _pool
+
+
+def run_task(name, tracker=None, **kwargs):
+    """
+    Run a conversion job of tasks.py, in a worker process of this web
+    process's pool (see WorkerPool), or inline when workers are disabled
+
+    Args:
+        name: Name of the job function in tasks.py
+        tracker: ProgressTracker of the conversion (None = not tracked)
+        **kwargs: Job arguments
+
+    Returns:
+        The job's result
+    """
+    pool = get_pool()
+    if pool is None:
+        from . import tasks
+
+        return getattr(tasks, name)(tracker, **kwargs)
+    return pool.run(name, tracker, **kwargs)
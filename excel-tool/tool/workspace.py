@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def is_local(storage=None):
+    """True when the storage keeps files on this machine's file system"""
+    storage = storage or default_storage
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def scratch_dir():
+    """
+    Directory for intermediate files (outputs being written, merge spools,
+    downloaded copies of stored workbooks)
+
+    Nothing in it outlives a request: other workers and nodes only ever see
+    files through the storage.
+    """
+    path = str(settings.EXCEL_SCRATCH_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def scratch_path(suffix=''):
+    """Create an empty scratch file and return its path (the caller removes it)"""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=scratch_dir())
+    os.close(fd)
+    return path
+
+
+@contextmanager
+def scratch_file(suffix=''):
+    """Scratch file path that is removed at the end of the block if still there"""
+    path = scratch_path(suffix)
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@contextmanager
+def local_copy(name, storage=None):
+    """
+    Local path of a stored file for the duration of the block
+
+    Files of a local storage (including a shared directory mounted on every
+    node) are used in place; files of a remote storage (e.g. S3) are
+    downloaded into the scratch directory and removed afterwards.
+
+    Args:
+        name: Storage name of the file
+        storage: Storage holding the file (default_storage when None)
+    """
+    storage = storage or default_storage
+    if is_local(storage):
+        yield storage.path(name)
+        return
+
+    with scratch_file(os.path.splitext(name)[1]) as path:
+        with storage.open(name, 'rb') as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+        yield path
+
+
+class _ScratchFile(File):
+    """A finished scratch file that FileSystemStorage may move instead of copy"""
+
+    def temporary_file_path(self):
+        return self.name
+
+
+def store_file(local_path, name, storage=None):
+    """
+    Save a finished local file to storage and remove the local file
+
+    With a local storage on the same file system as the scratch directory,
+    the file is renamed into place rather than copied.
+
+    Args:
+        local_path: Path of the local file
+        name: Requested storage name
+        storage: Target storage (default_storage when None)
+
+    Returns:
+        The name the file was stored under (it may differ from name when the
+        name was already taken)
+    """
+    storage = storage or default_storage
+    try:
+        with open(local_path, 'rb') as f:
+            content = _ScratchFile(f, local_path) if is_local(storage) else File(f, os.path.basename(name))
+            return storage.save(name, content)
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+
+def delete_stored(names, storage=None):
+    """Delete stored files, ignoring the ones already gone"""
+    storage = storage or default_storage
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception as e:
+            print(f"Error deleting file {name}: {e}")
+
+
+def cleanup_old_stored_files(prefix, max_files=10, storage=None):
+    """
+    Delete the oldest files of a storage directory if there are more than max_files
+
+    Blobs of a ContentAddressedStorage no name links to any more (e.g. names
+    deleted outside the storage API) are removed as well.
+
+    Args:
+        prefix: Storage directory (e.g. 'outputs')
+        max_files: Maximum number of files to keep
+        storage: Storage to clean (default_storage when None)
+    """
+    storage = storage or default_storage
+    try:
+        _, filenames = storage.listdir(prefix)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    files = []
+    for filename in filenames:
+        name = f'{prefix}/{filename}'
+        try:
+            files.append((name, storage.get_modified_time(name)))
+        except (FileNotFoundError, NotImplementedError):
+            continue
+
+    files.sort(key=lambda item: item[1])
+    if len(files) > max_files:
+        delete_stored([name for name, _ in files[:len(files) - max_files]], storage)
+
+    if hasattr(storage, 'collect_orphans'):
+        storage.collect_orphans()
@@ -0,0 +1,393 @@
+import mmap
+import re
+import struct
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+
+from .inspector import inspect_workbook
+from .readers import (column_names, detect_excel_format, frame_from_rows, is_file_object, read_sheet_streamed,
+                      row_values)
+from .tracing import span
+from .workers import process_context
+from .workspace import scratch_file
+
+
+# A row range parsed by one process is at least this large (sheet XML bytes),
+# and a sheet is split into at most this many ranges per process
+MIN_CHUNK_BYTES = 8 * 1024 * 1024
+CHUNKS_PER_PROCESS = 2
+
+# Bytes read around each split target to find the next row start, and at the
+# start of the sheet to find <sheetData> (after the sheet's <cols>)
+ROW_SCAN_BYTES = 1024 * 1024
+HEAD_SCAN_BYTES = 4 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+ROOT_RE = re.compile(rb'<((?:[\w.-]+:)?)worksheet[\s>]')
+SHEET_DATA_RE = re.compile(rb'<((?:[\w.-]+:)?)sheetData(?:\s[^>]*)?(/?)>')
+ROW_NUMBER_RE = re.compile(rb'\sr\s*=\s*["\']')
+
+
+class _Unsplittable(Exception):
+    """The sheet's rows cannot be parsed in ranges (the sheet is read serially)"""
+
+
+def parallel_processes(source, sheet_name=None):
+    """
+    Number of processes a sheet is parsed with by read_sheet_parallel (0 =
+    read it serially)
+
+    Only .xlsx files given by path whose sheet XML is at least
+    EXCEL_PARALLEL_PARSE_MIN_MB are split; this reads workbook metadata only.
+
+    Args:
+        source: Path to Excel file, or a seekable file object
+        sheet_name: Name of the sheet (None = the first sheet)
+
+    Returns:
+        int
+    """
+    processes = settings.EXCEL_PARSE_PROCESSES
+    if processes < 2 or is_file_object(source):
+        return 0
+    try:
+        if detect_excel_format(source) != 'xlsx':
+            return 0
+        sheets = inspect_workbook(source)['sheets']
+    except Exception:
+        # The serial reader reports unreadable files
+        return 0
+
+    sheet = next((sheet for sheet in sheets if sheet_name is None or sheet['name'] == sheet_name), None)
+    if sheet is None or sheet['uncompressed_size'] < settings.EXCEL_PARALLEL_PARSE_MIN_MB * 1024 * 1024:
+        return 0
+    return processes
+
+
+def _write_shared_strings(strings, path):
+    """
+    Write a workbook's shared strings for _SharedStrings: their count, the
+    offset of each in the text, then the UTF-8 text of all of them
+    """
+    offsets = array('Q', [0])
+    with open(path, 'wb') as out:
+        encoded = [str(value).encode('utf-8', 'surrogatepass') for value in strings]
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        out.write(array('Q', [len(encoded)]).tobytes())
+        out.write(offsets.tobytes())
+        for value in encoded:
+            out.write(value)
+
+
+class _SharedStrings:
+    """
+    Shared strings table written by _write_shared_strings, read from a memory
+    map so every process parsing the sheet uses one copy of it
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count, = struct.unpack_from('=Q', self._map)
+        self._text = 8 * (count + 2)
+
+    def __getitem__(self, index):
+        start, end = struct.unpack_from('=QQ', self._map, 8 * (index + 1))
+        return self._map[self._text + start:self._text + end].decode('utf-8', 'surrogatepass')
+
+    def close(self):
+        self._map.close()
+
+
+class _RowRange:
+    """
+    File-like object reading rows start:end of an extracted sheet as an XML
+    document: the sheet's head (up to <sheetData>), the rows, then the tail
+    closing <sheetData> and the root element (empty when end is the end of
+    the sheet, which closes them itself)
+    """
+
+    def __init__(self, path, head, start, end, tail):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._head = head
+        self._tail = tail
+
+    def read(self, size=-1):
+        if self._head:
+            data, self._head = self._head, b''
+            return data
+        if self._remaining:
+            data = self._file.read(self._remaining if size is None or size < 0 else min(size, self._remaining))
+            self._remaining = self._remaining - len(data) if data else 0
+            if data:
+                return data
+        data, self._tail = self._tail, b''
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _parse_range(sheet_path, strings_path, head, start, end, tail, reading):
+    """
+    Parse one row range of a sheet (run in a parse process)
+
+    Rows are turned into values and filtered as read_sheet_streamed does.
+    Row numbers missing inside the range are empty rows; the rows at or
+    above the header are left out.
+
+    Args:
+        reading: dict with the workbook's 'epoch', 'date_formats' and
+            'timedelta_formats', and the read's 'skip_rows', 'row_filter'
+            and 'header'
+
+    Returns:
+        tuple (first row number, last row number (None when the range has no
+        rows), number of data rows scanned, kept rows)
+    """
+    from openpyxl.worksheet._reader import WorkSheetParser
+
+    skip_rows = reading['skip_rows']
+    matches = None
+    if reading['row_filter'] is not None:
+        matches = reading['row_filter'].bind(reading['header'])
+
+    data = []
+    rows_scanned = 0
+    first = None
+    counter = None
+
+    def add(values, number):
+        nonlocal rows_scanned
+        # Row numbers start at 1; the header is row skip_rows + 1
+        if number > skip_rows + 1:
+            rows_scanned += 1
+            if matches is None or matches(values):
+                data.append(values)
+
+    strings = _SharedStrings(strings_path)
+    source = _RowRange(sheet_path, head, start, end, tail)
+    try:
+        parser = WorkSheetParser(source, strings, data_only=True, epoch=reading['epoch'],
+                                 date_formats=reading['date_formats'],
+                                 timedelta_formats=reading['timedelta_formats'])
+        for number, cells in parser.parse():
+            if first is None:
+                first = counter = number
+            if number < counter:
+                # Out of order, skipped as openpyxl does
+                continue
+            for missing in range(counter, number):
+                add([], missing)
+
+            values = [None] * (max((cell['column'] for cell in cells), default=0))
+            for cell in cells:
+                values[cell['column'] - 1] = cell['value']
+            add(row_values(values), number)
+            counter = number + 1
+    finally:
+        source.close()
+        strings.close()
+
+    return first, None if first is None else counter - 1, rows_scanned, data
+
+
+def _extract_sheet(archive, part, path):
+    """
+    Decompress a sheet's XML to path
+
+    Returns:
+        tuple (the sheet's XML up to and including its <sheetData> tag, the
+        tags closing <sheetData> and the root element, pattern of row start
+        tags)
+    """
+    with archive.open(part) as stream, open(path, 'wb') as out:
+        head = b''
+        match = None
+        while True:
+            data = stream.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+            if match is None and len(head) < HEAD_SCAN_BYTES:
+                head += data
+                match = SHEET_DATA_RE.search(head)
+    if match is None or match.group(2):
+        raise _Unsplittable('no <sheetData> with rows')
+    root = ROOT_RE.search(head, 0, match.start())
+    if root is None:
+        raise _Unsplittable('no <worksheet> element')
+    tail = b'</%ssheetData></%sworksheet>' % (match.group(1), root.group(1))
+    return head[:match.end()], tail, re.compile(rb'<' + re.escape(match.group(1)) + rb'row[\s>/]')
+
+
+def _split_points(path, start, size, chunks, row_re):
+    """Offsets of row start tags near chunks evenly spaced targets after start"""
+    points = [start]
+    with open(path, 'rb') as f:
+        for index in range(1, chunks):
+            target = start + (size - start) * index // chunks
+            if target <= points[-1]:
+                continue
+            f.seek(target)
+            window = f.read(ROW_SCAN_BYTES)
+            match = row_re.search(window)
+            if match is None:
+                continue
+            tag_end = window.find(b'>', match.start())
+            # Rows are numbered by their r attribute; a range starting with an
+            # unnumbered row could not know its row number
+            if tag_end < 0 or not ROW_NUMBER_RE.search(window, match.start(), tag_end):
+                raise _Unsplittable('rows without row numbers')
+            points.append(target + match.start())
+    return points
+
+
+def read_sheet_parallel(file_path, sheet_name, skip_rows=0, row_filter=None, on_progress=None, processes=None):
+    """
+    Read a huge .xlsx sheet into a DataFrame, parsing row ranges of it in
+    parallel processes
+
+    The sheet's XML is decompressed once to a scratch file and split at row
+    start tags; each range is parsed by openpyxl's sheet parser in its own
+    process, against one copy of the shared strings, and the rows are
+    reassembled in order. Values, filtering and the resulting DataFrame are
+    those of read_sheet_streamed, which is used instead when the sheet
+    cannot be split (e.g. rows without row numbers).
+
+    Args:
+        file_path: Path to an .xlsx file
+        sheet_name: Name of the sheet to read (None = the first sheet)
+        skip_rows: Number of rows to skip before the header row
+        row_filter: filters.RowFilter (None = keep all rows)
+        on_progress: Called with the number of data rows scanned so far as
+            ranges are parsed; exceptions it raises (e.g. cancellation) stop
+            the read
+        processes: Number of parse processes (None = EXCEL_PARSE_PROCESSES)
+
+    Returns:
+        tuple (pandas.DataFrame, dict with 'rows_scanned' and 'rows_kept')
+    """
+    import openpyxl
+
+    processes = processes or settings.EXCEL_PARSE_PROCESSES
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        worksheet = workbook[sheet_name] if sheet_name is not None else workbook.worksheets[0]
+        sheet_name = worksheet.title
+        reading = {
+            'epoch': workbook.epoch,
+            'date_formats': workbook._date_formats,
+            'timedelta_formats': workbook._timedelta_formats,
+            'skip_rows': skip_rows,
+            'row_filter': row_filter,
+        }
+
+        with scratch_file('.xml') as sheet_path, scratch_file('.strings') as strings_path:
+            try:
+                with span('xlsx_parallel.split', sheet=sheet_name) as s:
+                    head, tail, row_re = _extract_sheet(workbook._archive, worksheet._worksheet_path, sheet_path)
+                    size = workbook._archive.getinfo(worksheet._worksheet_path).file_size
+                    chunks = min(processes * CHUNKS_PER_PROCESS, size // MIN_CHUNK_BYTES)
+                    points = _split_points(sheet_path, len(head), size, chunks, row_re)
+                    if len(points) < 2:
+                        raise _Unsplittable('sheet too small to split')
+                    s.set(chunks=len(points), bytes=size)
+                _write_shared_strings(worksheet._shared_strings, strings_path)
+            except _Unsplittable as e:
+                print(f"Reading sheet {sheet_name} serially: {e}")
+                return read_sheet_streamed(file_path, sheet_name, skip_rows, row_filter, on_progress=on_progress)
+
+            header = None
+            # Rows are read past a stale <dimension>, as iter_sheet_rows does
+            worksheet.reset_dimensions()
+            for index, row in enumerate(worksheet.iter_rows(max_row=skip_rows + 1, values_only=True)):
+                if index == skip_rows:
+                    header = row_values(row)
+            if header is None:
+                raise ValueError(f"Sheet {sheet_name} has no rows after skipping {skip_rows}")
+            reading['header'] = column_names(header)
+
+            ranges = [
+                (sheet_path, strings_path, head, start, end, tail if end < size else b'', reading)
+                for start, end in zip(points, points[1:] + [size])
+            ]
+            with span('xlsx_parallel.parse', sheet=sheet_name, processes=processes, chunks=len(ranges)):
+                results = _parse_ranges(ranges, processes, on_progress)
+    finally:
+        workbook.close()
+
+    try:
+        data, rows_scanned = _assemble(results, header, reading)
+    except _Unsplittable as e:
+        print(f"Reading sheet {sheet_name} serially: {e}")
+        return read_sheet_streamed(file_path, sheet_name, skip_rows, row_filter, on_progress=on_progress)
+
+    if on_progress is not None:
+        on_progress(rows_scanned)
+
+    df = frame_from_rows(data)
+    return df, {'rows_scanned': rows_scanned, 'rows_kept': len(df)}
+
+
+def _parse_ranges(ranges, processes, on_progress):
+    """Run _parse_range over ranges in parse processes; return the results in range order"""
+    results = [None] * len(ranges)
+    executor = ProcessPoolExecutor(min(processes, len(ranges)), mp_context=process_context())
+    try:
+        pending = {executor.submit(_parse_range, *arguments): index for index, arguments in enumerate(ranges)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+            if on_progress is not None:
+                on_progress(sum(result[2] for result in results if result is not None))
+    except BaseException:
+        # Ranges being parsed finish in the background; the others never start
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return results
+
+
+def _assemble(results, header, reading):
+    """
+    Join the rows of the parsed ranges in order, filling in the rows missing
+    between ranges as _parse_range does within one
+
+    Returns:
+        tuple (list of rows, header first; number of data rows scanned)
+    """
+    skip_rows = reading['skip_rows']
+    matches = None
+    if reading['row_filter'] is not None:
+        matches = reading['row_filter'].bind(reading['header'])
+
+    data = [header]
+    rows_scanned = 0
+    counter = 1
+
+    def fill(until):
+        nonlocal rows_scanned
+        # Missing rows are empty; those at or above the header are not data
+        for number in range(max(counter, skip_rows + 2), until):
+            rows_scanned += 1
+            if matches is None or matches([]):
+                data.append([])
+
+    for first, last, scanned, rows in results:
+        if first is None:
+            continue
+        if first < counter:
+            raise _Unsplittable('rows out of order')
+        fill(first)
+        data.extend(rows)
+        rows_scanned += scanned
+        counter = last + 1
+    return data, rows_scanned